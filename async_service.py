@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Native asyncio service mode: the same routes as python_agent_service.py
+(/health, /intent, /optimize, /optimize-route, /optimize-route/stream, /jobs) served by aiohttp, with
+every upstream call made on one shared aiohttp client session instead of threads. Background jobs run
+on the app's event loop.
+
+Run with `python async_service.py` (ASYNC_HOST / ASYNC_PORT, default port 5050).
+"""
+import asyncio
+import json
+
+from aiohttp import web
+
+import service_config as config
+import http_clients
+import models
+import route_pipeline
+from upstream import Upstream
+
+UPSTREAM = web.AppKey("upstream", Upstream)
+
+
+async def read_json(request):
+    """Request body as a dict, {} when empty or not JSON (like Flask's request.json or {})."""
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return {}
+    return body or {}
+
+
+def respond(result):
+    payload, status, *headers = result
+    return web.Response(body=models.dumps(payload), status=status, headers=headers[0] if headers else None,
+                        content_type="application/json")
+
+
+async def health(request):
+    return respond(await route_pipeline.health(request.app[UPSTREAM]))
+
+
+async def intent(request):
+    return respond(await route_pipeline.intent(await read_json(request), request.app[UPSTREAM]))
+
+
+async def optimize(request):
+    return respond(await route_pipeline.optimize(await read_json(request), request.app[UPSTREAM]))
+
+
+async def optimize_route(request):
+    body = route_pipeline.with_query(await read_json(request), request.query)
+    return respond(await route_pipeline.optimize_route(body, request.app[UPSTREAM]))
+
+
+async def optimize_route_stream(request):
+    body = route_pipeline.with_query(await read_json(request), request.query)
+    return await stream(request, route_pipeline.stream_optimize_route(body, request.app[UPSTREAM]))
+
+
+async def submit_job(request):
+    body = route_pipeline.with_query(await read_json(request), request.query)
+    return respond(await route_pipeline.submit_job(body, request.app[UPSTREAM]))
+
+
+async def job_status(request):
+    return respond(await route_pipeline.job_status(request.match_info["job_id"], request.app[UPSTREAM]))
+
+
+async def cancel_job(request):
+    return respond(await route_pipeline.cancel_job(request.match_info["job_id"], request.app[UPSTREAM]))
+
+
+async def job_stream(request):
+    lines = await route_pipeline.job_stream(request.match_info["job_id"])
+    if lines is None:
+        return respond(({"success": False, "error": "Unknown or expired job"}, 404))
+    return await stream(request, lines)
+
+
+async def stream(request, lines):
+    """Send the NDJSON lines of an async generator as they come; it is closed when the client goes away."""
+    response = web.StreamResponse(headers={
+        "Content-Type": "application/x-ndjson",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+    try:
+        async for line in lines:
+            await response.write(line)
+    finally:
+        await lines.aclose()
+    await response.write_eof()
+    return response
+
+
+async def start_upstream(app):
+    client = http_clients.AsyncHTTPClient()
+    await client.start()
+    app[UPSTREAM] = Upstream(client)
+    # Jobs use the app's upstream, so they must run on its loop
+    route_pipeline.JOBS.run_on(asyncio.get_running_loop())
+
+
+async def close_upstream(app):
+    await app[UPSTREAM].transport.close()
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_post("/intent", intent)
+    app.router.add_post("/optimize", optimize)
+    app.router.add_post("/optimize-route", optimize_route)
+    app.router.add_post("/optimize-route/stream", optimize_route_stream)
+    app.router.add_post("/jobs", submit_job)
+    app.router.add_get("/jobs/{job_id}", job_status)
+    app.router.add_delete("/jobs/{job_id}", cancel_job)
+    app.router.add_get("/jobs/{job_id}/stream", job_stream)
+    app.on_startup.append(start_upstream)
+    app.on_cleanup.append(close_upstream)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=config.ASYNC_HOST, port=config.ASYNC_PORT)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark the vectorized distance kernels and grid deduplication in geo_kernels
+against the original pure-Python helpers, at 10, 1k and 100k points.
+
+    python benchmarks/bench_geo.py [--sizes 10,1000,100000] [--repeat 3]
+
+The pairwise reference implementations are O(n^2); they are skipped above
+--reference-limit points and reported as "skipped".
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geo_kernels  # noqa: E402
+
+
+def haversine_reference(lat1, lon1, lat2, lon2):
+    # The original python_agent_service.haversine, including its per-call import
+    from math import radians, sin, cos, sqrt, atan2
+    R = 6371000.0
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    return R * c
+
+
+def deduplicate_reference(locations, min_distance_meters=50):
+    # The original pairwise python_agent_service.deduplicate_locations
+    deduped = []
+    for loc in locations:
+        is_duplicate = False
+        for existing in deduped:
+            distance = haversine_reference(
+                loc.get("latitude", 0), loc.get("longitude", 0),
+                existing.get("latitude", 0), existing.get("longitude", 0),
+            )
+            if distance < min_distance_meters:
+                is_duplicate = True
+                break
+        if not is_duplicate:
+            deduped.append(loc)
+    return deduped
+
+
+def synthetic_locations(n, seed=0, spread_deg=0.5, duplicate_ratio=0.2):
+    """Random points around San Ramon, CA; a share of them are jittered copies (< 30 m away)."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        if out and rng.random() < duplicate_ratio:
+            base = rng.choice(out)
+            lat = base["latitude"] + rng.uniform(-0.0002, 0.0002)
+            lon = base["longitude"] + rng.uniform(-0.0002, 0.0002)
+        else:
+            lat = 37.78 + rng.uniform(-spread_deg, spread_deg)
+            lon = -121.98 + rng.uniform(-spread_deg, spread_deg)
+        out.append({"latitude": lat, "longitude": lon, "name": f"Place {i}", "address": f"{i} Main St"})
+    return out
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def fmt(seconds):
+    if seconds is None:
+        return "skipped"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds:.2f}s"
+
+
+def run(sizes, repeat, reference_limit):
+    rows = []
+    for n in sizes:
+        locs = synthetic_locations(n)
+        start = (37.78, -121.98)
+        lats, lons = geo_kernels.coords(locs)
+
+        # Distances from the start to every point (the stage-5 nearest-to-start sort)
+        ref_t, ref_sorted = timeit(lambda: sorted(locs, key=lambda L: haversine_reference(start[0], start[1], L["latitude"], L["longitude"])), repeat)
+        new_t, new_sorted = timeit(lambda: geo_kernels.sort_by_distance(start[0], start[1], locs), repeat)
+        assert [id(x) for x in ref_sorted] == [id(x) for x in new_sorted]
+        rows.append(("sort by distance from start", n, ref_t, new_t))
+
+        # Full pairwise matrix (only where it fits in memory comfortably)
+        if n <= 5000:
+            ref_t = None
+            if n <= reference_limit:
+                ref_t, _ = timeit(lambda: [[haversine_reference(a["latitude"], a["longitude"], b["latitude"], b["longitude"]) for b in locs] for a in locs], 1)
+            new_t, _ = timeit(lambda: geo_kernels.distance_matrix(lats, lons), repeat)
+            rows.append(("distance matrix", n, ref_t, new_t))
+
+        # Deduplication with the 100 m threshold used by optimize_route
+        ref_t = ref_out = None
+        if n <= reference_limit:
+            ref_t, ref_out = timeit(lambda: deduplicate_reference(locs, 100), 1)
+        new_t, new_out = timeit(lambda: geo_kernels.deduplicate_locations(locs, 100), repeat)
+        if ref_out is not None:
+            assert [id(x) for x in ref_out] == [id(x) for x in new_out], "grid dedup diverged from pairwise"
+        rows.append((f"deduplicate (kept {len(new_out)})", n, ref_t, new_t))
+
+    print(f"{'benchmark':<32}{'n':>8}{'original':>12}{'new':>12}{'speedup':>10}")
+    for name, n, ref_t, new_t in rows:
+        speedup = f"{ref_t / new_t:.1f}x" if ref_t and new_t else "-"
+        print(f"{name:<32}{n:>8}{fmt(ref_t):>12}{fmt(new_t):>12}{speedup:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,100000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reference-limit", type=int, default=5000)
+    args = parser.parse_args()
+    run([int(s) for s in args.sizes.split(",")], args.repeat, args.reference_limit)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Offline microbenchmarks for the pure-compute parts of the /optimize-route pipeline:
+haversine, deduplicate_locations, calculate_preference_score, combination
+generation/ranking (trips and matrix modes) and JSON response building (full and
+compact route geometry).
+
+Inputs are synthetic and generated at four scales (small, medium, large, xlarge).
+Results are compared with the stored baseline and reported per case:
+
+    python benchmarks/bench_pipeline.py                      # compare with baselines/pipeline.json
+    python benchmarks/bench_pipeline.py --scales small,medium --only dedup
+    python benchmarks/bench_pipeline.py --save-baseline      # record this machine's numbers
+    python benchmarks/bench_pipeline.py --fail-on-regression # exit 1 if any case is > --threshold slower
+
+Baselines are machine-specific; re-record them when moving to different hardware.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from itertools import product
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# No cache files, log files or log output from the service modules while benchmarking
+os.environ.setdefault("GEOCODE_CACHE_PATH", "")
+os.environ.setdefault("LLM_CACHE_BACKEND", "off")
+os.environ.setdefault("JOB_STORE", "memory")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "memory")
+os.environ.setdefault("LOG_FILE", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import geo_kernels  # noqa: E402
+import models  # noqa: E402
+import route_geometry  # noqa: E402
+import route_pipeline  # noqa: E402
+from bench_geo import fmt, synthetic_locations  # noqa: E402
+
+SCALES = ("small", "medium", "large", "xlarge")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "pipeline.json")
+START = {"latitude": 37.78, "longitude": -121.98, "name": "San Ramon", "address": "San Ramon, California, United States"}
+CHAINS = ["Walmart", "Target", "Safeway", "24 Hour Fitness", "Starbucks", "Costco"]
+
+
+def synthetic_tasks(n_tasks, seed=0):
+    rng = random.Random(seed)
+    tasks = []
+    for t in range(n_tasks):
+        tasks.append(models.Task.from_dict({
+            "type": f"task{t}",
+            "description": f"errand {t}",
+            "preferences": [
+                {"type": "chain", "value": rng.choice(CHAINS), "isMandatory": rng.random() < 0.5},
+                {"type": "category", "value": "market", "isMandatory": False},
+            ],
+        }))
+    return tasks
+
+
+def synthetic_candidates(n_tasks, per_task, seed=0):
+    """location_options and candidate lists shaped like optimize_route's after pruning."""
+    rng = random.Random(seed)
+    tasks = synthetic_tasks(n_tasks, seed)
+    locs = synthetic_locations(n_tasks * per_task, seed=seed, spread_deg=0.15, duplicate_ratio=0)
+    filtered = []
+    for t in range(n_tasks):
+        group = locs[t * per_task:(t + 1) * per_task]
+        for loc in group:
+            loc["name"] = f"{rng.choice(CHAINS)} {loc['name']}"
+        filtered.append(group)
+    options = [{"task": task, "locations": group} for task, group in zip(tasks, filtered)]
+    return options, filtered
+
+
+def road_line(rng, n):
+    """A road-like line: about 10 m between points, heading drifting slowly."""
+    lon, lat, heading = -121.98, 37.78, rng.uniform(0, 2 * math.pi)
+    line = []
+    for _ in range(n):
+        line.append([lon, lat])
+        heading += rng.gauss(0, 0.15)
+        lon += 0.00011 * math.cos(heading)
+        lat += 0.00009 * math.sin(heading)
+    return line
+
+
+def synthetic_payload(n_coords, seed=0, road=False):
+    """
+    An optimize_route response with five routes whose geometry/steps total n_coords points,
+    scattered around the start or (road=True) following road_line.
+    """
+    rng = random.Random(seed)
+    options, filtered = synthetic_candidates(3, 3, seed)
+    per_route = max(2, n_coords // 5)
+    routes = []
+    for r in range(5):
+        if road:
+            line = road_line(rng, per_route)
+        else:
+            line = [[-121.98 + rng.uniform(-0.1, 0.1), 37.78 + rng.uniform(-0.1, 0.1)] for _ in range(per_route)]
+        steps = [{
+            "distance": rng.uniform(10, 500),
+            "duration": rng.uniform(5, 60),
+            "name": "Main St",
+            "maneuver": {"instruction": "Turn left onto Main St", "type": "turn", "location": line[i]},
+            "geometry": {"type": "LineString", "coordinates": line[i:i + 2]},
+        } for i in range(0, per_route - 1, 10)]
+        stops = tuple(group[r % len(group)] for group in filtered)
+        routes.append({
+            "id": f"route-{r + 1}",
+            "stops": stops,
+            "totalDistance": rng.uniform(5000, 30000),
+            "totalDuration": rng.uniform(600, 3600),
+            "legs": [{"distance": 1000.0, "duration": 100.0, "steps": steps}],
+            "geometry": {"type": "LineString", "coordinates": line},
+            "preferenceScore": 70,
+            "visitOrder": list(range(len(stops))),
+        })
+    return {
+        "success": True,
+        "parsedRequest": {"startingLocation": START, "tasks": [o["task"].to_dict() for o in options], "preferences": [], "optimizeFor": "time"},
+        "routes": routes,
+        "timings": {"mode": "concurrent", "tasks": [], "routeEvaluation": {"mode": "matrix", "ms": 1.0}},
+    }
+
+
+def durations_for(points):
+    """Synthetic travel-duration matrix: straight-line distance at 10 m/s."""
+    lats, lons = geo_kernels.coords(points)
+    return (geo_kernels.distance_matrix(lats, lons) / 10.0).tolist()
+
+
+def trips_combinations(filtered, options):
+    # evaluate_routes_trips without the optimized-trips calls: enumerate and score every combination
+    filtered = [geo_kernels.sort_by_distance(START["latitude"], START["longitude"], locs) for locs in filtered]
+    scores = []
+    for combo in product(*filtered):
+        task_order = [{"task": options[i]["task"], "location": c} for i, c in enumerate(combo)]
+        scores.append(route_pipeline.calculate_preference_score(task_order))
+    return scores
+
+
+# name -> (scale -> size, setup(size) -> zero-argument callable)
+def _haversine_scalar(n):
+    locs = synthetic_locations(n, duplicate_ratio=0)
+    pairs = [(a["latitude"], a["longitude"], b["latitude"], b["longitude"]) for a, b in zip(locs, locs[1:] + locs[:1])]
+    return lambda: [route_pipeline.haversine(*p) for p in pairs]
+
+
+def _haversine_vector(n):
+    lats, lons = geo_kernels.coords(synthetic_locations(n, duplicate_ratio=0))
+    return lambda: geo_kernels.haversine_np(START["latitude"], START["longitude"], lats, lons)
+
+
+def _dedup(n):
+    locs = synthetic_locations(n)
+    return lambda: route_pipeline.deduplicate_locations(locs, min_distance_meters=100)
+
+
+def _preference(n):
+    options, filtered = synthetic_candidates(3, max(1, n // 3))
+    orders = [[{"task": options[t]["task"], "location": filtered[t][i % len(filtered[t])]} for t in range(3)] for i in range(n)]
+    return lambda: [route_pipeline.calculate_preference_score(o) for o in orders]
+
+
+def _trips(shape):
+    options, filtered = synthetic_candidates(*shape)
+    return lambda: trips_combinations(filtered, options)
+
+
+def _matrix(shape):
+    options, filtered = synthetic_candidates(*shape)
+    points, groups = route_pipeline.candidate_points(START, filtered)
+    durations = durations_for(points)
+    return lambda: route_pipeline.rank_combinations(points, groups, options, durations)
+
+
+def _json(n):
+    payload = synthetic_payload(n)
+    return lambda: json.dumps(payload)
+
+
+def with_models(payload):
+    """payload with its route dicts turned into models.Route, as optimize_route builds them."""
+    return {**payload, "routes": [models.Route.from_dict(r) for r in payload["routes"]]}
+
+
+def _json_models(n):
+    # fidelity=full through the route model and models.dumps (orjson when installed)
+    payload = with_models(synthetic_payload(n))
+    return lambda: models.dumps(route_geometry.compact_payload(payload, "full"))
+
+
+def _json_compact(n):
+    # fidelity=medium: polyline6 geometry simplified for zoom 14, trimmed steps
+    payload = with_models(synthetic_payload(n, road=True))
+    return lambda: models.dumps(route_geometry.compact_payload(payload, "medium"))
+
+
+def _json_flask(n):
+    from flask import Flask
+
+    app = Flask(__name__)
+    payload = synthetic_payload(n)
+
+    def build():
+        with app.app_context():
+            return app.json.response(payload).get_data()
+    return build
+
+
+CASES = {
+    "haversine (scalar, pairs)": ({"small": 100, "medium": 10_000, "large": 100_000, "xlarge": 1_000_000}, _haversine_scalar),
+    "haversine (vectorized, points)": ({"small": 100, "medium": 10_000, "large": 100_000, "xlarge": 1_000_000}, _haversine_vector),
+    "deduplicate_locations": ({"small": 100, "medium": 1_000, "large": 10_000, "xlarge": 100_000}, _dedup),
+    "calculate_preference_score": ({"small": 100, "medium": 1_000, "large": 10_000, "xlarge": 100_000}, _preference),
+    # (tasks, candidates per task)
+    "combinations: trips enumerate+score": ({"small": (2, 2), "medium": (3, 3), "large": (5, 3), "xlarge": (7, 4)}, _trips),
+    "combinations: matrix rank": ({"small": (2, 3), "medium": (3, 3), "large": (5, 3), "xlarge": (8, 3)}, _matrix),
+    # total route geometry points in the response
+    "json response: json.dumps": ({"small": 100, "medium": 1_000, "large": 10_000, "xlarge": 100_000}, _json),
+    "json response: models + dumps": ({"small": 100, "medium": 1_000, "large": 10_000, "xlarge": 100_000}, _json_models),
+    "json response: compact + dumps": ({"small": 100, "medium": 1_000, "large": 10_000, "xlarge": 100_000}, _json_compact),
+    "json response: flask jsonify": ({"small": 100, "medium": 1_000, "large": 10_000, "xlarge": 100_000}, _json_flask),
+}
+
+
+def measure(fn, repeat, min_sample=0.02):
+    """Best per-call time over `repeat` samples; fast cases loop until a sample takes min_sample seconds."""
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_sample:
+            break
+        loops *= 2 if elapsed * 10 > min_sample else 10
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / loops)
+    return best
+
+
+def size_label(size):
+    return "x".join(str(s) for s in size) if isinstance(size, tuple) else str(size)
+
+
+def run(scales, repeat, only=None):
+    results = {}
+    for name, (sizes, setup) in CASES.items():
+        if only and only.lower() not in name.lower():
+            continue
+        for scale in scales:
+            fn = setup(sizes[scale])
+            fn()  # warm-up (imports, caches, allocator)
+            seconds = measure(fn, repeat)
+            results[f"{name}/{scale}"] = {"size": size_label(sizes[scale]), "seconds": seconds}
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("results", {})
+
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    existing = load_baseline(path)
+    existing.update(results)
+    with open(path, "w") as f:
+        json.dump({
+            "machine": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.machine()},
+            "recorded": time.strftime("%Y-%m-%d"),
+            "results": existing,
+        }, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def report(results, baseline, threshold):
+    """Print the comparison table; returns the keys that regressed beyond threshold."""
+    regressions = []
+    print(f"{'benchmark':<38}{'scale':<8}{'size':>9}{'baseline':>11}{'current':>11}{'ratio':>8}  status")
+    for key, res in results.items():
+        name, scale = key.rsplit("/", 1)
+        base = baseline.get(key, {}).get("seconds")
+        ratio = res["seconds"] / base if base else None
+        if ratio is None:
+            status = "new"
+        elif ratio > threshold:
+            status = "REGRESSION"
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            status = "faster"
+        else:
+            status = "ok"
+        print(f"{name:<38}{scale:<8}{res['size']:>9}{(fmt(base) if base else '-'):>11}{fmt(res['seconds']):>11}"
+              f"{(f'{ratio:.2f}x' if ratio else '-'):>8}  {status}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default=",".join(SCALES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="run only cases whose name contains this text")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="merge these results into the baseline file")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    scales = [s for s in args.scales.split(",") if s]
+    unknown = set(scales) - set(SCALES)
+    if unknown:
+        parser.error(f"unknown scales: {', '.join(sorted(unknown))}")
+    results = run(scales, args.repeat, args.only)
+    regressions = report(results, load_baseline(args.baseline), args.threshold)
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"\nbaseline saved to {args.baseline}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold}x: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            sys.exit(1)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Per-request latency budget shared by every stage and upstream call of a request.
+
+begin(seconds) starts the budget; it lives in a contextvar, so tasks the request
+spawns (gather, ensure_future, to_thread) see the same deadline. Then:
+
+- Upstream helpers use timeout(default) for HTTP timeouts: the usual value, capped
+  at whatever time is left.
+- A stage that must leave time for later stages runs inside limit(reserve), which
+  sets a tighter deadline for everything awaited inside the block.
+- bounded(aw) and gather_partial(aws) stop waiting when the deadline passes. Stages
+  that were cut short are recorded with note(stage) and reported by missed(), so the
+  response can be flagged as partial.
+
+Without a budget (begin(None), or outside a request) everything waits as before.
+"""
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+
+
+class DeadlineExceeded(Exception):
+    """The request's latency budget (or the current stage's share of it) ran out."""
+
+
+class Deadline:
+    def __init__(self, at, missed):
+        self.at = at
+        self.missed = missed  # shared with the request's nested limits
+
+    def remaining(self):
+        return max(0.0, self.at - time.monotonic())
+
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+def begin(seconds):
+    """Start a budget of `seconds` for the current request (None or 0: unbounded)."""
+    _current.set(Deadline(time.monotonic() + seconds, []) if seconds else None)
+
+
+def remaining():
+    """Seconds left in the current (stage) deadline, or None without a budget."""
+    d = _current.get()
+    return d.remaining() if d is not None else None
+
+
+def expired():
+    d = _current.get()
+    return d is not None and d.remaining() <= 0
+
+
+def timeout(default):
+    """Timeout for one upstream call: default, capped at the time left. Raises DeadlineExceeded if none is left."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(default, left)
+
+
+@contextmanager
+def limit(reserve):
+    """Within the block the deadline is `reserve` seconds earlier, keeping that much for later stages."""
+    d = _current.get()
+    if d is None:
+        yield
+        return
+    token = _current.set(Deadline(d.at - reserve, d.missed))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def note(stage):
+    """Record that `stage` was cut short by the deadline."""
+    d = _current.get()
+    if d is not None and stage not in d.missed:
+        d.missed.append(stage)
+
+
+def missed():
+    """Stages cut short so far in this request, in the order they happened."""
+    d = _current.get()
+    return list(d.missed) if d is not None else []
+
+
+async def bounded(aw):
+    """await aw, giving up (and cancelling it) when the deadline passes; raises DeadlineExceeded then."""
+    left = remaining()
+    if left is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, left)
+    except asyncio.TimeoutError:
+        if expired():
+            raise DeadlineExceeded() from None
+        raise
+
+
+async def gather_partial(aws, stage):
+    """
+    Like asyncio.gather, but awaitables still running at the deadline are cancelled and
+    give None (as do those that raised DeadlineExceeded), and the stage is noted.
+    Other exceptions propagate.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    left = remaining()
+    try:
+        await asyncio.wait(tasks, timeout=left)
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+    out = []
+    error = None
+    for t in tasks:
+        # Tasks cancelled just above are not done until their next step runs
+        if not t.done() or t.cancelled() or isinstance(t.exception(), DeadlineExceeded):
+            note(stage)
+            out.append(None)
+        elif t.exception() is not None:
+            error = error or t.exception()
+        else:
+            out.append(t.result())
+    if error is not None:
+        raise error
+    return out
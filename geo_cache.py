@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Persistent geocoding cache shared by the Mapbox helpers in upstream.
+
+Entries live in a small SQLite file so they survive restarts and are shared by
+every worker process on the host. Keys are canonicalized so that trivially
+different spellings of the same place ("San Ramon, CA" / "san ramon california 94583")
+hit the same row.
+
+Every call is SQLite I/O behind a lock: code on an event loop goes through io(),
+which runs it in a worker thread for the stores that block (see `blocking`).
+"""
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+US_STATES = {
+    "al": "alabama", "ak": "alaska", "az": "arizona", "ar": "arkansas", "ca": "california",
+    "co": "colorado", "ct": "connecticut", "de": "delaware", "fl": "florida", "ga": "georgia",
+    "hi": "hawaii", "id": "idaho", "il": "illinois", "in": "indiana", "ia": "iowa",
+    "ks": "kansas", "ky": "kentucky", "la": "louisiana", "me": "maine", "md": "maryland",
+    "ma": "massachusetts", "mi": "michigan", "mn": "minnesota", "ms": "mississippi",
+    "mo": "missouri", "mt": "montana", "ne": "nebraska", "nv": "nevada", "nh": "new hampshire",
+    "nj": "new jersey", "nm": "new mexico", "ny": "new york", "nc": "north carolina",
+    "nd": "north dakota", "oh": "ohio", "ok": "oklahoma", "or": "oregon", "pa": "pennsylvania",
+    "ri": "rhode island", "sc": "south carolina", "sd": "south dakota", "tn": "tennessee",
+    "tx": "texas", "ut": "utah", "vt": "vermont", "va": "virginia", "wa": "washington",
+    "wv": "west virginia", "wi": "wisconsin", "wy": "wyoming", "dc": "district of columbia",
+}
+
+# Reads noted before the LRU column is updated: at most this many, or this many seconds' worth
+TOUCH_BATCH = 64
+TOUCH_FLUSH_SECONDS = 30.0
+
+# A ZIP (or ZIP+4, after punctuation became spaces) ending the last part; 5-digit house
+# numbers elsewhere are part of the address
+_ZIP_RE = re.compile(r"(?:^|\s)\d{5}(?:\s\d{4})?$")
+_PUNCT_RE = re.compile(r"[^\w\s]")
+# A final comma-separated part that is only the country ("..., CA, USA")
+_COUNTRY_RE = re.compile(r"^(usa|us|u s a|u s|united states(?: of america)?)$")
+
+
+def canonical_query(query):
+    """
+    Normalize a free-form place/address string for use as a cache key:
+    lowercase, drop punctuation, a trailing country part and the ZIP code ending
+    what is left, expand a two-letter state code ending the last part and
+    collapse whitespace.
+    """
+    q = (query or "").lower()
+    parts = [" ".join(_PUNCT_RE.sub(" ", part).split()) for part in q.split(",")]
+    parts = [part for part in parts if part]
+    # Only a part of its own is a country or a state code: "Toys R Us" and "Shop In"
+    # keep their last word
+    if len(parts) > 1 and _COUNTRY_RE.match(parts[-1]):
+        parts.pop()
+    if parts:
+        rest = _ZIP_RE.sub("", parts[-1]).strip()
+        if rest:
+            parts[-1] = rest
+        elif len(parts) > 1:
+            parts.pop()  # a ZIP part of its own; a query that is only a ZIP keeps it
+    if len(parts) > 1:
+        words = parts[-1].split()
+        if words[-1] in US_STATES:
+            words[-1] = US_STATES[words[-1]]
+        parts[-1] = " ".join(words)
+    return " ".join(parts)
+
+
+class GeoCache:
+    """SQLite-backed key/value cache with per-entry TTL, LRU eviction and a size cap."""
+
+    # Calls may block (on the file and on other threads' writes), so they must not run on an event loop
+    blocking = True
+
+    def __init__(self, path, ttl_seconds=30 * 24 * 3600, max_entries=50000, table="geocode_cache"):
+        if not table.isidentifier():
+            raise ValueError(f"invalid cache table name: {table!r}")
+        self.path = path
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connect()
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_lru ON {table} (last_access)"
+        )
+        self._conn.commit()
+        self._writes = 0
+        self._touched = {}  # key -> last read, not yet written to last_access
+        self._last_flush = time.time()
+        # A SQLite connection must not be used across fork: a forked child (pre-forked
+        # server worker) opens its own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._connect()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    @staticmethod
+    def make_key(namespace, query, **params):
+        extra = "&".join(f"{k}={params[k]}" for k in sorted(params) if params[k] is not None)
+        return f"{namespace}|{canonical_query(query)}|{extra}"
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[1] < now:
+                    self.misses += 1
+                    return None
+                # A read only notes the access; the LRU column is written in batches, so hits
+                # do not each commit a write
+                self._touched[key] = now
+                if len(self._touched) >= TOUCH_BATCH or now - self._last_flush >= TOUCH_FLUSH_SECONDS:
+                    self._flush_touches(now)
+                    self._conn.commit()
+            except sqlite3.Error:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def get_many(self, keys):
+        """{key: value} for the keys that hit; one call (and one worker thread hop) for a batch."""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def _flush_touches(self, now):
+        if self._touched:
+            self._conn.executemany(
+                f"UPDATE {self.table} SET last_access = ? WHERE key = ?",
+                [(at, key) for key, at in self._touched.items()],
+            )
+            self._touched.clear()
+        self._last_flush = now
+
+    def set(self, key, value, ttl_seconds=None):
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            try:
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_access)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now + ttl, now),
+                )
+                self._touched.pop(key, None)
+                self._writes += 1
+                # Evict in batches rather than on every insert; the table may briefly
+                # exceed max_entries by at most one batch (10% of the cap, max 100 rows)
+                if self._writes % max(1, min(100, self.max_entries // 10)) == 0:
+                    self._evict(now)
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def set_many(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def _evict(self, now):
+        # Pending touches first, so recently read rows are not evicted as stale
+        self._flush_touches(now)
+        self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,))
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f" SELECT key FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            try:
+                size = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            except sqlite3.Error:
+                size = None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / total, 3) if total else None,
+            "entries": size,
+            "maxEntries": self.max_entries,
+        }
+
+
+async def io(store, method, *args):
+    """
+    store.method(*args) from a coroutine: in a worker thread when the store blocks
+    (its `blocking` attribute), inline for in-process stores.
+    """
+    call = getattr(store, method)
+    if getattr(store, "blocking", False):
+        return await asyncio.to_thread(call, *args)
+    return call(*args)
+
+
+def from_env():
+    """Build the cache from GEOCODE_CACHE_* env vars; an empty path disables caching."""
+    path = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3")
+    if not path:
+        return None
+    return GeoCache(
+        path,
+        ttl_seconds=int(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 3600))),
+        max_entries=int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "50000")),
+    )
+
+
+def aliases_from_env():
+    """
+    The start-location alias table (raw start input -> the spelling variant that
+    geocoded), kept in its own table of the geocoding cache file. None when the
+    cache is disabled.
+    """
+    path = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3")
+    if not path:
+        return None
+    return GeoCache(
+        path,
+        ttl_seconds=int(os.getenv("START_ALIAS_TTL", str(180 * 24 * 3600))),
+        max_entries=int(os.getenv("START_ALIAS_MAX_ENTRIES", "20000")),
+        table="start_aliases",
+    )
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Vectorized distance kernels and grid-bucketed deduplication for candidate locations.
+
+Locations are the dicts used throughout python_agent_service
+({"latitude", "longitude", "name", "address", ...}); missing coordinates count as 0,
+as in the original helpers.
+"""
+from math import atan2, cos, radians, sin, sqrt
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE = EARTH_RADIUS_M * np.pi / 180.0
+# Below this many points NumPy's per-call overhead outweighs vectorization
+SMALL_INPUT = 32
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two points (scalar)."""
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return EARTH_RADIUS_M * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+
+def haversine_np(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters; arguments are arrays (or scalars) that broadcast."""
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(lon2) - np.radians(lon1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def coords(locations):
+    """(lats, lons) float arrays for a list of location dicts."""
+    lats = np.fromiter((loc.get("latitude", 0) for loc in locations), dtype=float, count=len(locations))
+    lons = np.fromiter((loc.get("longitude", 0) for loc in locations), dtype=float, count=len(locations))
+    return lats, lons
+
+
+def distances_from(lat, lon, locations):
+    """Distance in meters from (lat, lon) to every location."""
+    lats, lons = coords(locations)
+    return haversine_np(lat, lon, lats, lons)
+
+
+def distance_matrix(lats_a, lons_a, lats_b=None, lons_b=None):
+    """Pairwise distance matrix in meters (len(a) x len(b); a x a when b is omitted)."""
+    lats_a = np.asarray(lats_a, dtype=float)
+    lons_a = np.asarray(lons_a, dtype=float)
+    if lats_b is None:
+        lats_b, lons_b = lats_a, lons_a
+    lats_b = np.asarray(lats_b, dtype=float)
+    lons_b = np.asarray(lons_b, dtype=float)
+    return haversine_np(lats_a[:, None], lons_a[:, None], lats_b[None, :], lons_b[None, :])
+
+
+def sort_by_distance(lat, lon, locations):
+    """Locations ordered nearest-first from (lat, lon); stable for equal distances."""
+    if len(locations) < SMALL_INPUT:
+        return sorted(locations, key=lambda L: haversine(lat, lon, L.get("latitude", 0), L.get("longitude", 0)))
+    order = np.argsort(distances_from(lat, lon, locations), kind="stable")
+    return [locations[i] for i in order]
+
+
+def deduplicate_locations(locations, min_distance_meters=50):
+    """
+    Keep each location unless it lies within min_distance_meters of one already kept
+    (input order decides which survives), like the pairwise version but bucketing kept
+    points into a lat/lon grid so each point is only compared with its 3x3 neighbourhood.
+    The longitude cell width uses the highest latitude in the input, so no pair closer
+    than the threshold can fall outside adjacent cells (away from the poles/antimeridian).
+    """
+    if not locations:
+        return []
+    if min_distance_meters <= 0:
+        return list(locations)
+    lats, lons = coords(locations)
+    cell_lat = min_distance_meters / METERS_PER_DEGREE
+    max_abs_lat = min(89.0, float(np.abs(lats).max()) + cell_lat)
+    cell_lon = cell_lat / max(np.cos(np.radians(max_abs_lat)), 1e-6)
+    rows = np.floor(lats / cell_lat).astype(np.int64).tolist()
+    cols = np.floor(lons / cell_lon).astype(np.int64).tolist()
+    lats = lats.tolist()
+    lons = lons.tolist()
+
+    grid = {}
+    deduped = []
+    for i, loc in enumerate(locations):
+        r, c = rows[i], cols[i]
+        lat, lon = lats[i], lons[i]
+        is_duplicate = False
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                for j in grid.get((r + dr, c + dc), ()):
+                    if haversine(lat, lon, lats[j], lons[j]) < min_distance_meters:
+                        is_duplicate = True
+                        break
+                if is_duplicate:
+                    break
+            if is_duplicate:
+                break
+        if not is_duplicate:
+            grid.setdefault((r, c), []).append(i)
+            deduped.append(loc)
+    return deduped
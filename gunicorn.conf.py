@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Production server for the agent service: gunicorn with pre-forked workers,
+configured from the environment (SERVER_*, WEB_CONCURRENCY; see service_config).
+
+    gunicorn                       # from this directory, which picks up this file
+    ./run_python_service.sh
+
+SERVER_APP=flask serves python_agent_service on gthread workers with
+SERVER_THREADS request threads each; SERVER_APP=async serves async_service on
+aiohttp workers. Either way, WEB_CONCURRENCY processes spread the load over
+the cores, where the development server (python python_agent_service.py)
+runs everything in one.
+
+With SERVER_PRELOAD the app is imported once in the master and warmed up
+(route_pipeline.warm) before the workers are forked, so each worker starts
+hot and shares that memory copy-on-write. Per-process state (the log writer
+thread, SQLite connections, pooled HTTP sessions) is recreated in every worker
+by those modules' fork hooks. In-memory caches are per worker; the disk
+backends (PLAN_CACHE_BACKEND, LLM_CACHE_BACKEND=disk, the geocode cache) are
+shared.
+
+Each worker is replaced after SERVER_MAX_REQUESTS requests (plus up to
+SERVER_MAX_REQUESTS_JITTER), which bounds slow memory growth.
+
+Signals to the master process:
+- HUP: reload this configuration and gracefully replace the workers (in-flight
+  requests get SERVER_GRACEFUL_TIMEOUT seconds). A preloaded app is not
+  re-imported, so to deploy new code send USR2 (start a new master alongside)
+  and then QUIT to the old master, or restart.
+- TTIN / TTOU: one worker more / fewer.
+- TERM: graceful shutdown.
+"""
+import gc
+
+import service_config as config
+
+# SERVER_APP -> (app, worker class)
+APPS = {
+    "flask": ("python_agent_service:app", "gthread"),
+    "async": ("async_service:create_app()", "aiohttp.GunicornWebWorker"),
+}
+if config.SERVER_APP not in APPS:
+    raise ValueError(f"SERVER_APP must be one of {', '.join(APPS)}, not {config.SERVER_APP!r}")
+
+wsgi_app, worker_class = APPS[config.SERVER_APP]
+bind = config.SERVER_BIND
+workers = config.WEB_CONCURRENCY
+threads = config.SERVER_THREADS
+preload_app = config.SERVER_PRELOAD
+max_requests = config.SERVER_MAX_REQUESTS
+max_requests_jitter = config.SERVER_MAX_REQUESTS_JITTER
+timeout = config.SERVER_TIMEOUT
+graceful_timeout = config.SERVER_GRACEFUL_TIMEOUT
+keepalive = config.SERVER_KEEPALIVE
+# The service logs its own structured events (service_logging); gunicorn's access log stays off
+accesslog = None
+
+
+def when_ready(server):
+    # Runs in the master once listening, before the first worker is forked
+    if not preload_app:
+        return
+    import route_pipeline
+
+    route_pipeline.warm()
+    # Keep the garbage collector out of everything allocated so far: collections in the
+    # workers would otherwise write to (and so copy) the pages they share with the master
+    gc.freeze()
+    server.log.info("app preloaded and warmed up; forking %d workers", workers)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Hedged requests for tail-prone upstream calls (geocoding, optimized-trips).
+
+Hedger.do(kind, fetch) awaits fetch(). If it has not finished after the
+HEDGE_PERCENTILE latency recently seen for that kind of call, an identical
+second fetch() is started and whichever finishes first wins; the other is
+cancelled. Until HEDGE_MIN_SAMPLES latencies are known, HEDGE_INITIAL_DELAY_MS is used.
+
+Hedges are extra load on an upstream that may already be slow, so they are
+rationed: every call earns HEDGE_MAX_RATIO of a hedge token, and a hedge spends a
+whole one. That keeps hedges to at most about that fraction of calls, even when
+a latency spike makes the observed percentile stale.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+import service_config as config
+import deadline
+
+
+class Hedger:
+    def __init__(self, percentile, initial_delay, min_delay, min_samples=20, max_ratio=0.1, window=256):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.window = window
+        self._latencies = {}
+        self._counts = {}
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+
+    def delay(self, kind):
+        """Seconds to wait before hedging a call of this kind."""
+        with self._lock:
+            samples = sorted(self._latencies.get(kind, ()))
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        rank = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay, samples[rank])
+
+    def _record(self, kind, seconds):
+        with self._lock:
+            self._latencies.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def _count(self, kind, field):
+        with self._lock:
+            counts = self._counts.setdefault(kind, {"calls": 0, "hedged": 0, "hedgeWins": 0})
+            counts[field] += 1
+            if field == "calls":
+                self._tokens = min(10.0, self._tokens + self.max_ratio)
+
+    def _take_token(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    async def _timed(self, kind, fetch):
+        t0 = time.perf_counter()
+        result = await fetch()
+        self._record(kind, time.perf_counter() - t0)
+        return result
+
+    async def do(self, kind, fetch):
+        self._count(kind, "calls")
+        primary = asyncio.ensure_future(self._timed(kind, fetch))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.delay(kind))
+            if done or deadline.expired() or not self._take_token():
+                return await primary
+            self._count(kind, "hedged")
+            hedge = asyncio.ensure_future(self._timed(kind, fetch))
+            racing = {primary, hedge}
+            error = None
+            while racing:
+                done, racing = await asyncio.wait(racing, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is hedge:
+                            self._count(kind, "hedgeWins")
+                        return t.result()
+                    error = error or t.exception()
+            raise error
+        finally:
+            for t in (primary, hedge):
+                if t is not None:
+                    if not t.done():
+                        t.cancel()
+                    # Nobody awaits the loser: retrieve its outcome (say UpstreamError("timeout"),
+                    # or a failure that came with the winner), or asyncio logs it as never retrieved
+                    t.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def stats(self):
+        with self._lock:
+            kinds = {kind: dict(counts) for kind, counts in self._counts.items()}
+        for kind, counts in kinds.items():
+            counts["delayMs"] = round(self.delay(kind) * 1000, 1)
+        return kinds
+
+
+def from_env():
+    """The Hedger configured by the HEDGE_* settings, or None when UPSTREAM_HEDGING is off."""
+    if not config.UPSTREAM_HEDGING:
+        return None
+    return Hedger(
+        percentile=config.HEDGE_PERCENTILE,
+        initial_delay=config.HEDGE_INITIAL_DELAY_MS / 1000,
+        min_delay=config.HEDGE_MIN_DELAY_MS / 1000,
+        min_samples=config.HEDGE_MIN_SAMPLES,
+        max_ratio=config.HEDGE_MAX_RATIO,
+    )
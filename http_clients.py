@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Shared keep-alive HTTP clients for the upstream APIs (Mapbox, Sudo LLM endpoint).
+
+One requests.Session is kept per upstream host so TCP+TLS connections are
+reused across calls and threads. Idempotent requests (GET/HEAD) are retried
+with exponential backoff on connection errors and 429/5xx responses; POSTs
+are never retried here. A call's timeout covers the whole call, retries and
+backoff included, so a retry never outlasts the request's latency budget.
+
+AsyncHTTPClient is the aiohttp counterpart used by the async service mode,
+with the same retry policy and the same per-host statistics.
+
+Sessions are per process: a forked child (a pre-forked server worker) starts
+without any, so no pooled connection is ever shared between processes.
+"""
+import asyncio
+import json as jsonlib
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import service_config as config
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+if config.RATE_LIMIT_BACKEND != "off":
+    # 429s are retried by upstream through the shared rate limiter, which holds every worker
+    # back until the Retry-After, instead of each caller here retrying on its own
+    RETRY_STATUSES = tuple(s for s in RETRY_STATUSES if s != 429)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
+
+_sessions = {}
+_lock = threading.Lock()
+os.register_at_fork(after_in_child=_sessions.clear)
+
+
+class UpstreamError(Exception):
+    """Transport-level failure (connection error, timeout) talking to an upstream."""
+
+
+def _new_session():
+    # Retries are made by request(), which can keep them within the call's timeout; urllib3's
+    # Retry gives each attempt (and each Retry-After wait) the full timeout
+    adapter = HTTPAdapter(
+        pool_connections=config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=config.HTTP_POOL_MAXSIZE,
+        max_retries=0,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _host(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def session_for(url):
+    """Return the pooled session for the scheme+host of url, creating it on first use."""
+    host = _host(url)
+    session = _sessions.get(host)
+    if session is None:
+        with _lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _sessions[host] = _new_session()
+    return session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """
+    Send a request through the pooled session; transport failures raise UpstreamError.
+    Idempotent requests are retried as AsyncHTTPClient.request does: within `timeout`
+    seconds in all (None: each attempt unbounded), and a retry that could not start
+    before that runs out is not made. The final response is returned whatever its status.
+    """
+    session = session_for(url)
+    attempts = 1 + (config.HTTP_RETRIES if method in IDEMPOTENT_METHODS else 0)
+    end = None if timeout is None else time.monotonic() + timeout
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            r = session.request(method, url, timeout=None if end is None else max(0.001, end - time.monotonic()),
+                                **kwargs)
+        except requests.RequestException as e:
+            delay = _backoff(attempt)
+            if last or (end is not None and time.monotonic() + delay >= end):
+                raise UpstreamError(str(e)) from e
+            time.sleep(delay)
+            continue
+        if r.status_code in RETRY_STATUSES and not last:
+            delay = _backoff(attempt, r.headers.get("Retry-After"))
+            if end is None or time.monotonic() + delay < end:
+                r.close()
+                time.sleep(delay)
+                continue
+        return r
+
+
+def iter_lines(method, url, **kwargs):
+    """
+    Send a request and yield the response body line by line as it arrives (e.g. a
+    server-sent event stream). Non-200 responses and transport failures raise UpstreamError.
+    """
+    try:
+        with session_for(url).request(method, url, stream=True, **kwargs) as r:
+            if r.status_code != 200:
+                raise UpstreamError(f"HTTP {r.status_code}: {r.text[:200]}")
+            for line in r.iter_lines(decode_unicode=True):
+                yield line
+    except requests.RequestException as e:
+        raise UpstreamError(str(e)) from e
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stats():
+    """Per-host connection reuse: requests sent vs. new connections opened by urllib3."""
+    out = {}
+    with _lock:
+        items = list(_sessions.items())
+    for host, session in items:
+        sent = 0
+        opened = 0
+        # The same adapter is mounted for http:// and https://
+        for adapter in {id(a): a for a in session.adapters.values()}.values():
+            pools = getattr(adapter.poolmanager, "pools", None)
+            if pools is None:
+                continue
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                sent += pool.num_requests
+                opened += pool.num_connections
+        out[host] = _stat_entry(sent, opened)
+    return out
+
+
+def _stat_entry(sent, opened):
+    return {
+        "requests": sent,
+        "connectionsOpened": opened,
+        "reuseRatio": round(1 - opened / sent, 3) if sent else None,
+    }
+
+
+def close_all():
+    """Close every pooled session (e.g. in a worker's shutdown hook)."""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class AsyncResponse:
+    """The subset of requests.Response the upstream helpers use."""
+
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self._data = None
+
+    def json(self):
+        if self._data is None:
+            self._data = jsonlib.loads(self.text)
+        return self._data
+
+
+class AsyncHTTPClient:
+    """One pooled aiohttp.ClientSession for all upstream hosts (aiohttp is only needed in async mode)."""
+
+    def __init__(self):
+        self._session = None
+        self._counts = {}
+
+    async def start(self):
+        import aiohttp
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_connection_create_end.append(self._on_connection_created)
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=config.HTTP_POOL_MAXSIZE, keepalive_timeout=30)
+        self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _count(self, host):
+        return self._counts.setdefault(host, [0, 0])
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.host = f"{params.url.scheme}://{params.url.raw_authority}"
+        self._count(ctx.host)[0] += 1
+
+    async def _on_connection_created(self, session, ctx, params):
+        host = getattr(ctx, "host", None)
+        if host:
+            self._count(host)[1] += 1
+
+    async def request(self, method, url, params=None, json=None, headers=None, timeout=30):
+        import aiohttp
+        from yarl import URL
+
+        if self._session is None:
+            await self.start()
+        query = {k: str(v) for k, v in (params or {}).items()}
+        attempts = 1 + (config.HTTP_RETRIES if method in IDEMPOTENT_METHODS else 0)
+        # timeout covers the whole call, retries and backoff included; a retry that
+        # could not start before it runs out is not made
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                # encoded=True: callers already percent-encode path segments
+                async with self._session.request(
+                    method, URL(url, encoded=True), params=query, json=json, headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=max(0.001, end - loop.time())),
+                ) as r:
+                    text = await r.text()
+                    if r.status in RETRY_STATUSES and not last:
+                        delay = _backoff(attempt, r.headers.get("Retry-After"))
+                        if loop.time() + delay < end:
+                            await asyncio.sleep(delay)
+                            continue
+                    return AsyncResponse(r.status, text, dict(r.headers))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = _backoff(attempt)
+                if last or loop.time() + delay >= end:
+                    raise UpstreamError(str(e) or type(e).__name__) from e
+                await asyncio.sleep(delay)
+
+    async def stream_lines(self, method, url, params=None, json=None, headers=None, timeout=60):
+        """Async counterpart of iter_lines (no retries: the body is consumed as it streams)."""
+        import aiohttp
+        from yarl import URL
+
+        if self._session is None:
+            await self.start()
+        query = {k: str(v) for k, v in (params or {}).items()}
+        try:
+            async with self._session.request(
+                method, URL(url, encoded=True), params=query, json=json, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as r:
+                if r.status != 200:
+                    raise UpstreamError(f"HTTP {r.status}: {(await r.text())[:200]}")
+                async for raw in r.content:
+                    yield raw.decode("utf-8", "replace").rstrip("\r\n")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise UpstreamError(str(e) or type(e).__name__) from e
+
+    def stats(self):
+        return {host: _stat_entry(sent, opened) for host, (sent, opened) in self._counts.items()}
+
+
+def _backoff(attempt, retry_after=None):
+    """urllib3-style exponential backoff; a numeric Retry-After header wins."""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return config.HTTP_RETRY_BACKOFF * (2 ** attempt)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Background jobs for long /optimize-route plans: a plan is submitted, its job id
+comes back at once, and the caller polls or streams the job instead of holding
+a connection for the whole plan (see route_pipeline.submit_job).
+
+Jobs run on a bounded pool: at most JOB_WORKERS at a time, in two priority
+classes. "interactive" jobs are always started first; "batch" jobs may occupy at
+most JOB_BATCH_WORKERS of the workers, so an interactive job never waits behind
+a pool full of batch work. Each class has a bounded queue (JOB_QUEUE_INTERACTIVE
+/ JOB_QUEUE_BATCH). A submission that finds its class's queue full is refused
+(QueueFull) with a retry-after estimated from the queue depth and recent job
+durations: excess work is turned away at the door instead of every queued job
+waiting longer.
+
+The queue and the running jobs belong to the process that accepted them. Each
+job's record (status, timestamps and, once finished, its result) is also written
+to a store on every state change; with the "disk" store that is a SQLite file
+every worker process reads, so a poll that reaches another worker still finds
+the job. Progress events are only kept by the worker running the job. Writes to a
+store that blocks (SQLite) go through one writer thread, in order, so state changes
+on the jobs loop never wait on the file; reads of it (fetch) run in a worker thread.
+
+Jobs are asyncio tasks on one event loop: the caller's (run_on, the aiohttp
+service) or, by default, a loop in a background thread started with the first
+job (the Flask service).
+"""
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import service_config as config
+from llm_cache import DiskBackend, MemoryBackend
+
+PRIORITIES = ("interactive", "batch")
+FINISHED = ("succeeded", "failed", "cancelled")
+# Weight of the latest job in the running average of job durations
+DURATION_ALPHA = 0.2
+
+
+class QueueFull(Exception):
+    """The priority class's queue is full; try again in retry_after seconds."""
+
+    def __init__(self, priority, queued, retry_after):
+        super().__init__(f"{queued} {priority} jobs already queued")
+        self.priority = priority
+        self.queued = queued
+        self.retry_after = retry_after
+
+
+class Job:
+    """One submitted plan: its state, the progress lines it has produced and, once finished, its result."""
+
+    def __init__(self, priority, run):
+        self.id = uuid.uuid4().hex
+        self.priority = priority
+        self.run = run  # coroutine function of the job, returning (payload, status)
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.result_status = None
+        self.task = None
+        self._lines = []
+        self._lock = threading.Lock()
+        # Completed (and replaced) whenever a line is added or the job finishes; works across
+        # threads and event loops like single_flight's shared outcome
+        self._changed = Future()
+
+    def append(self, line):
+        """Add a progress line (NDJSON bytes)."""
+        with self._lock:
+            self._lines.append(line)
+            self._notify()
+
+    def read(self, offset):
+        """(lines from offset on, finished?, a Future completed at the next change)."""
+        with self._lock:
+            return self._lines[offset:], self.status in FINISHED, self._changed
+
+    def _finish(self, status, result, result_status):
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.result_status = result_status
+            self.finished_at = time.time()
+            self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, Future()
+        changed.set_result(None)
+
+    def to_dict(self):
+        record = {
+            "jobId": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "submittedAt": self.submitted_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+        if self.status in FINISHED:
+            record["resultStatus"] = self.result_status
+            record["result"] = self.result
+        return record
+
+
+class JobQueue:
+    def __init__(self, store, store_name, workers=4, batch_workers=2, max_queued=None, retention=900,
+                 initial_seconds=10.0):
+        self.store = store
+        self.store_name = store_name
+        self.workers = max(1, workers)
+        # Batch may not take every worker, or it could hold interactive jobs up
+        self.batch_workers = max(1, min(batch_workers, self.workers - 1)) if self.workers > 1 else 1
+        self.max_queued = max_queued or {"interactive": 16, "batch": 256}
+        self.retention = retention
+        self.avg_seconds = initial_seconds
+        self._loop = None
+        self._own_loop = False
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._queues = {p: deque() for p in PRIORITIES}
+        self._running = {p: 0 for p in PRIORITIES}
+        self._jobs = {}  # this process's jobs, by id, until their retention ends
+        # One thread keeps a job's state changes in order
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="jobs-store") if self.store.blocking else None
+        self.submitted = 0
+        self.rejected = {p: 0 for p in PRIORITIES}
+        self.finished = {s: 0 for s in FINISHED}
+
+    def _after_fork(self):
+        # Threads (and so our own loop) do not survive fork; the child starts empty
+        if self._own_loop:
+            self._loop = None
+            self._own_loop = False
+        self._reset()
+
+    def run_on(self, loop):
+        """Run jobs on `loop` (an aiohttp app's loop) instead of a background thread's."""
+        self._loop = loop
+        self._own_loop = False
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._own_loop = True
+                threading.Thread(target=self._loop.run_forever, name="jobs", daemon=True).start()
+            return self._loop
+
+    def submit(self, priority, run):
+        """
+        Queue a job of class `priority`; run(job) is awaited when a worker takes it and
+        returns (payload, status). Raises QueueFull when that class's queue is full.
+        """
+        loop = self._ensure_loop()
+        job = Job(priority, run)
+        with self._lock:
+            self._expire()
+            queued = len(self._queues[priority])
+            if queued >= self.max_queued[priority]:
+                self.rejected[priority] += 1
+                raise QueueFull(priority, queued, self._retry_after(priority, queued))
+            self._queues[priority].append(job)
+            self._jobs[job.id] = job
+            self.submitted += 1
+        self._publish(job)
+        loop.call_soon_threadsafe(self._dispatch)
+        return job
+
+    def _retry_after(self, priority, queued):
+        # Seconds for the jobs queued now to get started, at the recent pace
+        slots = self.batch_workers if priority == "batch" else self.workers
+        return max(1, math.ceil(queued * self.avg_seconds / slots))
+
+    def _expire(self):
+        cutoff = time.time() - self.retention
+        for job_id in [i for i, j in self._jobs.items() if j.finished_at is not None and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def _dispatch(self):
+        # On the jobs loop: start queued jobs while there are free workers, interactive first
+        while True:
+            with self._lock:
+                if sum(self._running.values()) >= self.workers:
+                    return
+                if self._queues["interactive"]:
+                    job = self._queues["interactive"].popleft()
+                elif self._queues["batch"] and self._running["batch"] < self.batch_workers:
+                    job = self._queues["batch"].popleft()
+                else:
+                    return
+                self._running[job.priority] += 1
+                job.status = "running"
+                job.started_at = time.time()
+            self._publish(job)
+            # A fresh context: the job must not inherit the submitting request's deadline or request id
+            job.task = self._loop.create_task(job.run(job), context=contextvars.Context())
+            job.task.add_done_callback(lambda task, job=job: self._done(job, task))
+
+    def _done(self, job, task):
+        if task.cancelled():
+            job._finish("cancelled", {"success": False, "error": "Job cancelled", "cancelled": True}, 409)
+        elif task.exception() is not None:
+            job._finish("failed", {"success": False, "error": str(task.exception())}, 500)
+        else:
+            payload, status = task.result()
+            job._finish("succeeded" if status == 200 else "failed", payload, status)
+        with self._lock:
+            self._running[job.priority] -= 1
+            self.finished[job.status] += 1
+            if job.status != "cancelled":
+                seconds = job.finished_at - job.started_at
+                self.avg_seconds += DURATION_ALPHA * (seconds - self.avg_seconds)
+        self._publish(job)
+        self._dispatch()
+
+    def _publish(self, job):
+        if self._writer is not None:
+            self._writer.submit(self.store.set, f"job|{job.id}", job.to_dict(), self.retention)
+        else:
+            self.store.set(f"job|{job.id}", job.to_dict(), self.retention)
+
+    def get(self, job_id):
+        """This process's Job for job_id, or None (unknown, expired, or accepted by another worker)."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def record(self, job_id):
+        """The job's record (see Job.to_dict), from this process or the store; None if unknown."""
+        job = self.get(job_id)
+        if job is None:
+            return self.store.get(f"job|{job_id}")
+        record = job.to_dict()
+        position = self.position(job)
+        if position is not None:
+            record["position"] = position
+        return record
+
+    async def fetch(self, job_id):
+        """record() from a coroutine: a store that blocks is read in a worker thread."""
+        if self.get(job_id) is None and self.store.blocking:
+            return await asyncio.to_thread(self.record, job_id)
+        return self.record(job_id)
+
+    def position(self, job):
+        """1-based place of a queued job among the jobs that will start before it (None once started)."""
+        with self._lock:
+            queue = self._queues[job.priority]
+            if job not in queue:
+                return None
+            ahead = queue.index(job) + 1
+            if job.priority == "batch":
+                ahead += len(self._queues["interactive"])
+            return ahead
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job of this process; False if there is no such job or it has finished."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            queued = job in self._queues[job.priority]
+            if queued:
+                self._queues[job.priority].remove(job)
+                self.finished["cancelled"] += 1
+        if queued:
+            job._finish("cancelled", {"success": False, "error": "Job cancelled", "cancelled": True}, 409)
+            self._publish(job)
+        else:
+            self._loop.call_soon_threadsafe(job.task.cancel)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "store": self.store_name,
+                "workers": self.workers,
+                "batchWorkers": self.batch_workers,
+                "queued": {p: len(q) for p, q in self._queues.items()},
+                "maxQueued": dict(self.max_queued),
+                "running": dict(self._running),
+                "submitted": self.submitted,
+                "rejected": dict(self.rejected),
+                "finished": dict(self.finished),
+                "avgJobMs": round(self.avg_seconds * 1000),
+            }
+
+
+def from_env():
+    """Build the job queue from the JOB_* settings."""
+    if config.JOB_STORE == "disk":
+        store = DiskBackend(config.JOB_STORE_PATH, config.JOB_RETENTION, max_entries=config.JOB_MAX_RETAINED,
+                            table="jobs")
+    else:
+        store = MemoryBackend(config.JOB_RETENTION, max_entries=config.JOB_MAX_RETAINED)
+    # Until jobs have run, expect them to take about half the default request budget
+    initial = config.REQUEST_BUDGET_MS / 2000 if config.REQUEST_BUDGET_MS > 0 else 10.0
+    return JobQueue(
+        store,
+        "disk" if config.JOB_STORE == "disk" else "memory",
+        workers=config.JOB_WORKERS,
+        batch_workers=config.JOB_BATCH_WORKERS,
+        max_queued={"interactive": config.JOB_QUEUE_INTERACTIVE, "batch": config.JOB_QUEUE_BATCH},
+        retention=config.JOB_RETENTION,
+        initial_seconds=initial,
+    )
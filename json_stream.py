@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Incremental scanner for JSON arriving in pieces (streamed LLM completions).
+
+It reports every string value inside a JSON array - and every "address" field of
+an object - the moment its closing quote arrives, together with the keys of the
+enclosing objects:
+
+    scanner = JsonStreamScanner()
+    scanner.feed('```json\n{"0": ["Target, 1 Main')   # -> []
+    scanner.feed(' St", "Costco')                     # -> [(("0",), "Target, 1 Main St")]
+
+Anything before the first '[' or '{' (code fences, chatter) and after the root
+value closes is ignored. Numbers, booleans and other keys are skipped.
+"""
+import json
+
+
+class JsonStreamScanner:
+    def __init__(self):
+        # Open containers: ["[", None, None] or ["{", current key, expecting a key]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._buf = []
+        self.done = False
+
+    def feed(self, text):
+        """Consume the next chunk; returns [(path, value), ...] for the values it completed."""
+        out = []
+        i, n = 0, len(text)
+        while i < n and not self.done:
+            if self._in_string:
+                j = i
+                while j < n:
+                    c = text[j]
+                    if self._escape:
+                        self._escape = False
+                    elif c == "\\":
+                        self._escape = True
+                    elif c == '"':
+                        break
+                    j += 1
+                self._buf.append(text[i:j])
+                if j == n:
+                    break
+                self._in_string = False
+                raw = "".join(self._buf)
+                self._buf = []
+                try:
+                    value = json.loads(f'"{raw}"')
+                except ValueError:
+                    value = None
+                self._string(value, out)
+                i = j + 1
+                continue
+
+            c = text[i]
+            if c in "[{":
+                self._stack.append([c, None, c == "{"])
+            elif not self._stack:
+                pass  # before the root value
+            elif c == '"':
+                self._in_string = True
+            elif c in "]}":
+                self._stack.pop()
+                if not self._stack:
+                    self.done = True
+            elif c == ":" and self._stack[-1][0] == "{":
+                self._stack[-1][2] = False
+            elif c == "," and self._stack[-1][0] == "{":
+                self._stack[-1][2] = True
+            i += 1
+        return out
+
+    def _string(self, value, out):
+        top = self._stack[-1]
+        if top[0] == "{":
+            if top[2]:
+                top[1] = value
+            elif top[1] == "address" and value is not None:
+                out.append((self._path(self._stack[:-1]), value))
+        elif value is not None:
+            out.append((self._path(self._stack), value))
+
+    @staticmethod
+    def _path(frames):
+        return tuple(f[1] for f in frames if f[0] == "{")
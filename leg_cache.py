@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Pairwise travel-leg cache: (origin, destination, profile, traffic window) ->
+(duration, distance), with coordinates rounded to LEG_CACHE_PRECISION decimals
+(4 decimals is about 11 m).
+
+upstream fills it from every routing response it sees: optimized-trips legs,
+directions legs and matrix cells. A combination whose legs are all known can
+then be costed without an API call. Legs expire with the traffic window they
+were measured in (see plan_cache.traffic_window), since they are driving-traffic
+durations.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import service_config as config
+from plan_cache import traffic_window
+
+
+class LegCache:
+    """In-process LRU of legs, bounded by entry count."""
+
+    def __init__(self, precision=4, max_entries=200000):
+        self.precision = precision
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (duration, distance, expires_at)
+        self._lock = threading.Lock()
+
+    def _key(self, a, b, profile, window):
+        p = self.precision
+        return profile, window, round(a[0], p), round(a[1], p), round(b[0], p), round(b[1], p)
+
+    def matrix(self, coords, profile="driving-traffic", now=None):
+        """
+        {"durations": [[...]], "distances": [[...]]} for coords [(lon, lat), ...] if every
+        leg between them is known for the current window, else None.
+        """
+        now = time.time() if now is None else now
+        window, _ = traffic_window(now)
+        n = len(coords)
+        durations = [[0.0] * n for _ in range(n)]
+        distances = [[0.0] * n for _ in range(n)]
+        with self._lock:
+            for i in range(n):
+                for j in range(n):
+                    if i == j:
+                        continue
+                    key = self._key(coords[i], coords[j], profile, window)
+                    entry = self._data.get(key)
+                    if entry is not None and entry[2] <= now:
+                        # Window ids recur every day: this one was measured on an earlier day
+                        del self._data[key]
+                        entry = None
+                    if entry is None:
+                        self.misses += 1
+                        return None
+                    self._data.move_to_end(key)
+                    durations[i][j], distances[i][j] = entry[0], entry[1]
+            self.hits += 1
+        return {"durations": durations, "distances": distances}
+
+    def put(self, pairs, profile="driving-traffic", now=None):
+        """Store [(origin, destination, duration, distance), ...]; unroutable (None) legs are skipped."""
+        window, expires_at = traffic_window(now)
+        with self._lock:
+            for a, b, duration, distance in pairs:
+                if duration is None or distance is None or a == b:
+                    continue
+                key = self._key(a, b, profile, window)
+                self._data[key] = (duration, distance, expires_at)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def put_matrix(self, coords, durations, distances, profile="driving-traffic"):
+        if not distances:
+            return
+        self.put([
+            (coords[i], coords[j], durations[i][j], distances[i][j])
+            for i in range(len(coords)) for j in range(len(coords))
+        ], profile)
+
+    def put_legs(self, path, legs, profile="driving-traffic"):
+        """Legs of a route through path [(lon, lat), ...]: legs[k] runs from path[k] to path[k + 1]."""
+        self.put([
+            (path[k], path[k + 1], leg.get("duration"), leg.get("distance"))
+            for k, leg in enumerate(legs[:len(path) - 1])
+        ], profile)
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            size = len(self._data)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / total, 3) if total else None,
+            "entries": size,
+            "maxEntries": self.max_entries,
+        }
+
+
+def from_env():
+    """The leg cache configured by LEG_CACHE_*, or None when LEG_CACHE is off."""
+    if not config.LEG_CACHE:
+        return None
+    return LegCache(precision=config.LEG_CACHE_PRECISION, max_entries=config.LEG_CACHE_MAX_ENTRIES)
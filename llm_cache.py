@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Response cache in front of sudo_chat.
+
+Entries are keyed on the model plus the normalized message list, so the same
+"top 3 addresses of Walmart groceries near San Ramon" prompt is answered from
+cache regardless of incidental whitespace. Two backends are available: an
+in-process LRU bounded by entry count and bytes, and the SQLite store from
+geo_cache for sharing across workers and restarts.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from geo_cache import GeoCache
+
+
+def cache_key(model, messages):
+    """Stable hash of the model and messages with roles lowercased and content whitespace-collapsed."""
+    normalized = [
+        {
+            "role": (m.get("role") or "").strip().lower(),
+            "content": " ".join(str(m.get("content") or "").split()),
+        }
+        for m in messages
+    ]
+    blob = json.dumps({"model": model, "messages": normalized}, sort_keys=True, separators=(",", ":"))
+    return "llm|" + hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """Thread-safe in-process LRU with TTL, bounded by entry count and approximate payload bytes."""
+
+    blocking = False
+
+    def __init__(self, ttl_seconds, max_entries=1000, max_bytes=32 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expires_at, size, payload json)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._drop(key)
+                return None
+            self._data.move_to_end(key)
+            return json.loads(entry[2])
+
+    def set(self, key, value, ttl_seconds=None):
+        payload = json.dumps(value)
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.time() + ttl, size, payload)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._data)))
+
+    def _drop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes, "maxEntries": self.max_entries}
+
+
+class DiskBackend:
+    """SQLite-backed store (shared across worker processes) reusing GeoCache's TTL/LRU table."""
+
+    blocking = True
+
+    def __init__(self, path, ttl_seconds, max_entries=10000, table="llm_cache"):
+        self._store = GeoCache(path, ttl_seconds=ttl_seconds, max_entries=max_entries, table=table)
+
+    def get(self, key):
+        return self._store.get(key)
+
+    def set(self, key, value, ttl_seconds=None):
+        self._store.set(key, value, ttl_seconds)
+
+    def stats(self):
+        s = self._store.stats()
+        return {"entries": s["entries"], "maxEntries": s["maxEntries"]}
+
+
+class LLMCache:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def blocking(self):
+        return self.backend.blocking
+
+    def get(self, model, messages):
+        value = self.backend.get(cache_key(model, messages))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, model, messages, response):
+        # Error responses ({"error": ...}) are never cached
+        if not isinstance(response, dict) or "error" in response:
+            return
+        self.backend.set(cache_key(model, messages), response)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / total, 3) if total else None,
+            **self.backend.stats(),
+        }
+
+
+def from_env():
+    """Build the cache from LLM_CACHE_* env vars; LLM_CACHE_BACKEND=off disables it."""
+    backend = os.getenv("LLM_CACHE_BACKEND", "memory").lower()
+    ttl = int(os.getenv("LLM_CACHE_TTL", str(6 * 3600)))
+    if backend == "memory":
+        return LLMCache(MemoryBackend(
+            ttl,
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000")),
+            max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+        ), "memory")
+    if backend == "disk":
+        return LLMCache(DiskBackend(
+            os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"),
+            ttl,
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+        ), "disk")
+    return None
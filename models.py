@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Typed model of what /optimize-route takes and returns: Preference, Task,
+Location, Step, Leg and Route.
+
+Objects are built once at the boundary, where outside data enters:
+Task.from_dict for request bodies (and LLM-parsed intents), Route.from_mapbox
+for optimized-trips / directions routes, Route.from_dict for stored plans.
+from_dict validates and raises ModelError naming the offending field, so the
+pipeline past that point reads plain attributes instead of .get() chains.
+Mapbox fields nothing renders (intersections, voice and banner instructions,
+...) are dropped there, so routes keep only what the response carries.
+
+The classes use __slots__ and turn into wire-format dicts (camelCase keys,
+unset optional fields left out) with to_dict(); Route.to_dict(level) renders
+one of route_geometry's fidelity levels. dumps() encodes payloads that may
+contain model objects, with orjson when it is installed and the stdlib json
+module otherwise.
+"""
+import json
+
+import numpy as np
+
+import route_geometry
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib encoder is used instead
+    orjson = None
+
+
+class ModelError(ValueError):
+    """Input that does not fit the model; the message names the field."""
+
+
+def _number(value, where, optional=False):
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ModelError(f"{where}: expected a number")
+    return value
+
+
+def _text(value, where, optional=True):
+    if value is None and optional:
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if not isinstance(value, str):
+        raise ModelError(f"{where}: expected a string")
+    return value
+
+
+def _object(value, where):
+    if not isinstance(value, dict):
+        raise ModelError(f"{where}: expected an object")
+    return value
+
+
+def _list(value, where):
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        raise ModelError(f"{where}: expected a list")
+    return value
+
+
+def _coords(value, where):
+    """[[lon, lat], ...] as a list of 2-item float lists (checked as one array: lines run to thousands of points)."""
+    value = _list(value, where)
+    if not value:
+        return []
+    try:
+        arr = np.asarray(value, dtype=float)
+    except (TypeError, ValueError):
+        arr = None
+    if arr is None or arr.ndim != 2 or arr.shape[1] < 2:
+        raise ModelError(f"{where}: expected [[longitude, latitude], ...]")
+    return arr[:, :2].tolist()
+
+
+def _line(geometry, where):
+    """Coordinates of a GeoJSON LineString (None or missing: no line)."""
+    if geometry is None:
+        return []
+    return _coords(_object(geometry, where).get("coordinates"), f"{where}.coordinates")
+
+
+class Preference:
+    __slots__ = ("type", "value", "is_mandatory", "id", "description")
+
+    def __init__(self, type, value, is_mandatory=False, id=None, description=None):
+        self.type = type
+        self.value = value
+        self.is_mandatory = is_mandatory
+        self.id = id
+        self.description = description
+
+    @classmethod
+    def from_dict(cls, d, where="preference"):
+        d = _object(d, where)
+        return cls(
+            type=_text(d.get("type"), f"{where}.type") or "",
+            value=_text(d.get("value"), f"{where}.value") or "",
+            is_mandatory=bool(d.get("isMandatory")),
+            id=_text(d.get("id"), f"{where}.id"),
+            description=_text(d.get("description"), f"{where}.description"),
+        )
+
+    def to_dict(self):
+        out = {"type": self.type, "value": self.value, "isMandatory": self.is_mandatory}
+        if self.id is not None:
+            out["id"] = self.id
+        if self.description is not None:
+            out["description"] = self.description
+        return out
+
+
+class Task:
+    __slots__ = ("type", "description", "preferences", "id", "is_mandatory")
+
+    def __init__(self, type, description=None, preferences=(), id=None, is_mandatory=None):
+        self.type = type
+        self.description = description
+        self.preferences = list(preferences)
+        self.id = id
+        self.is_mandatory = is_mandatory
+
+    @classmethod
+    def from_dict(cls, d, where="task"):
+        d = _object(d, where)
+        prefs = _list(d.get("preferences"), f"{where}.preferences")
+        mandatory = d.get("isMandatory")
+        return cls(
+            type=_text(d.get("type"), f"{where}.type") or "",
+            description=_text(d.get("description"), f"{where}.description"),
+            preferences=[Preference.from_dict(p, f"{where}.preferences[{i}]") for i, p in enumerate(prefs)],
+            id=_text(d.get("id"), f"{where}.id"),
+            is_mandatory=None if mandatory is None else bool(mandatory),
+        )
+
+    @classmethod
+    def list_from(cls, items, where="tasks"):
+        return [cls.from_dict(t, f"{where}[{i}]") for i, t in enumerate(_list(items, where))]
+
+    def to_dict(self):
+        out = {"type": self.type, "description": self.description, "preferences": [p.to_dict() for p in self.preferences]}
+        if self.id is not None:
+            out["id"] = self.id
+        if self.is_mandatory is not None:
+            out["isMandatory"] = self.is_mandatory
+        return out
+
+
+class Location:
+    __slots__ = ("latitude", "longitude", "name", "address", "type")
+
+    def __init__(self, latitude, longitude, name="", address="", type=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.name = name
+        self.address = address
+        self.type = type
+
+    @classmethod
+    def from_dict(cls, d, where="location"):
+        d = _object(d, where)
+        lat = _number(d.get("latitude"), f"{where}.latitude")
+        lon = _number(d.get("longitude"), f"{where}.longitude")
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ModelError(f"{where}: coordinates out of range")
+        return cls(lat, lon, _text(d.get("name"), f"{where}.name") or "",
+                   _text(d.get("address"), f"{where}.address") or "", _text(d.get("type"), f"{where}.type"))
+
+    def to_dict(self):
+        out = {"latitude": self.latitude, "longitude": self.longitude, "address": self.address, "name": self.name}
+        if self.type is not None:
+            out["type"] = self.type
+        return out
+
+
+class Step:
+    __slots__ = ("distance", "duration", "name", "instruction", "maneuver_type", "modifier", "location", "geometry")
+
+    def __init__(self, distance, duration, name=None, instruction=None, maneuver_type=None, modifier=None,
+                 location=None, geometry=()):
+        self.distance = distance
+        self.duration = duration
+        self.name = name
+        self.instruction = instruction
+        self.maneuver_type = maneuver_type
+        self.modifier = modifier
+        self.location = location
+        self.geometry = geometry
+
+    @classmethod
+    def from_dict(cls, d, where="step"):
+        # Mapbox's step objects and to_dict()'s output have the same shape
+        d = _object(d, where)
+        maneuver = _object(d.get("maneuver") or {}, f"{where}.maneuver")
+        location = maneuver.get("location")
+        return cls(
+            distance=_number(d.get("distance"), f"{where}.distance", optional=True),
+            duration=_number(d.get("duration"), f"{where}.duration", optional=True),
+            name=_text(d.get("name"), f"{where}.name") or None,
+            instruction=_text(maneuver.get("instruction"), f"{where}.maneuver.instruction"),
+            maneuver_type=_text(maneuver.get("type"), f"{where}.maneuver.type"),
+            modifier=_text(maneuver.get("modifier"), f"{where}.maneuver.modifier"),
+            location=_coords([location], f"{where}.maneuver.location")[0] if location is not None else None,
+            geometry=_line(d.get("geometry"), f"{where}.geometry"),
+        )
+
+    def to_dict(self, full=True):
+        """Full: with the maneuver location and step geometry; otherwise only what the UI renders."""
+        maneuver = {"instruction": self.instruction, "type": self.maneuver_type}
+        if self.modifier:
+            maneuver["modifier"] = self.modifier
+        out = {"distance": self.distance, "duration": self.duration, "maneuver": maneuver}
+        if self.name:
+            out["name"] = self.name
+        if full:
+            if self.location is not None:
+                maneuver["location"] = self.location
+            if self.geometry:
+                out["geometry"] = {"type": "LineString", "coordinates": self.geometry}
+        return out
+
+
+class Leg:
+    __slots__ = ("distance", "duration", "summary", "steps")
+
+    def __init__(self, distance, duration, summary=None, steps=()):
+        self.distance = distance
+        self.duration = duration
+        self.summary = summary
+        self.steps = list(steps)
+
+    @classmethod
+    def from_dict(cls, d, where="leg"):
+        d = _object(d, where)
+        steps = _list(d.get("steps"), f"{where}.steps")
+        return cls(
+            distance=_number(d.get("distance"), f"{where}.distance", optional=True),
+            duration=_number(d.get("duration"), f"{where}.duration", optional=True),
+            summary=_text(d.get("summary"), f"{where}.summary") or None,
+            steps=[Step.from_dict(s, f"{where}.steps[{i}]") for i, s in enumerate(steps)],
+        )
+
+    def to_dict(self, level="full"):
+        """The leg at a route_geometry fidelity level: "low" keeps the totals only."""
+        out = {"distance": self.distance, "duration": self.duration}
+        if level == "low":
+            return out
+        if level == "full" and self.summary:
+            out["summary"] = self.summary
+        out["steps"] = [s.to_dict(level == "full") for s in self.steps]
+        return out
+
+
+class Route:
+    __slots__ = ("stops", "total_distance", "total_duration", "legs", "geometry", "preference_score",
+                 "visit_order", "id", "matrix_duration", "estimated")
+
+    def __init__(self, stops, total_distance, total_duration, legs, geometry, preference_score, visit_order,
+                 id=None, matrix_duration=None, estimated=False):
+        self.stops = stops
+        self.total_distance = total_distance
+        self.total_duration = total_duration
+        self.legs = legs
+        self.geometry = geometry  # [[lon, lat], ...]
+        self.preference_score = preference_score
+        self.visit_order = visit_order
+        self.id = id
+        self.matrix_duration = matrix_duration
+        self.estimated = estimated
+
+    @classmethod
+    def from_mapbox(cls, route, stops, visit_order, preference_score):
+        """
+        A route from an optimized-trips trip or a directions route (GeoJSON geometry),
+        visiting stops (candidate location dicts) in visit_order.
+        """
+        route = _object(route, "route")
+        return cls(
+            stops=[Location.from_dict(s, f"stops[{i}]") for i, s in enumerate(stops)],
+            total_distance=_number(route.get("distance"), "route.distance", optional=True),
+            total_duration=_number(route.get("duration"), "route.duration", optional=True),
+            legs=[Leg.from_dict(leg, f"route.legs[{i}]") for i, leg in enumerate(_list(route.get("legs"), "route.legs"))],
+            geometry=_line(route.get("geometry"), "route.geometry"),
+            preference_score=preference_score,
+            visit_order=list(visit_order),
+        )
+
+    @classmethod
+    def from_dict(cls, d, where="route"):
+        """A route from its full-fidelity to_dict() form (e.g. a stored plan)."""
+        d = _object(d, where)
+        return cls(
+            stops=[Location.from_dict(s, f"{where}.stops[{i}]") for i, s in enumerate(_list(d.get("stops"), f"{where}.stops"))],
+            total_distance=_number(d.get("totalDistance"), f"{where}.totalDistance", optional=True),
+            total_duration=_number(d.get("totalDuration"), f"{where}.totalDuration", optional=True),
+            legs=[Leg.from_dict(leg, f"{where}.legs[{i}]") for i, leg in enumerate(_list(d.get("legs"), f"{where}.legs"))],
+            geometry=_line(d.get("geometry"), f"{where}.geometry"),
+            preference_score=_number(d.get("preferenceScore"), f"{where}.preferenceScore"),
+            visit_order=[_number(v, f"{where}.visitOrder") for v in _list(d.get("visitOrder"), f"{where}.visitOrder")],
+            id=_text(d.get("id"), f"{where}.id"),
+            matrix_duration=_number(d.get("matrixDuration"), f"{where}.matrixDuration", optional=True),
+            estimated=bool(d.get("estimated")),
+        )
+
+    def to_dict(self, level="full"):
+        """The route at a route_geometry fidelity level: GeoJSON for "full", else simplified polyline6."""
+        out = {
+            "stops": [s.to_dict() for s in self.stops],
+            "totalDistance": self.total_distance,
+            "totalDuration": self.total_duration,
+            "legs": [leg.to_dict(level) for leg in self.legs],
+            "geometry": route_geometry.render(self.geometry, level),
+            "preferenceScore": self.preference_score,
+            "visitOrder": self.visit_order,
+        }
+        if self.id is not None:
+            out["id"] = self.id
+        if self.matrix_duration is not None:
+            out["matrixDuration"] = self.matrix_duration
+        if self.estimated:
+            out["estimated"] = True
+        return out
+
+
+def _plain(obj):
+    # Model objects met while encoding become their (full-fidelity) wire form
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    """value as compact JSON bytes; model objects are encoded with to_dict()."""
+    if orjson is not None:
+        return orjson.dumps(value, default=_plain, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, default=_plain, separators=(",", ":")).encode()
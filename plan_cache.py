@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Cache of complete /optimize-route results.
+
+A stored plan answers later requests that have
+- the same tasks: type and preferences, canonicalized; descriptions are ignored;
+- a start in the same grid cell (PLAN_CACHE_BUCKET_DEG degrees);
+- the same evaluation mode and optimizeFor;
+- the same traffic window.
+
+The routes come from driving-traffic durations, so an entry only lives until the
+end of the time-of-day window it was computed in. Windows are hour ranges in
+PLAN_CACHE_TIMEZONE (PLAN_CACHE_WINDOWS), kept apart for weekdays and weekends,
+and no entry lives longer than PLAN_CACHE_TTL. Entries are stored with
+llm_cache's memory or disk backend.
+"""
+import hashlib
+import json
+import math
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import service_config as config
+from geo_cache import canonical_query
+from llm_cache import DiskBackend, MemoryBackend
+
+
+def canonical_tasks(tasks):
+    """Task types and preferences (models.Task), normalized for keying (task order is kept, preference order is not)."""
+    out = []
+    for task in tasks:
+        prefs = sorted((canonical_query(p.type), canonical_query(p.value), p.is_mandatory) for p in task.preferences)
+        out.append({"type": canonical_query(task.type), "preferences": prefs})
+    return out
+
+
+def geo_bucket(lat, lon, size_deg):
+    """Grid cell of a point: (row, column) of size_deg-degree squares."""
+    return math.floor(lat / size_deg), math.floor(lon / size_deg)
+
+
+def traffic_window(now=None, tz=None, boundaries=None):
+    """
+    The traffic window containing now (epoch seconds): (window id, epoch seconds at which it
+    ends). Ids look like "weekday-15" (weekday from 15:00) or "weekend-0".
+    """
+    tz = ZoneInfo(tz or config.PLAN_CACHE_TIMEZONE)
+    if boundaries is None:
+        boundaries = sorted({int(h) for h in config.PLAN_CACHE_WINDOWS.split(",") if h.strip()} | {0})
+    local = datetime.fromtimestamp(time.time() if now is None else now, tz)
+    start = max(h for h in boundaries if h <= local.hour)
+    later = [h for h in boundaries if h > local.hour]
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    # Wall-clock arithmetic: the last window of the day ends at the next local midnight
+    end = midnight.replace(hour=later[0]) if later else midnight + timedelta(days=1)
+    day = "weekend" if local.weekday() >= 5 else "weekday"
+    return f"{day}-{start}", end.timestamp()
+
+
+class PlanCache:
+    def __init__(self, backend, name, bucket_deg=0.01, max_ttl=3600):
+        self.backend = backend
+        self.name = name
+        self.bucket_deg = bucket_deg
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @property
+    def blocking(self):
+        return self.backend.blocking
+
+    def key(self, tasks, start, evaluation_mode, optimize_for, now=None):
+        """(cache key, traffic window id, epoch seconds when an entry stored now must expire)."""
+        window, window_end = traffic_window(now)
+        blob = json.dumps({
+            "tasks": canonical_tasks(tasks),
+            "start": geo_bucket(start["latitude"], start["longitude"], self.bucket_deg),
+            "evaluationMode": evaluation_mode,
+            "optimizeFor": optimize_for,
+            "window": window,
+        }, sort_keys=True, separators=(",", ":"))
+        now = time.time() if now is None else now
+        return "plan|" + hashlib.sha256(blob.encode("utf-8")).hexdigest(), window, min(window_end, now + self.max_ttl)
+
+    def get(self, key):
+        """The stored {"payload", "storedAt", "expiresAt"} entry, or None."""
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, payload, expires_at, refresh=False):
+        if refresh:
+            self.refreshes += 1
+        now = time.time()
+        if expires_at <= now:
+            return
+        self.backend.set(key, {"payload": payload, "storedAt": now, "expiresAt": expires_at}, expires_at - now)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hitRate": round(self.hits / total, 3) if total else None,
+            **self.backend.stats(),
+        }
+
+
+def from_env():
+    """Build the cache from the PLAN_CACHE_* settings; PLAN_CACHE_BACKEND=off disables it."""
+    if config.PLAN_CACHE_BACKEND == "memory":
+        backend = MemoryBackend(config.PLAN_CACHE_TTL, max_entries=config.PLAN_CACHE_MAX_ENTRIES,
+                                max_bytes=config.PLAN_CACHE_MAX_BYTES)
+    elif config.PLAN_CACHE_BACKEND == "disk":
+        backend = DiskBackend(config.PLAN_CACHE_PATH, config.PLAN_CACHE_TTL,
+                              max_entries=config.PLAN_CACHE_MAX_ENTRIES, table="plan_cache")
+    else:
+        return None
+    return PlanCache(backend, config.PLAN_CACHE_BACKEND, bucket_deg=config.PLAN_CACHE_BUCKET_DEG,
+                     max_ttl=config.PLAN_CACHE_TTL)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Upstream rate limiting shared by every thread and worker process.
+
+Mapbox and the LLM endpoint meter the account, not the worker, and one
+/optimize-route fans out into many geocodes, routing calls and LLM calls. Every
+upstream call therefore goes through RateLimiter.call(endpoint), which
+
+- takes a token from the endpoint's bucket (RATE_LIMITS, requests per minute,
+  bursts of up to RATE_LIMIT_BURST_SECONDS of that rate). With the "disk"
+  backend the buckets live in a SQLite file, so every worker on the host draws
+  from the same quota;
+- holds one of the endpoint's concurrency slots while the call runs. The number
+  of slots adapts in each process: it is halved when the endpoint answers 429 or
+  5xx or the call fails, and grows by about one per round of successful calls,
+  between RATE_LIMIT_MIN_CONCURRENCY and RATE_LIMIT_MAX_CONCURRENCY;
+- after a 429, pauses the endpoint for every worker until its Retry-After has
+  passed (RATE_LIMIT_PAUSE_SECONDS without one), instead of each caller retrying
+  on its own.
+
+Calls waiting for an endpoint go earliest request deadline first. With equal
+budgets that is the oldest request, the one closest to finishing, so requests
+already under way complete instead of all of them slowing down together. A call
+whose wait would outlast its request's deadline fails right away with
+deadline.DeadlineExceeded.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from contextlib import asynccontextmanager
+
+import service_config as config
+import deadline
+import http_clients
+
+# Minimum seconds between two concurrency cuts of an endpoint, so one burst of failures halves it once
+DECREASE_COOLDOWN = 1.0
+
+_order = itertools.count()
+
+
+def parse_limits(spec):
+    """{"geocode": 600.0, ...} (requests per minute) from "geocode:600,trips:300,..."."""
+    limits = {}
+    for item in spec.split(","):
+        name, _, per_minute = item.partition(":")
+        if name.strip():
+            limits[name.strip()] = float(per_minute)
+    return limits
+
+
+class Buckets:
+    """Token buckets keyed by name; subclasses store each bucket's (tokens, updated, paused_until)."""
+
+    # Whether an update may block (on file locks), so it must not run on an event loop
+    blocking = False
+
+    def take(self, name, cost, rate, burst):
+        """Take `cost` tokens: 0 when granted, otherwise the seconds to wait before asking again."""
+        def change(tokens, updated, paused_until, now):
+            # Nothing accrues while paused
+            tokens = min(burst, tokens + max(0.0, now - max(updated, paused_until)) * rate)
+            if paused_until > now:
+                return paused_until - now, tokens, paused_until
+            if tokens >= cost:
+                return 0.0, tokens - cost, paused_until
+            return (cost - tokens) / rate, tokens, paused_until
+
+        return self._update(name, burst, change)
+
+    def refund(self, name, cost, burst):
+        """Give back `cost` tokens taken for a call that was not made after all."""
+        def change(tokens, updated, paused_until, now):
+            return 0.0, min(burst, tokens + cost), paused_until
+
+        self._update(name, burst, change)
+
+    def pause(self, name, until, burst):
+        """Grant nothing before `until` (epoch seconds), and start refilling from empty after it."""
+        def change(tokens, updated, paused_until, now):
+            return 0.0, 0.0, max(paused_until, until)
+
+        self._update(name, burst, change)
+
+
+class MemoryBuckets(Buckets):
+    """Buckets of this process only."""
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def _update(self, name, burst, change):
+        now = time.time()
+        with self._lock:
+            tokens, updated, paused_until = self._state.get(name, (burst, now, 0.0))
+            result, tokens, paused_until = change(tokens, updated, paused_until, now)
+            self._state[name] = (tokens, now, paused_until)
+        return result
+
+
+class SharedBuckets(Buckets):
+    """Buckets in a SQLite file, shared by every process that opens it."""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connect()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            " name TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL,"
+            " paused_until REAL NOT NULL)"
+        )
+        # A SQLite connection must not be used across fork: a forked child opens its own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        # Autocommit, with an explicit BEGIN IMMEDIATE per update: processes read and
+        # change a bucket one at a time
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _update(self, name, burst, change):
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                row = self._conn.execute(
+                    "SELECT tokens, updated, paused_until FROM rate_buckets WHERE name = ?", (name,)
+                ).fetchone()
+                tokens, updated, paused_until = row or (burst, now, 0.0)
+                result, tokens, paused_until = change(tokens, updated, paused_until, now)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated, paused_until) VALUES (?, ?, ?, ?)",
+                    (name, tokens, now, paused_until),
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                # Fail open: an unreadable bucket file must not stop every upstream call
+                return 0.0
+        return result
+
+
+class Permit:
+    """An admitted call; record(response) reports how the endpoint answered."""
+
+    def __init__(self):
+        self.status = None
+        self.retry_after = None
+
+    def record(self, response):
+        self.status = response.status_code
+        self.retry_after = (response.headers or {}).get("Retry-After")
+
+
+class Endpoint:
+    """One upstream endpoint's bucket, adaptive concurrency and waiting calls, in this process."""
+
+    def __init__(self, name, buckets, per_minute, burst_seconds=5.0, max_concurrency=16, min_concurrency=1,
+                 pause_seconds=1.0):
+        self.name = name
+        self.buckets = buckets
+        self.rate = per_minute / 60
+        self.burst = max(1.0, self.rate * burst_seconds)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.pause_seconds = pause_seconds
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self._waiting = []  # heap of (deadline, arrival) of the calls waiting here
+        self._wakers = []
+        self._taking = None  # the waiting entry whose bucket update is under way
+        self._last_cut = 0.0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+        self.failed = 0
+        self.expired = 0
+
+    async def acquire(self, cost=1):
+        """Wait until this call is first in line, a concurrency slot is free and the bucket grants `cost` tokens."""
+        left = deadline.remaining()
+        entry = (time.monotonic() + left if left is not None else math.inf, next(_order))
+        cost = min(cost, self.burst)
+        t0 = time.monotonic()
+        with self._lock:
+            heapq.heappush(self._waiting, entry)
+        try:
+            while True:
+                wait = None  # until something changes here
+                with self._lock:
+                    taking = self._taking is None and self._ready(entry)
+                    if taking:
+                        self._taking = entry
+                    else:
+                        waker = Future()
+                        self._wakers.append(waker)
+                if taking:
+                    # Outside the lock (and, for shared buckets, off the event loop): the update
+                    # may wait for other processes. Meanwhile nobody else here takes tokens
+                    wait = await self._bucket(self.buckets.take, self.name, cost, self.rate, self.burst)
+                    granted = wait <= 0
+                    with self._lock:
+                        self._taking = None
+                        admitted = granted and self._ready(entry)
+                        if admitted:
+                            heapq.heappop(self._waiting)
+                            self.in_flight += 1
+                            self._admitted(time.monotonic() - t0)
+                        # Whoever is next in line takes over
+                        self._notify()
+                        if admitted:
+                            return
+                        if granted:
+                            # An earlier deadline arrived or the concurrency was cut meanwhile
+                            wait = None
+                        waker = Future()
+                        self._wakers.append(waker)
+                    if granted:
+                        await self._bucket(self.buckets.refund, self.name, cost, self.burst)
+                await self._sleep(waker, wait)
+        except BaseException as e:
+            with self._lock:
+                if self._taking == entry:
+                    self._taking = None
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                if isinstance(e, deadline.DeadlineExceeded):
+                    self.expired += 1
+                self._notify()
+            raise
+
+    def _ready(self, entry):
+        return self._waiting[0] == entry and self.in_flight < max(self.min_concurrency, int(self.limit))
+
+    async def _bucket(self, update, *args):
+        if self.buckets.blocking:
+            return await asyncio.to_thread(update, *args)
+        return update(*args)
+
+    async def _sleep(self, waker, wait):
+        left = deadline.remaining()
+        if left is not None and (left <= 0 or (wait is not None and wait > left)):
+            # The token would come after the request has given up on this call
+            raise deadline.DeadlineExceeded()
+        timeouts = [t for t in (wait, left) if t is not None]
+        woken = asyncio.wrap_future(waker)
+        done, _ = await asyncio.wait({woken}, timeout=min(timeouts) if timeouts else None)
+        if not done:
+            woken.cancel()
+
+    def _admitted(self, seconds):
+        self.calls += 1
+        if seconds > 0.001:
+            self.waited += 1
+            self.wait_seconds += seconds
+
+    def _notify(self):
+        wakers, self._wakers = self._wakers, []
+        for waker in wakers:
+            try:
+                waker.set_result(None)
+            except InvalidStateError:
+                pass  # its waiter already stopped waiting
+
+    async def release(self, permit, failed=False):
+        """Free the call's slot and adapt the concurrency to how the endpoint answered."""
+        now = time.monotonic()
+        status = permit.status
+        with self._lock:
+            self.in_flight -= 1
+            if failed or status == 429 or (status is not None and status >= 500):
+                if status == 429:
+                    self.throttled += 1
+                else:
+                    self.failed += 1
+                if now - self._last_cut >= DECREASE_COOLDOWN:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_cut = now
+            elif status is not None:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._notify()
+        if status == 429:
+            until = time.time() + _seconds(permit.retry_after, self.pause_seconds)
+            await self._bucket(self.buckets.pause, self.name, until, self.burst)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "perMinute": round(self.rate * 60, 1),
+                "burst": round(self.burst, 1),
+                "concurrency": round(self.limit, 2),
+                "inFlight": self.in_flight,
+                "queued": len(self._waiting),
+                "calls": self.calls,
+                "waited": self.waited,
+                "avgWaitMs": round(self.wait_seconds / self.waited * 1000, 1) if self.waited else None,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "deadlineExpired": self.expired,
+            }
+
+
+def _seconds(retry_after, default):
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    def __init__(self, buckets, name, limits, **endpoint_options):
+        self.name = name
+        self.endpoints = {e: Endpoint(e, buckets, per_minute, **endpoint_options) for e, per_minute in limits.items()}
+
+    @asynccontextmanager
+    async def call(self, endpoint, cost=1):
+        """
+        Admit one call to `endpoint` (see Endpoint.acquire), costing `cost` tokens, and
+        release it when the block exits. Endpoints without a limit are not metered.
+
+            async with LIMITER.call("geocode") as permit:
+                r = await transport.request(...)
+                permit.record(r)
+        """
+        limited = self.endpoints.get(endpoint)
+        permit = Permit()
+        if limited is None:
+            yield permit
+            return
+        await limited.acquire(cost)
+        try:
+            yield permit
+        except http_clients.UpstreamError:
+            await limited.release(permit, failed=True)
+            raise
+        except BaseException:
+            # Cancelled or out of time: says nothing about the endpoint
+            permit.status = None
+            await limited.release(permit)
+            raise
+        await limited.release(permit)
+
+    def stats(self):
+        return {"backend": self.name, **{name: e.stats() for name, e in self.endpoints.items()}}
+
+
+def from_env():
+    """Build the limiter from the RATE_LIMIT_* settings; RATE_LIMIT_BACKEND=off disables it."""
+    if config.RATE_LIMIT_BACKEND == "disk":
+        buckets = SharedBuckets(config.RATE_LIMIT_PATH)
+    elif config.RATE_LIMIT_BACKEND == "memory":
+        buckets = MemoryBuckets()
+    else:
+        return None
+    return RateLimiter(
+        buckets,
+        config.RATE_LIMIT_BACKEND,
+        parse_limits(config.RATE_LIMITS),
+        burst_seconds=config.RATE_LIMIT_BURST_SECONDS,
+        max_concurrency=config.RATE_LIMIT_MAX_CONCURRENCY,
+        min_concurrency=config.RATE_LIMIT_MIN_CONCURRENCY,
+        pause_seconds=config.RATE_LIMIT_PAUSE_SECONDS,
+    )
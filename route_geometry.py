@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Compact route output for /optimize-route: polyline6 geometry, zoom-aware
+Douglas-Peucker simplification and steps trimmed to what the UI renders
+(models.Route.to_dict renders a route at a level).
+
+A fidelity level (the "fidelity" query parameter, ROUTE_FIDELITY by default)
+selects the output:
+
+- "full": GeoJSON geometry and complete legs;
+- "high", "medium", "low": geometry simplified to ROUTE_SIMPLIFY_PX pixels at
+  the level's map zoom and encoded as a polyline6 string (precision 1e-6,
+  latitude first, as Mapbox's geometries=polyline6). Steps keep distance,
+  duration, name and maneuver instruction/type/modifier; "low" drops steps
+  altogether and keeps only each leg's totals.
+
+Routes are compacted on the way out, so cached plans keep full fidelity and
+serve every level.
+"""
+import math
+
+import numpy as np
+
+import service_config as config
+
+# Map zoom each compact level is simplified for (None: no simplification)
+FIDELITY = {"full": None, "high": 17, "medium": 14, "low": 11}
+# Ground meters per pixel at zoom 0 on the equator, for 512 px tiles (Mapbox GL)
+METERS_PER_PIXEL_Z0 = 78271.517
+METERS_PER_DEGREE = 6371000.0 * math.pi / 180.0
+# Spans shorter than this are scanned in plain Python, where NumPy's per-call overhead dominates
+SMALL_SPAN = 48
+# 5-bit chunks in the largest encoded value (zigzagged, at precision 6 that is under 2**31)
+MAX_CHUNKS = 7
+
+
+def tolerance_meters(zoom, latitude, pixels=1.0):
+    """Ground distance covered by `pixels` screen pixels at map zoom `zoom` and `latitude`."""
+    return pixels * METERS_PER_PIXEL_Z0 * math.cos(math.radians(latitude)) / 2 ** zoom
+
+
+def _farthest_np(xy, first, last):
+    """(index, squared distance) of the point between first and last farthest from segment first-last."""
+    a = xy[first]
+    seg = xy[last] - a
+    rel = xy[first + 1:last] - a
+    length2 = seg @ seg
+    if length2 == 0:
+        dist2 = (rel * rel).sum(axis=1)
+    else:
+        # Distance to the segment (not the infinite line), so loops back past an end are kept
+        t = np.clip(rel @ seg / length2, 0.0, 1.0)
+        diff = rel - t[:, None] * seg
+        dist2 = (diff * diff).sum(axis=1)
+    k = int(dist2.argmax())
+    return first + 1 + k, float(dist2[k])
+
+
+def _farthest_py(xs, ys, first, last):
+    # Same as _farthest_np; cheaper than NumPy's per-call overhead for short spans
+    ax, ay = xs[first], ys[first]
+    sx, sy = xs[last] - ax, ys[last] - ay
+    length2 = sx * sx + sy * sy
+    best, best_d2 = first + 1, -1.0
+    for i in range(first + 1, last):
+        px, py = xs[i] - ax, ys[i] - ay
+        if length2:
+            t = (px * sx + py * sy) / length2
+            if t > 1.0:
+                t = 1.0
+            elif t < 0.0:
+                t = 0.0
+            px -= t * sx
+            py -= t * sy
+        d2 = px * px + py * py
+        if d2 > best_d2:
+            best, best_d2 = i, d2
+    return best, best_d2
+
+
+def simplify(coords, tolerance):
+    """
+    Douglas-Peucker simplification of a [[lon, lat], ...] line: points closer than
+    `tolerance` meters to the simplified line are dropped; both ends are always kept.
+    """
+    n = len(coords)
+    if n < 3 or tolerance <= 0:
+        return [list(c) for c in coords]
+    pts = np.asarray(coords, dtype=float)[:, :2]
+    # Local equirectangular projection to meters; routes are small enough for it
+    xy = np.empty_like(pts)
+    xy[:, 0] = pts[:, 0] * METERS_PER_DEGREE * math.cos(math.radians(pts[:, 1].mean()))
+    xy[:, 1] = pts[:, 1] * METERS_PER_DEGREE
+    xs = xy[:, 0].tolist()
+    ys = xy[:, 1].tolist()
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    tol2 = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        if last - first < SMALL_SPAN:
+            k, d2 = _farthest_py(xs, ys, first, last)
+        else:
+            k, d2 = _farthest_np(xy, first, last)
+        if d2 > tol2:
+            keep[k] = True
+            stack.append((first, k))
+            stack.append((k, last))
+    return pts[keep].tolist()
+
+
+def encode_polyline(coords, precision=6):
+    """Encoded polyline (Google's algorithm, latitude first) for [[lon, lat], ...]."""
+    if not len(coords):
+        return ""
+    values = np.round(np.asarray(coords, dtype=float)[:, 1::-1] * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    # Each value becomes 5-bit chunks, low first, all but the last flagged 0x20; done for
+    # every value at once as a (values x MAX_CHUNKS) grid with the unused chunks masked out
+    shifted = zigzag[:, None] >> (np.arange(MAX_CHUNKS, dtype=np.int64) * 5)
+    count = np.maximum(1, (shifted > 0).sum(axis=1))[:, None]
+    position = np.arange(MAX_CHUNKS)
+    used = position < count
+    chars = ((shifted & 0x1F) | np.where(position < count - 1, 0x20, 0)) + 63
+    return chars[used].astype(np.uint8).tobytes().decode("ascii")
+
+
+def decode_polyline(encoded, precision=6):
+    """[[lon, lat], ...] from an encoded polyline (inverse of encode_polyline)."""
+    coords = []
+    index = lat = lon = 0
+    factor = 10 ** precision
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(encoded[index]) - 63
+                index += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coords.append([lon / factor, lat / factor])
+    return coords
+
+
+def render(coords, level):
+    """Route geometry [[lon, lat], ...] at fidelity `level`: GeoJSON for "full", else a simplified polyline6 string."""
+    zoom = FIDELITY[level]
+    if zoom is None:
+        return {"type": "LineString", "coordinates": coords}
+    if not coords:
+        return ""
+    tolerance = tolerance_meters(zoom, coords[len(coords) // 2][1], config.ROUTE_SIMPLIFY_PX)
+    return encode_polyline(simplify(coords, tolerance))
+
+
+def compact_payload(result, level):
+    """
+    An /optimize-route result with its routes (models.Route) rendered at fidelity `level`,
+    and a "geometry" block describing it.
+    """
+    zoom = FIDELITY[level]
+    block = {"fidelity": level, "format": "geojson"}
+    if zoom is not None:
+        block = {"fidelity": level, "format": "polyline6", "zoom": zoom, "tolerancePx": config.ROUTE_SIMPLIFY_PX}
+    return {**result, "routes": [r.to_dict(level) for r in result.get("routes") or []], "geometry": block}
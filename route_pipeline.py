@@ -0,0 +1,1252 @@
+#!/usr/bin/env python3
+"""
+The route-planning pipeline behind /intent, /optimize and /optimize-route.
+
+Handlers take the parsed JSON body and an upstream.Upstream and return
+(payload, status); python_agent_service (Flask) and async_service (aiohttp)
+only adapt them to their framework, so both service modes run this code.
+stream_optimize_route yields the same pipeline's progress as NDJSON lines.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from itertools import product
+
+import service_config as config
+import candidate_index
+import deadline
+import geo_cache
+import geo_kernels
+import http_clients
+import jobs
+import models
+import plan_cache
+import route_geometry
+import route_solver
+import service_logging
+from json_stream import JsonStreamScanner
+from service_logging import event, ms_since, payload
+
+log = service_logging.get_logger("pipeline")
+
+# Complete /optimize-route results by tasks, start area and traffic window; None when disabled
+PLAN_CACHE = plan_cache.from_env()
+# Background /optimize-route jobs (submit_job)
+JOBS = jobs.from_env()
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    return geo_kernels.haversine(lat1, lon1, lat2, lon2)
+
+def deduplicate_locations(locations, min_distance_meters=50):
+    return geo_kernels.deduplicate_locations(locations, min_distance_meters)
+
+def calculate_preference_score(task_order):
+    """task_order: [{"task": models.Task, "location": candidate dict}, ...]"""
+    score = 50
+    for item in task_order:
+        prefs = item["task"].preferences
+        loc = item.get("location", {})
+        name = loc.get("name", "").lower()
+        address = loc.get("address", "").lower()
+        # Mandatory
+        satisfied_mandatory = [p for p in prefs if p.is_mandatory and (
+            (p.type == "location" and (p.value.lower() in name or p.value.lower() in address)) or
+            (p.type == "chain" and p.value.lower() in name)
+        )]
+        score += len(satisfied_mandatory) * 20
+        # Preferred
+        satisfied_preferred = [p for p in prefs if not p.is_mandatory and (
+            (p.type == "chain" and p.value.lower() in name) or
+            (p.type == "category" and (p.value.lower() in name or p.value.lower() in address))
+        )]
+        score += len(satisfied_preferred) * 10
+    return max(0, min(100, score))
+
+def assess_traffic_factor(route):
+    try:
+        total_d = route["distance"]
+        total_t = route["duration"]
+        expected_speed_kmh = (total_d / total_t) * 3.6
+        if expected_speed_kmh < 20:
+            return "high"
+        if expected_speed_kmh < 40:
+            return "medium"
+        return "low"
+    except Exception:
+        return "medium"
+
+def estimate_gas_cost(distance_m):
+    miles = distance_m * 0.000621371
+    return round(miles * 0.15, 2)
+
+def _content(data):
+    return data.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+def _no_emit(event, data):
+    pass
+
+def _cache_stats(up):
+    return {**up.cache_stats(), "planCache": PLAN_CACHE.stats() if PLAN_CACHE is not None else "disabled"}
+
+async def health(up):
+    return {
+        "success": True,
+        "sudo": "configured" if config.SUDO_API_KEY else "not configured",
+        # Which worker answered (see gunicorn.conf.py); caches and stats below are per worker
+        "pid": os.getpid(),
+        # Cache stats count rows in their SQLite files: off the event loop
+        **await asyncio.to_thread(_cache_stats, up),
+        **up.stats(),
+        "jobs": JOBS.stats(),
+        "logging": service_logging.stats(),
+    }, 200
+
+async def intent(body, up):
+    text = body.get("text", "")
+    system = (
+        "You are a task parser. Extract starting location, tasks, and preferences."
+    )
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": text},
+    ]
+    data = await up.sudo_chat(messages)
+    if "error" in data:
+        return {"success": False, "error": data["error"], "body": data.get("body")}, 400
+    return {"success": True, "content": _content(data), "raw": data}, 200
+
+async def optimize(body, up):
+    text = body.get("text", "")
+    messages = [{"role": "user", "content": text}]
+    data = await up.sudo_chat(messages)
+    if "error" in data:
+        return {"success": False, "error": data["error"], "body": data.get("body")}, 400
+    return {"success": True, "content": _content(data), "raw": data}, 200
+
+def _task_subject(task):
+    """(type, brand, preferences, "brand " or "") for a task's address query."""
+    ttype = task.type.lower()
+    prefs = task.preferences
+    brand = next((p.value for p in prefs if p.type in ("location","chain")), None)
+    return ttype, brand, prefs, f"{brand} " if brand else ""
+
+def _strip_fences(content):
+    """Remove a surrounding markdown code block if present."""
+    content = content.strip()
+    if content.startswith("```"):
+        lines = content.split("\n")
+        content = "\n".join(lines[1:-1]) if len(lines) > 2 else content
+    return content
+
+def _address_strings(items, ttype):
+    """Normalize the Gemini answer to plain address strings (strings or {"address": ...} dicts)."""
+    valid = []
+    for idx, addr in enumerate(items):
+        # Handle both string addresses and dict format
+        if isinstance(addr, dict):
+            addr = addr.get("address", "")
+        if not addr or not isinstance(addr, str):
+            event(log, "task.address_skipped", logging.DEBUG, type=ttype, index=idx, address=payload(addr))
+            continue
+        valid.append(addr)
+    return valid
+
+def _task_messages(task, start):
+    """The per-task Gemini prompt: a JSON array of CANDIDATES_PER_TASK addresses."""
+    ttype, brand, prefs, brand_text = _task_subject(task)
+    max_items = config.CANDIDATES_PER_TASK
+
+    # Build the query for Gemini
+    gemini_query = f"Get me top {max_items} addresses of {brand_text}{ttype} in or near {start.get('address')}"
+    event(log, "task.query", logging.DEBUG, type=ttype, brand=brand, query=gemini_query, preferences=payload(prefs))
+
+    # Ask Gemini for specific addresses in the correct format for geocoding
+    prompt = {
+        "role": "system",
+        "content": f"""You are a local business address finder. Return ONLY a JSON array of exactly {max_items} real {brand_text}{ttype} addresses in or near {start.get('name')}, {start.get('address')}.
+
+CRITICAL: Return addresses in this EXACT format that works with geocoding APIs:
+"Business Name, Street Address, City, State ZIP"
+
+Example:
+[
+  "Walmart Supercenter, 2551 San Ramon Valley Blvd, San Ramon, CA 94583",
+  "Target, 3141 Crow Canyon Pl, San Ramon, CA 94583"
+]
+
+Return ONLY the JSON array, no markdown, no extra text. Use real businesses with complete addresses including ZIP codes."""
+    }
+    userq = {
+        "role": "user",
+        "content": gemini_query
+    }
+    return [prompt, userq]
+
+async def _chat_in_budget(up, messages):
+    """up.sudo_chat bounded by the request's deadline; an {"error": ...} reply if it runs out first."""
+    try:
+        return await deadline.bounded(up.sudo_chat(messages))
+    except deadline.DeadlineExceeded:
+        deadline.note("addresses")
+        return {"error": "deadline exceeded"}
+
+async def find_task_addresses(task, start, up):
+    """
+    Ask Gemini for candidate addresses for one task (stages 1 and 2).
+    Returns (addresses, timing) where timing holds the LLM milliseconds.
+    """
+    t0 = time.perf_counter()
+    ttype = _task_subject(task)[0]
+    max_items = config.CANDIDATES_PER_TASK
+    data = await _chat_in_budget(up, _task_messages(task, start))
+    t_llm = time.perf_counter()
+    addresses = []
+
+    if "error" in data:
+        event(log, "task.llm_error", logging.WARNING, type=ttype, error=data["error"])
+    else:
+        content = _content(data)
+        event(log, "task.llm_reply", logging.DEBUG, type=ttype, content=payload(content))
+        addresses = parse_task_addresses(content, ttype, max_items)
+
+    valid = _address_strings(addresses, ttype)
+    timing = {
+        "type": ttype,
+        "llmMs": round((t_llm - t0) * 1000, 1),
+        "lookup": "single",
+    }
+    event(log, "task.addresses", type=ttype, addresses=len(valid), ms=timing["llmMs"])
+    return valid, timing
+
+def parse_task_addresses(content, ttype, max_items):
+    """The JSON array in a per-task answer (code fences allowed), cut to max_items; [] if there is none."""
+    try:
+        content = _strip_fences(content)
+        # Try to extract JSON array
+        array_match = re.search(r'\[[\s\S]*\]', content)
+        if array_match:
+            parsed = json.loads(array_match.group(0))
+            if isinstance(parsed, list):
+                return parsed[:max_items]
+        else:
+            event(log, "task.parse_error", logging.WARNING, type=ttype, error="no JSON array in response", content=payload(content))
+    except Exception as e:
+        event(log, "task.parse_error", logging.WARNING, type=ttype, error=str(e), content=payload(content))
+    return []
+
+async def stream_task_addresses(task, start, up, on_address):
+    """
+    Streaming variant of find_task_addresses: the completion is read as it is generated
+    and each address is passed to on_address(address) the moment its string literal
+    closes. Falls back to find_task_addresses if the stream fails before any address;
+    if the deadline passes mid-stream, the addresses received so far are kept.
+    """
+    t0 = time.perf_counter()
+    ttype = _task_subject(task)[0]
+    max_items = config.CANDIDATES_PER_TASK
+    scanner = JsonStreamScanner()
+    parts = []
+    valid = []
+    first_ms = None
+
+    async def read():
+        nonlocal first_ms
+        async for chunk in up.sudo_chat_stream(_task_messages(task, start)):
+            parts.append(chunk)
+            for _, addr in scanner.feed(chunk):
+                if addr and len(valid) < max_items:
+                    if first_ms is None:
+                        first_ms = ms_since(t0)
+                    valid.append(addr)
+                    on_address(addr)
+
+    try:
+        await deadline.bounded(read())
+    except deadline.DeadlineExceeded:
+        deadline.note("addresses")
+        event(log, "task.stream_cut", logging.WARNING, type=ttype, received=len(valid))
+    except http_clients.UpstreamError as e:
+        event(log, "task.stream_error", logging.WARNING, type=ttype, error=str(e), received=len(valid))
+        if not valid:
+            found = await find_task_addresses(task, start, up)
+            for addr in found[0]:
+                on_address(addr)
+            return found
+    if not valid and parts:
+        # Nothing recognizable while streaming; give the whole answer to the regular parser
+        for addr in _address_strings(parse_task_addresses("".join(parts), ttype, max_items), ttype):
+            valid.append(addr)
+            on_address(addr)
+
+    timing = {
+        "type": ttype,
+        "llmMs": ms_since(t0),
+        "firstAddressMs": first_ms,
+        "lookup": "stream",
+    }
+    event(log, "task.addresses", type=ttype, addresses=len(valid), ms=timing["llmMs"], firstAddressMs=first_ms)
+    return valid, timing
+
+def _loads_lenient(text):
+    """json.loads, retrying once with trailing commas removed; None if it still fails."""
+    for candidate in (text, re.sub(r",\s*([}\]])", r"\1", text)):
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    return None
+
+def _task_number(key):
+    m = re.search(r"\d+", str(key))
+    return int(m.group(0)) if m else None
+
+def _numbering_shift(keys, n_tasks):
+    """
+    How the task numbers of a batched answer relate to the prompt's 0..n_tasks-1: 0, or 1
+    when the model numbered from one (key n_tasks, no 0). None when the answer has neither
+    0 nor n_tasks: then it cannot be told apart from a one-based answer that left out its
+    last task, and it is not used.
+    """
+    keys = set(keys)
+    if not keys or 0 in keys:
+        return 0
+    return 1 if n_tasks in keys else None
+
+def parse_batched_addresses(content, n_tasks):
+    """
+    Parse a batched address-finder answer into {task index: [address items]}.
+
+    Accepts {"0": [...], "1": [...]} (keys may read "task 1" etc.), the same wrapped
+    in {"tasks": ...}, a list of arrays in task order, or a list of
+    {"task": i, "addresses": [...]} objects; code fences and trailing commas are
+    tolerated. One-based numbering is shifted, and an answer whose numbering is
+    ambiguous is rejected (see _numbering_shift). If the whole
+    answer is not valid JSON, every `"<n>": [...]` entry that parses on its own is
+    kept. Tasks that are missing or not a list are left out.
+    """
+    content = _strip_fences(content)
+    first = min((i for i in (content.find("{"), content.find("[")) if i >= 0), default=-1)
+    parsed = None
+    if first >= 0:
+        last = max(content.rfind("}"), content.rfind("]"))
+        parsed = _loads_lenient(content[first:last + 1])
+    if isinstance(parsed, dict) and len(parsed) == 1:
+        # {"tasks": {...}} / {"results": [...]}
+        key, inner = next(iter(parsed.items()))
+        if _task_number(key) is None and isinstance(inner, (dict, list)):
+            parsed = inner
+
+    entries = {}
+    if isinstance(parsed, dict):
+        for key, value in parsed.items():
+            if isinstance(value, dict):
+                value = value.get("addresses")
+            entries[_task_number(key)] = value
+    elif isinstance(parsed, list):
+        for pos, item in enumerate(parsed):
+            if isinstance(item, dict):
+                idx = item.get("task", item.get("index", pos))
+                entries[_task_number(idx)] = item.get("addresses")
+            else:
+                entries[pos] = item
+    else:
+        for m in re.finditer(r'"([^"]*\d+[^"]*)"\s*:\s*(\[[^\[\]]*\])', content):
+            entries[_task_number(m.group(1))] = _loads_lenient(m.group(2))
+
+    # Numbered by every key the model wrote, usable or not
+    shift = _numbering_shift((k for k in entries if k is not None), n_tasks)
+    entries = {k: v for k, v in entries.items() if k is not None and isinstance(v, list)}
+    if shift is None:
+        return {}
+    return {k - shift: v for k, v in entries.items() if 0 <= k - shift < n_tasks}
+
+def _batched_messages(tasks, start):
+    """The batched Gemini prompt: one JSON object keyed by task number."""
+    max_items = config.CANDIDATES_PER_TASK
+    subjects = [_task_subject(task) for task in tasks]
+    task_lines = "\n".join(f"{i}: {brand_text}{ttype}" for i, (ttype, _, _, brand_text) in enumerate(subjects))
+    event(log, "tasks.batched_query", logging.DEBUG, tasks=len(tasks), query=task_lines)
+
+    prompt = {
+        "role": "system",
+        "content": f"""You are a local business address finder. For each numbered task, find exactly {max_items} real matching business addresses in or near {start.get('name')}, {start.get('address')}.
+
+Return ONLY a JSON object keyed by task number ("0", "1", ...), each value a JSON array of addresses.
+
+CRITICAL: Return addresses in this EXACT format that works with geocoding APIs:
+"Business Name, Street Address, City, State ZIP"
+
+Example for tasks "0: Walmart groceries" and "1: gym":
+{{
+  "0": ["Walmart Supercenter, 2551 San Ramon Valley Blvd, San Ramon, CA 94583"],
+  "1": ["24 Hour Fitness, 2600 Camino Ramon, San Ramon, CA 94583"]
+}}
+
+Return ONLY the JSON object, no markdown, no extra text. Use real businesses with complete addresses including ZIP codes."""
+    }
+    userq = {
+        "role": "user",
+        "content": f"Tasks:\n{task_lines}"
+    }
+    return [prompt, userq]
+
+async def find_addresses_batched(tasks, start, up):
+    """
+    Ask Gemini for every task's candidate addresses in one call (stages 1 and 2).
+    Returns a list aligned with tasks of (addresses, timing), or None where the
+    answer had nothing usable for that task.
+    """
+    t0 = time.perf_counter()
+    max_items = config.CANDIDATES_PER_TASK
+    subjects = [_task_subject(task) for task in tasks]
+    data = await _chat_in_budget(up, _batched_messages(tasks, start))
+    llm_ms = round((time.perf_counter() - t0) * 1000, 1)
+
+    if "error" in data:
+        event(log, "tasks.batched_llm_error", logging.WARNING, error=data["error"])
+        return [None] * len(tasks)
+    content = _content(data)
+    event(log, "tasks.batched_llm_reply", logging.DEBUG, content=payload(content))
+    entries = parse_batched_addresses(content, len(tasks))
+
+    out = []
+    for i, (ttype, _, _, _) in enumerate(subjects):
+        valid = _address_strings(entries.get(i, [])[:max_items], ttype)
+        out.append((valid, {"type": ttype, "llmMs": llm_ms, "lookup": "batched"}) if valid else None)
+    missing = [i for i, f in enumerate(out) if f is None]
+    event(log, "tasks.batched_addresses", tasks=len(tasks), missing=missing or None, ms=llm_ms,
+          content=payload(content) if missing else None)
+    return out
+
+async def stream_addresses_batched(tasks, start, up, on_address):
+    """
+    Streaming variant of find_addresses_batched: on_address(task number, address) is
+    called as each address closes in the completion. Numbers are passed as the model
+    wrote them; returns (found, shift) where shift is 1 if the finished answer turned
+    out to be numbered from one (callers subtract it from the numbers they were given),
+    or None if its numbering is ambiguous (see _numbering_shift; callers drop every
+    address they were given, and found is all None). If the deadline passes mid-stream,
+    the addresses received so far are kept.
+    """
+    t0 = time.perf_counter()
+    n = len(tasks)
+    max_items = config.CANDIDATES_PER_TASK
+    subjects = [_task_subject(task) for task in tasks]
+    scanner = JsonStreamScanner()
+    parts = []
+    streamed = {}
+    first_ms = None
+
+    async def read():
+        nonlocal first_ms
+        async for chunk in up.sudo_chat_stream(_batched_messages(tasks, start)):
+            parts.append(chunk)
+            for path, addr in scanner.feed(chunk):
+                key = next((k for k in map(_task_number, reversed(path)) if k is not None), None)
+                if key is None or key > n or not addr or len(streamed.get(key, ())) >= max_items:
+                    continue
+                if first_ms is None:
+                    first_ms = ms_since(t0)
+                streamed.setdefault(key, []).append(addr)
+                on_address(key, addr)
+
+    try:
+        await deadline.bounded(read())
+    except deadline.DeadlineExceeded:
+        deadline.note("addresses")
+        event(log, "tasks.batched_stream_cut", logging.WARNING, received=sum(map(len, streamed.values())))
+    except http_clients.UpstreamError as e:
+        event(log, "tasks.batched_stream_error", logging.WARNING, error=str(e), received=sum(map(len, streamed.values())))
+    shift = _numbering_shift(streamed, n)
+    if shift is None:
+        event(log, "tasks.batched_ambiguous_numbering", logging.WARNING, keys=sorted(streamed))
+        streamed = {}
+
+    # Shapes the scanner cannot attribute to a task (e.g. a list of arrays) go through the full parser
+    if parts and shift is not None:
+        for i, items in parse_batched_addresses("".join(parts), n).items():
+            if i + shift not in streamed:
+                addrs = _address_strings(items[:max_items], subjects[i][0])
+                if addrs:
+                    streamed[i + shift] = addrs
+                    for addr in addrs:
+                        on_address(i + shift, addr)
+
+    llm_ms = ms_since(t0)
+    out = []
+    for i, (ttype, _, _, _) in enumerate(subjects):
+        addrs = streamed.get(i + (shift or 0))
+        out.append((addrs, {"type": ttype, "llmMs": llm_ms, "firstAddressMs": first_ms, "lookup": "batched-stream"}) if addrs else None)
+    missing = [i for i, f in enumerate(out) if f is None]
+    event(log, "tasks.batched_addresses", tasks=n, missing=missing or None, ms=llm_ms, firstAddressMs=first_ms,
+          content=payload("".join(parts)) if missing else None)
+    return out, shift
+
+async def _find_each(tasks, lookup):
+    """lookup(index, task) for every task, fanned out (bounded by TASK_CONCURRENCY) in concurrent mode."""
+    if config.TASK_EXECUTION_MODE != "concurrent" or len(tasks) < 2 or config.TASK_CONCURRENCY < 2:
+        return [await lookup(i, task) for i, task in tasks]
+    limit = asyncio.Semaphore(config.TASK_CONCURRENCY)
+
+    async def bounded(i, task):
+        async with limit:
+            return await lookup(i, task)
+
+    return await asyncio.gather(*(bounded(i, task) for i, task in tasks))
+
+async def _find_addresses(tasks, start, up):
+    """Stages 1 and 2 without streaming: [(addresses, timing), ...] in task order."""
+    lookup = lambda i, task: find_task_addresses(task, start, up)
+    if config.ADDRESS_FINDER_MODE != "batched" or len(tasks) < 2:
+        return await _find_each(list(enumerate(tasks)), lookup)
+    found = await find_addresses_batched(tasks, start, up)
+    missing = [i for i, f in enumerate(found) if f is None]
+    if missing:
+        retried = await _find_each([(i, tasks[i]) for i in missing], lookup)
+        for i, result in zip(missing, retried):
+            result[1]["lookup"] = "fallback"
+            found[i] = result
+    return found
+
+async def _find_addresses_streaming(tasks, start, up):
+    """
+    Stages 1-3 with streamed completions: each address starts geocoding (at most
+    GEOCODE_CONCURRENCY at a time) as soon as it arrives, while the model is still
+    writing the rest. Returns (found, pending) with pending = [(task index, address,
+    geocoding task), ...] in arrival order.
+    """
+    limit = asyncio.Semaphore(max(1, config.GEOCODE_CONCURRENCY))
+    pending = []
+
+    async def geocode(addr):
+        async with limit:
+            return await up.geocode_address(addr)
+
+    def on_address(i, addr):
+        pending.append([i, addr, asyncio.ensure_future(geocode(addr))])
+
+    def lookup(i, task):
+        return stream_task_addresses(task, start, up, lambda addr: on_address(i, addr))
+
+    try:
+        if config.ADDRESS_FINDER_MODE != "batched" or len(tasks) < 2:
+            found = await _find_each(list(enumerate(tasks)), lookup)
+        else:
+            found, shift = await stream_addresses_batched(tasks, start, up, on_address)
+            for item in pending:
+                item[0] = item[0] - shift if shift is not None else -1
+            missing = [i for i, f in enumerate(found) if f is None]
+            if missing:
+                retried = await _find_each([(i, tasks[i]) for i in missing], lookup)
+                for i, result in zip(missing, retried):
+                    result[1]["lookup"] = "fallback"
+                    found[i] = result
+    except BaseException:
+        for _, _, job in pending:
+            job.cancel()
+        raise
+    kept = []
+    for i, addr, job in pending:
+        if 0 <= i < len(tasks):
+            kept.append((i, addr, job))
+        else:
+            job.cancel()
+    return found, kept
+
+async def find_all_task_locations(tasks, start, up):
+    """
+    Find candidate locations for every task. With ADDRESS_FINDER_MODE=batched one
+    Gemini call covers all tasks and only tasks missing from its answer get their own
+    call; otherwise each task has its own lookup (fanned out in concurrent mode).
+    With LLM_STREAMING each address is geocoded as soon as the model writes it
+    (geocodeMs is then only the wait left after the last completion); otherwise every
+    address of the request is geocoded in one bulk pass afterwards.
+    Returns [(locations, timing), ...] in task order.
+    """
+    t0 = time.perf_counter()
+    if config.LLM_STREAMING:
+        found, pending = await _find_addresses_streaming(tasks, start, up)
+        flat = [(i, addr) for i, addr, _ in pending]
+        t_geo = time.perf_counter()
+        results = await deadline.gather_partial([job for _, _, job in pending], "geocode")
+    else:
+        found = await _find_addresses(tasks, start, up)
+        # Stage 3: geocode all addresses across all tasks at once
+        flat = [(i, addr) for i, (addresses, _) in enumerate(found) for addr in addresses]
+        t_geo = time.perf_counter()
+        results = await up.geocode_addresses([addr for _, addr in flat])
+    geocode_ms = round((time.perf_counter() - t_geo) * 1000, 1)
+
+    per_task = [[] for _ in tasks]
+    failed = 0
+    for (i, addr), g in zip(flat, results):
+        if g:
+            g["type"] = found[i][1]["type"]
+            per_task[i].append(g)
+        else:
+            failed += 1
+            event(log, "geocode.failed", logging.DEBUG, task=i, address=payload(addr))
+    event(log, "geocode.done", addresses=len(flat), tasks=len(tasks), failed=failed, ms=geocode_ms)
+
+    out = []
+    for i, geocoded in enumerate(per_task):
+        # Deduplicate locations that are too close together
+        found_count = len(geocoded)
+        geocoded = deduplicate_locations(geocoded, min_distance_meters=100)
+        event(log, "task.deduplicated", logging.DEBUG, task=i, found=found_count, remaining=len(geocoded))
+
+        timing = dict(found[i][1])
+        timing["geocodeMs"] = geocode_ms
+        timing["totalMs"] = round((time.perf_counter() - t0) * 1000, 1)
+        out.append((geocoded, timing))
+    return out
+
+async def directions_route(start, combo, visit_order, preference_score, up):
+    """Route from start through combo in visit_order and back, with legs and geometry from one directions call; None on failure."""
+    ordered = [start] + [combo[k] for k in visit_order] + [start]
+    d = await up.directions_waypoints([(p["longitude"], p["latitude"]) for p in ordered], steps=True)
+    if not d or not d.get("routes"):
+        return None
+    try:
+        return models.Route.from_mapbox(d["routes"][0], combo, visit_order, preference_score)
+    except models.ModelError as e:
+        event(log, "directions.invalid", logging.WARNING, error=str(e))
+        return None
+
+async def evaluate_routes_trips(start, filtered, location_options, up, limit=5, emit=_no_emit):
+    """
+    Cost every combination with one optimized-trips call each. Calls grow as
+    TRIPS_MAX_CANDIDATES ** tasks, so only the candidates closest to the start are used.
+    Combinations whose legs are all in the leg cache are costed locally instead, and
+    only those ranking in the top `limit` get a directions call for their geometry.
+    Each route is passed to emit("route", ...) as soon as it is complete; calls still
+    outstanding at the deadline are left out.
+    """
+    filtered = [geo_kernels.sort_by_distance(start["latitude"], start["longitude"], locs)[:config.TRIPS_MAX_CANDIDATES] for locs in filtered]
+
+    def score(combo):
+        return calculate_preference_score([{"task": location_options[i]["task"], "location": c} for i, c in enumerate(combo)])
+
+    # Split off the combinations the leg cache can cost: (duration, -preferenceScore, stops, visitOrder, distance)
+    known = []
+    remote = []
+    for combo in product(*filtered):
+        legs = up.known_legs([(start["longitude"], start["latitude"])] + [(c["longitude"], c["latitude"]) for c in combo])
+        if legs is None:
+            remote.append(combo)
+            continue
+        duration, order = route_solver.best_order(route_solver.cost_matrix(legs["durations"]), range(1, len(combo) + 1), start=0, end=0)
+        if duration == route_solver.INF:
+            continue
+        known.append((duration, -score(combo), combo, [n - 1 for n in order], _path_length(legs["distances"], [0, *order, 0])))
+
+    async def cost(combo):
+        coords = [(start["longitude"], start["latitude"])] + [(c["longitude"], c["latitude"]) for c in combo]
+        ot = await up.optimized_trip(coords, source_first=True, destination_last=False)
+        if not ot or not ot.get("trips"):
+            return None
+        waypoints = ot.get("waypoints") or []
+        visit_order = [i for _, i in sorted((w.get("waypoint_index", i), i - 1) for i, w in enumerate(waypoints) if i > 0)]
+        try:
+            route = models.Route.from_mapbox(ot["trips"][0], combo, visit_order, score(combo))
+        except models.ModelError as e:
+            event(log, "trip.invalid", logging.WARNING, error=str(e))
+            return None
+        emit("route", route)
+        return route
+
+    costed = await deadline.gather_partial([cost(combo) for combo in remote], "routes")
+    routes = [r for r in costed if r]
+
+    async def finish(item):
+        duration, neg_score, combo, visit_order, _ = item
+        route = await directions_route(start, combo, visit_order, -neg_score, up)
+        if route is not None:
+            emit("route", route)
+        return route
+
+    # Locally costed combinations only need geometry if they would make the top `limit`
+    ranked = sorted([(r.total_duration, -r.preference_score, None) for r in routes] + [(k[0], k[1], k) for k in known],
+                    key=lambda x: (route_solver.INF if x[0] is None else x[0], x[1]))
+    top_known = [x[2] for x in ranked[:limit] if x[2] is not None]
+    finished = await deadline.gather_partial([finish(item) for item in top_known], "routes")
+    for item, route in zip(top_known, finished):
+        if route is None and deadline.expired():
+            duration, neg_score, combo, visit_order, distance = item
+            route = estimated_route(start, combo, visit_order, duration, distance, -neg_score)
+            emit("route", route)
+        if route:
+            routes.append(route)
+    event(log, "routes.trips", logging.DEBUG, combinations=len(known) + len(remote), tripCalls=len(remote),
+          fromLegCache=len(known), directionsCalls=len(top_known))
+    for i, r in enumerate(routes):
+        r.id = f"route-{i+1}"
+    return routes
+
+def candidate_points(start, filtered):
+    """Matrix points (start first, then every distinct candidate) and each task's point indices."""
+    points = [start]
+    index = {}
+    for locs in filtered:
+        for loc in locs:
+            if id(loc) not in index:
+                index[id(loc)] = len(points)
+                points.append(loc)
+    groups = [[index[id(c)] for c in locs] for locs in filtered]
+    return points, groups
+
+def rank_combinations(points, groups, location_options, durations, limit=5):
+    """
+    Rank candidate selections and visiting orders from a travel-duration matrix over
+    points. Returns [(duration, -preferenceScore, stops, visitOrder), ...] best first.
+    """
+    time_limit = config.SOLVER_TIME_LIMIT
+    left = deadline.remaining()
+    if left is not None:
+        time_limit = min(time_limit, max(0.05, left / 2))
+    cost = route_solver.cost_matrix(durations)
+    # Ask for a few extra selections so the preference-score tiebreak has room to work;
+    # end=0 makes each route a round trip, like optimized-trips' default
+    ranked = route_solver.rank_selections(
+        cost, groups, k=limit * 2, start=0, end=0,
+        time_limit=time_limit, exact_max_groups=config.SOLVER_EXACT_MAX_GROUPS,
+    )
+
+    scored = []
+    for sol in ranked:
+        combo = tuple(points[n] for n in sol.selection)
+        task_order = [{"task": location_options[i]["task"], "location": c} for i, c in enumerate(combo)]
+        visit_order = [sol.selection.index(n) for n in sol.order]
+        scored.append((sol.cost, -calculate_preference_score(task_order), combo, visit_order))
+    scored.sort(key=lambda x: (x[0], x[1]))
+    return scored
+
+async def evaluate_routes_matrix(start, filtered, location_options, up, limit=5, emit=_no_emit):
+    """
+    Fetch one travel matrix for the start and every candidate, rank the selections and
+    visiting orders locally with route_solver, then make a directions call only for the
+    top `limit` routes to get their legs and geometry (each passed to emit("route", ...)
+    as it completes). Routes whose directions call is still outstanding at the deadline
+    are returned as estimates from the matrix. Returns None if the matrix is unavailable.
+    """
+    points, groups = candidate_points(start, filtered)
+    matrix = await up.travel_matrix([(p["longitude"], p["latitude"]) for p in points])
+    if matrix is None:
+        return None
+    # The solver is CPU-bound, so it runs off the event loop
+    scored = await asyncio.to_thread(rank_combinations, points, groups, location_options, matrix["durations"], limit)
+
+    async def finish(item):
+        duration, neg_score, combo, visit_order = item
+        out = await directions_route(start, combo, visit_order, -neg_score, up)
+        if out is not None:
+            out.matrix_duration = duration
+            emit("route", out)
+        return out
+
+    finished = await deadline.gather_partial([finish(item) for item in scored[:limit]], "routes")
+    node = {id(p): n for n, p in enumerate(points)}
+    for k, (item, route) in enumerate(zip(scored, finished)):
+        if route is None and deadline.expired():
+            duration, neg_score, combo, visit_order = item
+            path = [0] + [node[id(combo[v])] for v in visit_order] + [0]
+            finished[k] = estimated_route(start, combo, visit_order, duration, _path_length(matrix["distances"], path), -neg_score)
+            emit("route", finished[k])
+    routes = [r for r in finished if r]
+    for i, r in enumerate(routes):
+        r.id = f"route-{i+1}"
+    return routes
+
+def _path_length(distances, path):
+    """Sum of matrix entries along path (node indices); None if any leg is missing."""
+    legs = [distances[a][b] for a, b in zip(path, path[1:])] if distances else [None]
+    return None if any(d is None for d in legs) else sum(legs)
+
+def estimated_route(start, combo, visit_order, duration, distance, preference_score):
+    """
+    A route without a directions call (the deadline came first): the given totals and a
+    straight-line geometry through the stops, flagged "estimated".
+    """
+    ordered = [start] + [combo[k] for k in visit_order] + [start]
+    return models.Route(
+        stops=[models.Location.from_dict(c) for c in combo],
+        total_distance=distance,
+        total_duration=duration,
+        legs=[],
+        geometry=[[p["longitude"], p["latitude"]] for p in ordered],
+        preference_score=preference_score,
+        visit_order=list(visit_order),
+        estimated=True,
+    )
+
+def estimate_routes(start, filtered, location_options, limit=5):
+    """
+    Last-resort ranking when no routing data arrived in time: straight-line distances
+    between the candidates, driven at ESTIMATE_SPEED_MPS. Returns estimated routes.
+    """
+    points, groups = candidate_points(start, filtered)
+    lats, lons = geo_kernels.coords(points)
+    distances = geo_kernels.distance_matrix(lats, lons).tolist()
+    durations = [[d / config.ESTIMATE_SPEED_MPS for d in row] for row in distances]
+    node = {id(p): n for n, p in enumerate(points)}
+    routes = []
+    for duration, neg_score, combo, visit_order in rank_combinations(points, groups, location_options, durations, limit)[:limit]:
+        path = [0] + [node[id(combo[k])] for k in visit_order] + [0]
+        routes.append(estimated_route(start, combo, visit_order, duration, _path_length(distances, path), -neg_score))
+    for i, r in enumerate(routes):
+        r.id = f"route-{i+1}"
+    return routes
+
+def warm():
+    """
+    Run the CPU-bound paths once (solver, distance kernels, route model, geometry and
+    JSON encoding) so their lazy imports and first-call setup are done before a
+    preloading server forks its workers.
+    """
+    start = {"latitude": 37.78, "longitude": -121.98, "name": "warm-up", "address": ""}
+    filtered = [[{"latitude": 37.78 + 0.01 * (t + 1), "longitude": -121.98 + 0.01 * k, "name": "", "address": ""}
+                 for k in range(2)] for t in range(2)]
+    routes = estimate_routes(start, filtered, [{"task": models.Task("warm-up"), "locations": locs} for locs in filtered])
+    for level in route_geometry.FIDELITY:
+        models.dumps(route_geometry.compact_payload({"routes": routes}, level))
+
+def request_budget(body):
+    """
+    Seconds the request may take: REQUEST_BUDGET_MS, or the caller's "budgetMs" capped
+    at REQUEST_BUDGET_MAX_MS. None when budgets are disabled.
+    """
+    ms = config.REQUEST_BUDGET_MS
+    asked = body.get("budgetMs")
+    if isinstance(asked, (int, float)) and not isinstance(asked, bool) and asked > 0:
+        ms = min(asked, config.REQUEST_BUDGET_MAX_MS)
+    return ms / 1000 if ms > 0 else None
+
+async def optimize_route(body, up, emit=_no_emit):
+    """
+    Plan routes for one /optimize-route body. emit(event, data) is called as stages
+    complete: "accepted", "start" (resolved start and tasks), "task" (each task's
+    candidates), "route" (each scored route, unranked); the ranked top 5 is returned.
+
+    The request runs within request_budget(body). Lookups and routing calls still
+    outstanding when it runs out are dropped and the result is flagged "partial"; if the
+    budget is gone before any route can be planned the answer is a 504.
+
+    Routes (returned and emitted) are at the body's "fidelity" level, ROUTE_FIDELITY by
+    default (see route_geometry).
+    """
+    service_logging.begin_request()
+    fidelity = str(body.get("fidelity") or config.ROUTE_FIDELITY).lower()
+    if fidelity not in route_geometry.FIDELITY:
+        return {"success": False, "error": f"Unknown fidelity '{fidelity}'",
+                "fidelityLevels": list(route_geometry.FIDELITY)}, 400
+    budget = request_budget(body)
+    deadline.begin(budget)
+
+    def emit_compact(event, data):
+        emit(event, data.to_dict(fidelity) if event == "route" else data)
+
+    try:
+        result, status = await deadline.bounded(_plan_routes(body, up, emit if emit is _no_emit else emit_compact, budget))
+    except deadline.DeadlineExceeded:
+        budget_ms = budget * 1000 if budget else None
+        event(log, "request.deadline_exceeded", logging.WARNING, budgetMs=budget_ms, missed=deadline.missed())
+        return {
+            "success": False,
+            "error": "Latency budget exhausted before a route could be planned",
+            "deadlineExceeded": True,
+            "budgetMs": budget_ms,
+        }, 504
+    if status != 200:
+        return result, status
+    return route_geometry.compact_payload(result, fidelity), status
+
+def with_query(body, query):
+    """body with the /optimize-route options given in the query string (fidelity, priority) merged in; the query wins."""
+    for option in ("fidelity", "priority"):
+        if query.get(option):
+            body = {**body, option: query[option]}
+    return body
+
+async def _plan_routes(body, up, emit, budget):
+    t0 = time.perf_counter()
+    parsed_json = {}
+    # Prefer structured payload from Node to avoid re-parsing raw text
+    starting_address = body.get("startingAddress") or ""
+    try:
+        tasks = models.Task.list_from(body.get("tasks") or [])
+    except models.ModelError as e:
+        event(log, "request.invalid", logging.WARNING, error=str(e))
+        return {"success": False, "error": f"Invalid request: {e}"}, 400
+    event(log, "request.received", startingAddress=starting_address or None, tasks=len(tasks), body=payload(body))
+    emit("accepted", {"startingAddress": starting_address or None, "taskCount": len(tasks)})
+    if not starting_address:
+        # Fallback: try raw text via LLM with structured prompt
+        user_input = body.get("userInput", "")
+        intent_messages = [
+            {
+                "role": "system",
+                "content": """Extract starting location, tasks, and preferences from user input.
+Return ONLY valid JSON in this exact format (no markdown, no extra text):
+{
+  "startingLocation": "City, State",
+  "tasks": [
+    {
+      "type": "gym|groceries|restaurant|custom",
+      "description": "brief description",
+      "preferences": [
+        {"type": "chain|category|location", "value": "specific value", "isMandatory": true|false}
+      ]
+    }
+  ],
+  "optimizeFor": "time|distance|preferences"
+}"""
+            },
+            {"role": "user", "content": user_input},
+        ]
+        parsed = await up.sudo_chat(intent_messages)
+        content = _content(parsed)
+
+        if "error" in parsed:
+            event(log, "intent.llm_error", logging.WARNING, error=parsed["error"])
+
+        try:
+            # Try to extract JSON from response
+            m = re.search(r"\{[\s\S]*\}", content)
+            if m:
+                parsed_json = json.loads(m.group(0))
+                event(log, "intent.parsed", startingLocation=parsed_json.get("startingLocation"),
+                      tasks=len(parsed_json.get("tasks") or []), content=payload(content))
+            else:
+                event(log, "intent.parse_error", logging.WARNING, error="no JSON object in response", content=payload(content))
+                parsed_json = {}
+        except Exception as e:
+            event(log, "intent.parse_error", logging.WARNING, error=str(e), content=payload(content))
+            parsed_json = {}
+        starting_address = parsed_json.get("startingLocation") or starting_address
+        if not tasks:
+            try:
+                tasks = models.Task.list_from(parsed_json.get("tasks") or [])
+            except models.ModelError as e:
+                event(log, "intent.invalid_tasks", logging.WARNING, error=str(e), content=payload(content))
+                return {"success": False, "error": f"Could not understand the tasks: {e}"}, 422
+
+    attempts = [
+        starting_address,
+        f"{starting_address}, USA",
+        starting_address.replace(", CA", ", California"),
+        starting_address.replace(", CA", ", California, USA"),
+    ]
+    start_candidates, variant = await up.resolve_start(starting_address, attempts)
+    if not start_candidates:
+        event(log, "start.not_found", logging.WARNING, startingAddress=starting_address)
+        return {"success": False, "error": "Starting location not found", "attempts": attempts}, 400
+    start = start_candidates[0]
+    event(log, "start.resolved", name=start.get("name"), latitude=start["latitude"], longitude=start["longitude"],
+          variant=variant, tasks=len(tasks), taskList=payload(tasks))
+    emit("start", {"startingLocation": start, "tasks": tasks})
+
+    optimize_for = (parsed_json.get("optimizeFor") if isinstance(parsed_json, dict) else None) or "preferences"
+    evaluation_mode = (body.get("evaluationMode") or config.ROUTE_EVALUATION_MODE).lower()
+    refresh = bool(body.get("forceRefresh"))
+    cache_key = window = None
+    if PLAN_CACHE is not None:
+        cache_key, window, expires_at = PLAN_CACHE.key(tasks, start, evaluation_mode, optimize_for)
+        entry = None if refresh else await geo_cache.io(PLAN_CACHE, "get", cache_key)
+        cached = _cached_plan(entry, start, tasks, optimize_for, window, emit, t0) if entry is not None else None
+        if cached is not None:
+            return cached
+
+    location_options = []
+    t_tasks = time.perf_counter()
+    # Keep part of the budget for route evaluation (a third of short budgets)
+    reserve = config.ROUTE_EVALUATION_RESERVE_MS / 1000
+    if budget:
+        reserve = min(reserve, budget / 3)
+    with deadline.limit(reserve):
+        task_results = await find_all_task_locations(tasks, start, up)
+    task_timings = []
+    located = []
+    skipped = []
+    for i, (task, (geocoded, timing)) in enumerate(zip(tasks, task_results)):
+        task_timings.append({"task": i, **timing})
+        emit("task", {"task": i, "type": timing["type"], "locations": geocoded, "timing": timing})
+        # Every task must have at least one location - if not, that's an error
+        if not geocoded:
+            error_msg = f"Could not find any locations for task: {task.description or timing['type']}"
+            if deadline.missed():
+                # The lookup ran out of time rather than finding nothing: plan the other tasks
+                event(log, "task.skipped", logging.WARNING, task=i, error=error_msg, missed=deadline.missed())
+                skipped.append(i)
+                continue
+            event(log, "task.no_locations", logging.WARNING, task=i, error=error_msg, taskSpec=payload(task))
+            return {"success": False, "error": error_msg, "task": task.to_dict()}, 422
+
+        located.append(i)
+        location_options.append({"task": task, "locations": geocoded})
+    event(log, "tasks.located", tasks=len(location_options), skipped=skipped or None, ms=service_logging.ms_since(t_tasks))
+    if skipped and not location_options:
+        raise deadline.DeadlineExceeded()
+
+    # Prepare combinations - prune each task's candidates by estimated detour
+    for opts in location_options:
+        if not opts["locations"]:
+            # This should never happen because we check earlier, but just in case
+            error_msg = f"No locations found for task: {opts['task'].description}"
+            event(log, "task.no_locations", logging.WARNING, error=error_msg)
+            return {"success": False, "error": error_msg}, 422
+
+    filtered, prune_report = candidate_index.prune_candidates(
+        start, [opts["locations"] for opts in location_options],
+        keep=config.CANDIDATES_KEEP, radius_meters=config.CANDIDATE_PRUNE_RADIUS_M,
+    )
+    event(log, "candidates.pruned", found=[len(opts["locations"]) for opts in location_options],
+          kept=[len(locs) for locs in filtered])
+
+    if not filtered:
+        return {"success": False, "error": "No locations found for any task"}, 422
+    t_eval = time.perf_counter()
+    routes = None
+    with deadline.limit(config.RESPONSE_RESERVE_MS / 1000):
+        try:
+            if evaluation_mode == "matrix":
+                routes = await evaluate_routes_matrix(start, filtered, location_options, up, emit=emit)
+                if routes is None:
+                    event(log, "matrix.unavailable", logging.WARNING, fallback="trips")
+                    evaluation_mode = "trips"
+            if routes is None:
+                routes = await evaluate_routes_trips(start, filtered, location_options, up, emit=emit)
+        except deadline.DeadlineExceeded:
+            deadline.note("routes")
+        if not routes and deadline.expired():
+            event(log, "routes.estimated", logging.WARNING, mode=evaluation_mode)
+            evaluation_mode = "estimate"
+            routes = await asyncio.to_thread(estimate_routes, start, filtered, location_options)
+            for route in routes:
+                emit("route", route)
+    evaluation_ms = round((time.perf_counter() - t_eval) * 1000, 1)
+
+    # Sort by shortest duration first (routes without one last), then by preference score as tiebreaker
+    routes = sorted(routes, key=lambda r: (route_solver.INF if r.total_duration is None else r.total_duration,
+                                           -r.preference_score))[:5]
+    event(log, "routes.evaluated", mode=evaluation_mode, routes=len(routes), ms=evaluation_ms)
+    if not routes:
+        return {"success": False, "error": "No route combinations found"}, 422
+    missed = deadline.missed()
+    event(log, "request.done", ms=service_logging.ms_since(t0), partial=bool(missed) or None, missed=missed or None)
+
+    result = {
+        "success": True,
+        # Something was cut short by the latency budget: fewer candidates, skipped
+        # tasks or estimated routes (see "deadline")
+        "partial": bool(missed),
+        "deadline": {
+            "budgetMs": budget * 1000 if budget else None,
+            "missed": missed,
+            "skippedTasks": skipped,
+        },
+        "parsedRequest": _parsed_request(start, tasks, optimize_for),
+        "routes": routes,
+        "candidates": {
+            "requestedPerTask": config.CANDIDATES_PER_TASK,
+            "keptPerTask": config.CANDIDATES_KEEP,
+            "pruneRadiusMeters": config.CANDIDATE_PRUNE_RADIUS_M,
+            "tasks": [{"task": located[i], **r} for i, r in enumerate(prune_report)],
+        },
+        "timings": {
+            "mode": config.TASK_EXECUTION_MODE,
+            "tasks": task_timings,
+            "routeEvaluation": {"mode": evaluation_mode, "ms": evaluation_ms},
+        }
+    }
+    if cache_key is None:
+        result["cache"] = {"status": "disabled"}
+        return result, 200
+    # Partial plans are not stored: the next request may have time for the full one
+    stored = not missed
+    if stored:
+        await geo_cache.io(PLAN_CACHE, "set", cache_key, {**result, "routes": [r.to_dict() for r in routes]}, expires_at,
+                           refresh)
+    result["cache"] = {"status": "refresh" if refresh else "miss", "window": window, "stored": stored}
+    return result, 200
+
+def _parsed_request(start, tasks, optimize_for):
+    return {
+        "startingLocation": start,
+        "tasks": [t.to_dict() for t in tasks],
+        "preferences": [p.to_dict() for t in tasks for p in t.preferences],
+        "optimizeFor": optimize_for,
+    }
+
+def _cached_plan(entry, start, tasks, optimize_for, window, emit, t0):
+    """
+    Answer from a stored plan: its routes and candidates, with this request's own
+    start and tasks in parsedRequest (the start may differ within its grid cell).
+    None if the stored routes do not fit the route model (the plan is then recomputed).
+    """
+    result = entry["payload"]
+    try:
+        result["routes"] = [models.Route.from_dict(r) for r in result["routes"]]
+    except (models.ModelError, KeyError) as e:
+        event(log, "plan.cache_invalid", logging.WARNING, window=window, error=str(e))
+        return None
+    result["parsedRequest"] = _parsed_request(start, tasks, optimize_for)
+    now = time.time()
+    result["cache"] = {
+        "status": "hit",
+        "window": window,
+        "ageMs": round((now - entry["storedAt"]) * 1000),
+        "expiresInMs": round((entry["expiresAt"] - now) * 1000),
+    }
+    for route in result["routes"]:
+        emit("route", route)
+    event(log, "plan.cache_hit", window=window, ageMs=result["cache"]["ageMs"], routes=len(result["routes"]))
+    event(log, "request.done", ms=service_logging.ms_since(t0), cache="hit")
+    return result, 200
+
+def stream_line(event, data, **extra):
+    """One NDJSON line: {"event": ..., **extra, "data": ...}."""
+    return models.dumps({"event": event, **extra, "data": data}) + b"\n"
+
+async def stream_optimize_route(body, up):
+    """
+    Run optimize_route and yield its events as NDJSON lines while it works, ending with
+    a "result" line (the same payload /optimize-route returns) or an "error" line, both
+    carrying the HTTP status the non-streaming endpoint would have used. Closing the
+    generator (client gone) cancels the pipeline.
+    """
+    queue = asyncio.Queue()
+
+    def emit(event, data, **extra):
+        queue.put_nowait(stream_line(event, data, **extra))
+
+    async def run():
+        try:
+            payload, status = await optimize_route(body, up, emit)
+            emit("result" if status == 200 else "error", payload, status=status)
+        except Exception as e:
+            event(log, "stream.failed", logging.ERROR, exc_info=True)
+            emit("error", {"success": False, "error": str(e)}, status=500)
+        finally:
+            queue.put_nowait(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            line = await queue.get()
+            if line is None:
+                break
+            yield line
+    finally:
+        task.cancel()
+
+def _job_links(job_id):
+    return {"self": f"/jobs/{job_id}", "stream": f"/jobs/{job_id}/stream"}
+
+async def submit_job(body, up):
+    """
+    Queue an /optimize-route body as a background job (see jobs); its "priority" is
+    "interactive" (default) or "batch". 202 with the job id and links to poll or stream
+    it, or 429 with Retry-After when that priority's queue is full. Returns
+    (payload, status, headers).
+    """
+    priority = str(body.get("priority") or "interactive").lower()
+    if priority not in jobs.PRIORITIES:
+        return {"success": False, "error": f"Unknown priority '{priority}'", "priorities": list(jobs.PRIORITIES)}, 400, {}
+    fidelity = str(body.get("fidelity") or config.ROUTE_FIDELITY).lower()
+    if fidelity not in route_geometry.FIDELITY:
+        return {"success": False, "error": f"Unknown fidelity '{fidelity}'",
+                "fidelityLevels": list(route_geometry.FIDELITY)}, 400, {}
+
+    async def run(job):
+        def emit(event, data, **extra):
+            job.append(stream_line(event, data, **extra))
+
+        try:
+            return await optimize_route(body, up, emit)
+        except Exception as e:
+            event(log, "job.failed", logging.ERROR, jobId=job.id, exc_info=True)
+            return {"success": False, "error": str(e)}, 500
+
+    try:
+        job = JOBS.submit(priority, run)
+    except jobs.QueueFull as e:
+        event(log, "job.rejected", logging.WARNING, priority=priority, queued=e.queued, retryAfter=e.retry_after)
+        return {
+            "success": False,
+            "error": f"Too many {priority} jobs queued, retry later",
+            "priority": priority,
+            "queued": e.queued,
+            "retryAfter": e.retry_after,
+        }, 429, {"Retry-After": str(e.retry_after)}
+    event(log, "job.submitted", jobId=job.id, priority=priority)
+    record = await JOBS.fetch(job.id)
+    return {"success": True, **record, "links": _job_links(job.id)}, 202, {"Location": f"/jobs/{job.id}"}
+
+async def job_status(job_id, up):
+    """A job's record: status, position while queued and, once finished, "result" and its "resultStatus"."""
+    record = await JOBS.fetch(job_id)
+    if record is None:
+        return {"success": False, "error": "Unknown or expired job"}, 404
+    return {"success": True, **record, "links": _job_links(job_id)}, 200
+
+async def cancel_job(job_id, up):
+    """Cancel a job: 200 once a queued job is cancelled, 202 while a running one is being stopped."""
+    if JOBS.cancel(job_id):
+        record = await JOBS.fetch(job_id)
+        return {"success": True, **record}, 200 if record["status"] in jobs.FINISHED else 202
+    record = await JOBS.fetch(job_id)
+    if record is None:
+        return {"success": False, "error": "Unknown or expired job"}, 404
+    if record["status"] in jobs.FINISHED:
+        return {"success": False, "error": f"Job already {record['status']}", **record}, 409
+    # Queued or running in another worker process, which is the only one that can stop it
+    return {"success": False, "error": "Job is running in another worker and cannot be cancelled from here",
+            **record}, 409
+
+async def job_stream(job_id):
+    """
+    NDJSON for a job: a "job" line (its record), the same progress lines as
+    /optimize-route/stream, then a "result" or "error" line. None for an unknown job.
+    A job running in another worker process is followed through the job store, which
+    only has its state changes.
+    """
+    job = JOBS.get(job_id)
+    record = await JOBS.fetch(job_id)
+    if record is None:
+        return None
+    return _follow_job(job) if job is not None else _follow_record(job_id, record)
+
+def _finished_line(record):
+    return stream_line("result" if record["resultStatus"] == 200 else "error", record["result"],
+                       status=record["resultStatus"])
+
+async def _follow_job(job):
+    yield stream_line("job", await JOBS.fetch(job.id))
+    offset = 0
+    while True:
+        lines, finished, changed = job.read(offset)
+        for line in lines:
+            yield line
+        offset += len(lines)
+        if finished:
+            break
+        await asyncio.wrap_future(changed)
+    yield _finished_line(job.to_dict())
+
+async def _follow_record(job_id, record):
+    yield stream_line("job", record)
+    status = record["status"]
+    while status not in jobs.FINISHED:
+        await asyncio.sleep(config.JOB_POLL_INTERVAL_MS / 1000)
+        record = await JOBS.fetch(job_id)
+        if record is None:
+            yield stream_line("error", {"success": False, "error": "Job expired"}, status=404)
+            return
+        if record["status"] != status:
+            status = record["status"]
+            yield stream_line("job", record)
+    yield _finished_line(record)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+In-process solver for the routing problem behind /optimize-route:
+pick one candidate location per task and order the stops so that the trip
+from the start (optionally to a fixed end) is as cheap as possible. This is a
+generalized TSP over a cost matrix (usually travel durations).
+
+- Held-Karp bitmask DP over tasks for exact answers on small instances, given
+  up for the heuristic when it would overrun the time limit
+- cheapest insertion + 2-opt / Or-opt / candidate re-selection, wrapped in a
+  large-neighbourhood search, for larger instances or under a time limit
+
+Costs are NumPy matrices indexed by node; np.inf marks unroutable pairs.
+`start`/`end` mirror optimized_trip's source_first/destination_last: the trip
+always leaves `start`; with end=None it may finish anywhere, with end=start it
+is a round trip.
+"""
+import random
+import time
+from dataclasses import dataclass
+from itertools import permutations, product
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+INF = float("inf")
+PERMUTATION_MAX_NODES = 6
+# Largest relative noise on insertion costs when the search rebuilds part of a tour
+INSERTION_NOISE = 0.5
+# Share of the time limit the exact DP may use before the heuristic takes over
+EXACT_TIME_SHARE = 0.5
+
+
+@dataclass
+class Solution:
+    """Chosen stops in visiting order (start/end excluded) and their total cost."""
+    cost: float
+    order: List[int]
+    selection: List[int]  # chosen node per group, in group order
+    exact: bool
+
+
+def cost_matrix(rows) -> np.ndarray:
+    """Nested lists from the Matrix API (None = unroutable) -> float matrix with inf."""
+    return np.array([[INF if v is None else float(v) for v in row] for row in rows], dtype=float)
+
+
+def _augment(cost: np.ndarray, end: Optional[int]) -> Tuple[np.ndarray, int]:
+    """Give open paths a dummy end node reachable from everywhere at zero cost."""
+    if end is not None:
+        return cost, end
+    n = cost.shape[0]
+    aug = np.zeros((n + 1, n + 1), dtype=float)
+    aug[:n, :n] = cost
+    aug[n, :] = INF
+    return aug, n
+
+
+def path_cost(cost: np.ndarray, start: int, order: Sequence[int], end: Optional[int] = None) -> float:
+    """Cost of start -> order... (-> end)."""
+    nodes = [start] + list(order) + ([end] if end is not None else [])
+    if len(nodes) < 2:
+        return 0.0
+    idx = np.asarray(nodes)
+    return float(cost[idx[:-1], idx[1:]].sum())
+
+
+def best_order(cost: np.ndarray, nodes: Sequence[int], start: int = 0, end: Optional[int] = None) -> Tuple[float, List[int]]:
+    """Exact cheapest visiting order of a fixed set of nodes (each node is its own group)."""
+    nodes = list(nodes)
+    if len(nodes) <= 1:
+        return path_cost(cost, start, nodes, end), nodes
+    if len(nodes) > PERMUTATION_MAX_NODES:
+        sol = solve(cost, [[n] for n in nodes], start=start, end=end)
+        return sol.cost, sol.order
+    # Tiny sets: plain permutations over a Python sub-matrix beat the DP's NumPy overhead
+    ids = [start] + nodes + ([end] if end is not None else [])
+    sub = np.asarray(cost, dtype=float)[np.ix_(ids, ids)].tolist()
+    last = len(ids) - 1 if end is not None else None
+    best, best_perm = INF, None
+    for perm in permutations(range(1, len(nodes) + 1)):
+        c = sub[0][perm[0]]
+        for a, b in zip(perm, perm[1:]):
+            c += sub[a][b]
+        if last is not None:
+            c += sub[perm[-1]][last]
+        if c < best:
+            best, best_perm = c, perm
+    if best_perm is None:
+        return INF, nodes
+    return best, [nodes[i - 1] for i in best_perm]
+
+
+def _held_karp(cost: np.ndarray, groups: Sequence[Sequence[int]], start: int, end: int,
+               deadline: float = INF) -> Optional[Solution]:
+    """Exact solution, or None if time.perf_counter() passes deadline first."""
+    g = len(groups)
+    nodes = np.array([n for grp in groups for n in grp], dtype=int)
+    members = []
+    pos = 0
+    for grp in groups:
+        members.append(np.arange(pos, pos + len(grp)))
+        pos += len(grp)
+    sub = cost[np.ix_(nodes, nodes)]
+    full = (1 << g) - 1
+    dp = np.full((full + 1, len(nodes)), INF)
+    parent = np.full((full + 1, len(nodes)), -1, dtype=np.int32)
+    for gi in range(g):
+        dp[1 << gi, members[gi]] = cost[start, nodes[members[gi]]]
+
+    for mask in range(1, full + 1):
+        row = dp[mask]
+        live = np.flatnonzero(row < INF)
+        if live.size == 0 or mask == full:
+            continue
+        if time.perf_counter() >= deadline:
+            return None
+        for gi in range(g):
+            if mask & (1 << gi):
+                continue
+            cols = members[gi]
+            vals = row[live, None] + sub[np.ix_(live, cols)]
+            arg = np.argmin(vals, axis=0)
+            best = vals[arg, np.arange(len(cols))]
+            nxt = mask | (1 << gi)
+            better = best < dp[nxt, cols]
+            if better.any():
+                dp[nxt, cols[better]] = best[better]
+                parent[nxt, cols[better]] = live[arg[better]]
+
+    final = dp[full] + cost[nodes, end]
+    last = int(np.argmin(final))
+    total = float(final[last])
+    if total == INF:
+        return Solution(INF, [], [], True)
+    order = []
+    mask = full
+    while last >= 0:
+        order.append(int(nodes[last]))
+        prev = int(parent[mask, last])
+        gi = next(i for i, m in enumerate(members) if last in m)
+        mask &= ~(1 << gi)
+        last = prev
+    order.reverse()
+    return Solution(total, order, _selection(order, groups), True)
+
+
+def _selection(order: Sequence[int], groups: Sequence[Sequence[int]]) -> List[int]:
+    chosen = set(order)
+    return [next(n for n in grp if n in chosen) for grp in groups]
+
+
+class _Search:
+    """Heuristic GTSP search state; tours are lists of node ids between fixed start and end."""
+
+    def __init__(self, cost, groups, start, end, rng):
+        self.cost = cost
+        self.groups = [list(g) for g in groups]
+        self.start = start
+        self.end = end
+        self.rng = rng
+        self.noise = np.random.default_rng(rng.randrange(2 ** 32))
+        self.group_of = {}
+        for gi, grp in enumerate(self.groups):
+            for n in grp:
+                self.group_of[n] = gi
+        self.seen: Dict[Tuple[int, ...], Tuple[float, List[int]]] = {}
+
+    def tour_cost(self, order):
+        return path_cost(self.cost, self.start, order, self.end)
+
+    def record(self, order, cost):
+        key = tuple(sorted(order))
+        if cost < self.seen.get(key, (INF, None))[0]:
+            self.seen[key] = (cost, list(order))
+
+    def insert_groups(self, order, group_ids, randomized=False):
+        """
+        Cheapest insertion: repeatedly add the (group, node, position) with the smallest cost
+        increase. randomized: add the groups in random order instead, each at its cheapest
+        (node, position) by costs scaled with up to INSERTION_NOISE random noise, for
+        varied tours.
+        """
+        order = list(order)
+        remaining = list(group_ids)
+        self.rng.shuffle(remaining)
+        c = self.cost
+        while remaining:
+            seq = np.array([self.start] + order + [self.end])
+            prev, nxt = seq[:-1], seq[1:]
+            base = c[prev, nxt]
+            best = (INF, None, None, None)
+            for gi in remaining[:1] if randomized else remaining:
+                cand = np.array(self.groups[gi])
+                delta = c[prev][:, cand] + c[cand][:, nxt].T - base[:, None]
+                delta[np.isnan(delta)] = INF
+                if randomized:
+                    delta = delta * (1 + INSERTION_NOISE * self.noise.random(delta.shape))
+                p, k = np.unravel_index(np.argmin(delta), delta.shape)
+                if delta[p, k] < best[0]:
+                    best = (delta[p, k], gi, int(cand[k]), int(p))
+            if best[1] is None:
+                # Nothing insertable at finite cost; place the first candidate at the end
+                gi = remaining[0]
+                best = (INF, gi, self.groups[gi][0], len(order))
+            _, gi, node, p = best
+            order.insert(p, node)
+            remaining.remove(gi)
+        return order
+
+    def local_search(self, order, deadline, reselect=True):
+        cur = self.tour_cost(order)
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            n = len(order)
+            # Candidate re-selection within each group
+            for i in range(n if reselect else 0):
+                for alt in self.groups[self.group_of[order[i]]]:
+                    if alt == order[i]:
+                        continue
+                    trial = order[:i] + [alt] + order[i + 1:]
+                    tc = self.tour_cost(trial)
+                    if tc < cur - 1e-9:
+                        order, cur, improved = trial, tc, True
+            # 2-opt (segment reversal; costs may be asymmetric so evaluate the whole tour)
+            for i in range(n - 1):
+                for j in range(i + 1, n):
+                    trial = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                    tc = self.tour_cost(trial)
+                    if tc < cur - 1e-9:
+                        order, cur, improved = trial, tc, True
+            # Or-opt: move a segment of 1-3 stops elsewhere
+            for seg in (1, 2, 3):
+                for i in range(n - seg + 1):
+                    segment = order[i:i + seg]
+                    rest = order[:i] + order[i + seg:]
+                    for j in range(len(rest) + 1):
+                        if j == i:
+                            continue
+                        trial = rest[:j] + segment + rest[j:]
+                        tc = self.tour_cost(trial)
+                        if tc < cur - 1e-9:
+                            order, cur, improved = trial, tc, True
+                            break
+            self.record(order, cur)
+        return order, cur
+
+    def run(self, deadline, max_iterations):
+        order = self.insert_groups([], range(len(self.groups)))
+        order, cur = self.local_search(order, deadline)
+        self.record(order, cur)
+        best_order, best = order, cur
+        g = len(self.groups)
+        it = 0
+        while it < max_iterations and time.perf_counter() < deadline and g > 1:
+            it += 1
+            # Large-neighbourhood step: drop some groups (up to all of them) and re-insert them,
+            # half the time with noisy costs. Greedy re-insertion alone mostly rebuilds the same
+            # tour, which leaves small instances in the first local optimum
+            k = self.rng.randint(1, g)
+            drop = set(self.rng.sample(range(g), k))
+            kept = [n for n in best_order if self.group_of[n] not in drop]
+            trial = self.insert_groups(kept, drop, randomized=self.rng.random() < 0.5)
+            trial, tc = self.local_search(trial, deadline)
+            self.record(trial, tc)
+            if tc < best - 1e-9:
+                best_order, best = trial, tc
+        return best_order, best
+
+
+def solve(cost: np.ndarray, groups: Sequence[Sequence[int]], start: int = 0, end: Optional[int] = None,
+          time_limit: float = 1.0, exact_max_groups: int = 10, max_iterations: int = 200,
+          seed: int = 0) -> Solution:
+    """
+    Choose one node from each group and a visiting order minimizing the trip cost.
+
+    Uses exact Held-Karp when there are at most exact_max_groups groups, otherwise (or
+    when Held-Karp has not finished within EXACT_TIME_SHARE of time_limit) the heuristic
+    search, which stops after time_limit seconds or max_iterations LNS steps.
+    """
+    groups = [list(g) for g in groups if len(g)]
+    if not groups:
+        return Solution(path_cost(cost, start, [], end), [], [], True)
+    t0 = time.perf_counter()
+    aug, end_idx = _augment(np.asarray(cost, dtype=float), end)
+    if len(groups) <= exact_max_groups:
+        exact = _held_karp(aug, groups, start, end_idx, deadline=t0 + time_limit * EXACT_TIME_SHARE)
+        if exact is not None:
+            return exact
+    search = _Search(aug, groups, start, end_idx, random.Random(seed))
+    order, total = search.run(t0 + time_limit, max_iterations)
+    return Solution(total, order, _selection(order, groups), False)
+
+
+def rank_selections(cost: np.ndarray, groups: Sequence[Sequence[int]], k: int = 5, start: int = 0,
+                    end: Optional[int] = None, max_enumerate: int = 256, time_limit: float = 1.0,
+                    exact_max_groups: int = 10, seed: int = 0) -> List[Solution]:
+    """
+    The k cheapest distinct selections (one node per group), each with its best order.
+
+    With at most max_enumerate selections (and few groups) every one is ordered exactly. Otherwise
+    the best solution is found with solve()'s machinery and the alternatives are its
+    one-swap neighbours (one group switched to another candidate, then re-ordered).
+    """
+    groups = [list(g) for g in groups if len(g)]
+    total = 1
+    for grp in groups:
+        total *= len(grp)
+    cost = np.asarray(cost, dtype=float)
+    if total <= max_enumerate and len(groups) <= PERMUTATION_MAX_NODES:
+        out = []
+        for combo in product(*groups):
+            c, order = best_order(cost, list(combo), start=start, end=end)
+            if c < INF:
+                out.append(Solution(c, order, list(combo), True))
+        out.sort(key=lambda s: s.cost)
+        return out[:k]
+
+    t0 = time.perf_counter()
+    aug, end_idx = _augment(cost, end)
+    search = _Search(aug, groups, start, end_idx, random.Random(seed))
+    exact = None
+    if len(groups) <= exact_max_groups:
+        exact = _held_karp(aug, groups, start, end_idx, deadline=t0 + time_limit * EXACT_TIME_SHARE)
+    if exact is not None:
+        best, best_cost = exact.order, exact.cost
+    else:
+        best, best_cost = search.run(t0 + time_limit * 0.7, max_iterations=10 ** 9)
+    if best_cost == INF:
+        return []
+    search.record(best, best_cost)
+    deadline = t0 + time_limit
+    for gi, grp in enumerate(groups):
+        for alt in grp:
+            if alt in best or time.perf_counter() >= deadline:
+                continue
+            trial = [alt if search.group_of[n] == gi else n for n in best]
+            trial, tc = search.local_search(trial, deadline, reselect=False)
+            search.record(trial, tc)
+    proven = exact is not None
+    ranked = sorted(search.seen.values(), key=lambda x: x[0])[:k]
+    return [Solution(c, order, _selection(order, groups), proven and order == best) for c, order in ranked if c < INF]
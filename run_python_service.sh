@@ -0,0 +1,5 @@
+#!/bin/sh
+# Production server: pre-forked gunicorn workers (see gunicorn.conf.py), configured from the environment / .env.
+# run_python_service.bat starts the single-process development server instead (gunicorn does not run on Windows)
+cd "$(dirname "$0")"
+exec gunicorn -c gunicorn.conf.py
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Settings for the Python agent service, read once from the environment.
+
+Import this module before anything that reads os.environ so that .env is
+loaded first (values in .env override the system environment).
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+SUDO_API_KEY = os.getenv("SUDO_API_KEY", "")
+SUDO_URL = os.getenv("GEMINI_API_URL", "https://sudoapp.dev/api/v1/chat/completions")
+MAPBOX_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN", "")
+
+# Shared keep-alive HTTP clients (see http_clients)
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.3"))
+# Flask mode: threads running the blocking upstream calls of every request in a worker. A call its
+# request no longer waits for (a hedge loser, one cut off at the deadline) keeps its thread until it ends
+UPSTREAM_THREADS = int(os.getenv("UPSTREAM_THREADS", "64"))
+
+# "concurrent" fans out the per-task Gemini lookup + geocoding; "serial" runs tasks one by one
+TASK_EXECUTION_MODE = os.getenv("TASK_EXECUTION_MODE", "concurrent").lower()
+TASK_CONCURRENCY = int(os.getenv("TASK_CONCURRENCY", "5"))
+# Bulk geocoding of LLM-supplied addresses: parallel single lookups, or one batch call when a URL is set
+GEOCODE_CONCURRENCY = int(os.getenv("GEOCODE_CONCURRENCY", "8"))
+MAPBOX_BATCH_GEOCODE_URL = os.getenv("MAPBOX_BATCH_GEOCODE_URL", "")
+GEOCODE_BATCH_SIZE = int(os.getenv("GEOCODE_BATCH_SIZE", "50"))
+# Stage 5 route evaluation: "matrix" scores every combination locally from one travel matrix,
+# "trips" calls optimized-trips once per combination
+ROUTE_EVALUATION_MODE = os.getenv("ROUTE_EVALUATION_MODE", "matrix").lower()
+MATRIX_MAX_COORDS = int(os.getenv("MATRIX_MAX_COORDS", "10"))  # driving-traffic limit
+# Candidates asked from Gemini per task, how many survive detour pruning, and the max distance from start
+CANDIDATES_PER_TASK = int(os.getenv("CANDIDATES_PER_TASK", "5"))
+CANDIDATES_KEEP = int(os.getenv("CANDIDATES_KEEP", "3"))
+CANDIDATE_PRUNE_RADIUS_M = float(os.getenv("CANDIDATE_PRUNE_RADIUS_M", "25000"))
+TRIPS_MAX_CANDIDATES = int(os.getenv("TRIPS_MAX_CANDIDATES", "2"))
+# route_solver knobs for matrix mode: heuristic time budget (seconds) and the largest task count solved exactly
+SOLVER_TIME_LIMIT = float(os.getenv("SOLVER_TIME_LIMIT", "0.5"))
+SOLVER_EXACT_MAX_GROUPS = int(os.getenv("SOLVER_EXACT_MAX_GROUPS", "10"))
+
+# Async service mode (async_service.py)
+ASYNC_HOST = os.getenv("ASYNC_HOST", "0.0.0.0")
+ASYNC_PORT = int(os.getenv("ASYNC_PORT", os.getenv("PY_AGENT_PORT", "5050")))
+
+# Structured logging (service_logging): JSON lines to stderr and/or LOG_FILE, written by a background thread.
+# Request bodies, LLM replies and other payloads are logged for a LOG_PAYLOAD_SAMPLE_RATE fraction of
+# requests and truncated to LOG_PAYLOAD_MAX_CHARS; records beyond LOG_QUEUE_SIZE are dropped, not waited on
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "debug.log")
+LOG_STDERR = os.getenv("LOG_STDERR", "true").lower() in ("1", "true", "yes")
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Share one in-flight upstream call between concurrent identical requests (single_flight)
+UPSTREAM_SINGLE_FLIGHT = os.getenv("UPSTREAM_SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+
+# Stage 1/2 address finding: "batched" asks Gemini for every task in one call (tasks missing from the
+# answer fall back to their own call); "per-task" makes one call per task
+ADDRESS_FINDER_MODE = os.getenv("ADDRESS_FINDER_MODE", "batched").lower()
+# Read Gemini completions as a stream and start geocoding each address as soon as it is written
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() in ("1", "true", "yes")
+
+# Per-request latency budget (deadline): every stage and upstream call gets only the time that is left,
+# and when it runs out the response carries whatever was finished, flagged "partial". A caller may ask
+# for less (or more, up to REQUEST_BUDGET_MAX_MS) with "budgetMs" in the body; 0 disables the budget.
+REQUEST_BUDGET_MS = int(os.getenv("REQUEST_BUDGET_MS", "12000"))
+REQUEST_BUDGET_MAX_MS = int(os.getenv("REQUEST_BUDGET_MAX_MS", "30000"))
+# Budget kept back from candidate lookup for route evaluation, and from route evaluation for the response
+ROUTE_EVALUATION_RESERVE_MS = int(os.getenv("ROUTE_EVALUATION_RESERVE_MS", "2500"))
+RESPONSE_RESERVE_MS = int(os.getenv("RESPONSE_RESERVE_MS", "150"))
+# Average driving speed used for straight-line route estimates when routing data is out of time
+ESTIMATE_SPEED_MPS = float(os.getenv("ESTIMATE_SPEED_MPS", "11"))
+# Hedged geocoding and optimized-trips calls (hedging): a duplicate request is sent once a call has taken
+# longer than the HEDGE_PERCENTILE latency seen recently, at most HEDGE_MAX_RATIO of calls
+UPSTREAM_HEDGING = os.getenv("UPSTREAM_HEDGING", "true").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_INITIAL_DELAY_MS = float(os.getenv("HEDGE_INITIAL_DELAY_MS", "800"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "50"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+
+# Cache of complete /optimize-route results (plan_cache): "memory" (per process), "disk" (SQLite at
+# PLAN_CACHE_PATH, shared by workers) or "off". Starts within the same PLAN_CACHE_BUCKET_DEG grid cell share
+# entries; an entry lasts until the end of its traffic window (PLAN_CACHE_WINDOWS: hours in
+# PLAN_CACHE_TIMEZONE where a window starts, weekdays and weekends apart), at most PLAN_CACHE_TTL seconds
+PLAN_CACHE_BACKEND = os.getenv("PLAN_CACHE_BACKEND", "memory").lower()
+PLAN_CACHE_PATH = os.getenv("PLAN_CACHE_PATH", "plan_cache.sqlite3")
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "500"))
+PLAN_CACHE_MAX_BYTES = int(os.getenv("PLAN_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PLAN_CACHE_TTL = int(os.getenv("PLAN_CACHE_TTL", "3600"))
+PLAN_CACHE_BUCKET_DEG = float(os.getenv("PLAN_CACHE_BUCKET_DEG", "0.01"))
+PLAN_CACHE_TIMEZONE = os.getenv("PLAN_CACHE_TIMEZONE", "America/Los_Angeles")
+PLAN_CACHE_WINDOWS = os.getenv("PLAN_CACHE_WINDOWS", "0,6,10,15,19")
+
+# Pairwise travel-leg cache (leg_cache) filled from trips, matrix and directions responses: combinations
+# whose legs are all known are costed without API calls. Coordinates are rounded to LEG_CACHE_PRECISION decimals
+LEG_CACHE = os.getenv("LEG_CACHE", "true").lower() in ("1", "true", "yes")
+LEG_CACHE_PRECISION = int(os.getenv("LEG_CACHE_PRECISION", "4"))
+LEG_CACHE_MAX_ENTRIES = int(os.getenv("LEG_CACHE_MAX_ENTRIES", "200000"))
+
+# /optimize-route geometry output (route_geometry): "full" (GeoJSON and complete steps), or "high", "medium",
+# "low" for polyline6 geometry simplified to ROUTE_SIMPLIFY_PX pixels at that level's zoom, with trimmed steps
+# ("low": none). Requests pick a level with the "fidelity" query parameter
+ROUTE_FIDELITY = os.getenv("ROUTE_FIDELITY", "full").lower()
+ROUTE_SIMPLIFY_PX = float(os.getenv("ROUTE_SIMPLIFY_PX", "1.0"))
+
+# Production server (gunicorn.conf.py): SERVER_APP "flask" (python_agent_service on threaded workers) or
+# "async" (async_service on aiohttp workers), WEB_CONCURRENCY pre-forked workers sharing the preloaded app,
+# SERVER_THREADS request threads per flask worker. A worker is replaced after SERVER_MAX_REQUESTS requests
+# (plus up to SERVER_MAX_REQUESTS_JITTER, so they do not all restart together); on reload or shutdown
+# workers get SERVER_GRACEFUL_TIMEOUT seconds to finish their requests. Binds where async_service listens
+SERVER_APP = os.getenv("SERVER_APP", "flask").lower()
+SERVER_BIND = os.getenv("SERVER_BIND", f"{ASYNC_HOST}:{ASYNC_PORT}")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))
+SERVER_PRELOAD = os.getenv("SERVER_PRELOAD", "true").lower() in ("1", "true", "yes")
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", "2000"))
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", "200"))
+SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", "60"))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", "5"))
+
+# Background jobs for /optimize-route (/jobs, see jobs): at most JOB_WORKERS plans run at a time per process,
+# at most JOB_BATCH_WORKERS of them "batch" jobs, so "interactive" ones (the default) always find a worker.
+# Each class queues at most JOB_QUEUE_INTERACTIVE / JOB_QUEUE_BATCH jobs; further submissions get a 429 with
+# Retry-After. Job records (and results) are kept JOB_RETENTION seconds in JOB_STORE: "disk" (SQLite at
+# JOB_STORE_PATH, seen by every worker process) or "memory" (the accepting process only)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_BATCH_WORKERS = int(os.getenv("JOB_BATCH_WORKERS", "2"))
+JOB_QUEUE_INTERACTIVE = int(os.getenv("JOB_QUEUE_INTERACTIVE", "16"))
+JOB_QUEUE_BATCH = int(os.getenv("JOB_QUEUE_BATCH", "256"))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", "900"))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "5000"))
+JOB_STORE = os.getenv("JOB_STORE", "disk").lower()
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.sqlite3")
+# How often a job stream served by another worker than the job's re-reads the job store
+JOB_POLL_INTERVAL_MS = int(os.getenv("JOB_POLL_INTERVAL_MS", "500"))
+
+# Upstream rate limiting (rate_limit): a token bucket per upstream endpoint, RATE_LIMITS "endpoint:requests per
+# minute" (Mapbox's default account limits; llm: the Sudo endpoint), bursting up to RATE_LIMIT_BURST_SECONDS of
+# the rate. RATE_LIMIT_BACKEND "disk" shares the buckets with every worker through SQLite at RATE_LIMIT_PATH,
+# "memory" keeps them per process, "off" disables limiting. Each endpoint's concurrency per process adapts between
+# RATE_LIMIT_MIN_CONCURRENCY and RATE_LIMIT_MAX_CONCURRENCY; a 429 pauses the endpoint for every worker until its
+# Retry-After (RATE_LIMIT_PAUSE_SECONDS without one), and 429s are retried through the limiter, not the HTTP client
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "disk").lower()
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "rate_limit.sqlite3")
+RATE_LIMITS = os.getenv("RATE_LIMITS", "geocode:600,trips:300,directions:300,matrix:60,llm:300")
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "5"))
+RATE_LIMIT_MAX_CONCURRENCY = int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", "16"))
+RATE_LIMIT_MIN_CONCURRENCY = int(os.getenv("RATE_LIMIT_MIN_CONCURRENCY", "1"))
+RATE_LIMIT_PAUSE_SECONDS = float(os.getenv("RATE_LIMIT_PAUSE_SECONDS", "1"))
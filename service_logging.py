@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Structured, non-blocking logging for the agent service.
+
+Call sites log one event per stage with keyword fields:
+
+    log = service_logging.get_logger("pipeline")
+    service_logging.event(log, "geocode.done", addresses=12, ms=84.1)
+
+Records are rendered as JSON lines in the calling thread and handed to a bounded
+queue; a QueueListener thread does the file/stderr writes, so request threads
+never block on I/O (when the queue is full the record is dropped and counted).
+
+Every record carries the current request id (see begin_request). Bulky values go
+through payload(), which returns them truncated for the sampled fraction of
+requests and None (field omitted) for the rest.
+
+A forked child (a pre-forked server worker) gets a fresh queue and writer
+thread: threads do not survive fork.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+import service_config as config
+
+ROOT = "bestpath"
+
+# (request id, payloads sampled) for the request being handled in this context
+_request = contextvars.ContextVar("service_logging_request", default=(None, False))
+_listener = None
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["requestId"] = record.request_id
+        for key, value in (getattr(record, "fields", None) or {}).items():
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render now, while the fields still hold this moment's values; the
+        # listener only writes the finished line
+        line = self.format(record)
+        record = logging.makeLogRecord({"name": record.name, "levelno": record.levelno, "levelname": record.levelname})
+        record.msg = line
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup():
+    """Attach the queue handler to the service's root logger and start the writer thread (idempotent)."""
+    global _listener, _handler
+    if _handler is not None:
+        return
+    root = logging.getLogger(ROOT)
+    root.setLevel(getattr(logging, config.LOG_LEVEL, logging.INFO))
+    root.propagate = False
+
+    sinks = []
+    if config.LOG_STDERR:
+        sinks.append(logging.StreamHandler(sys.stderr))
+    if config.LOG_FILE:
+        sinks.append(logging.FileHandler(config.LOG_FILE, encoding="utf-8"))
+    for sink in sinks:
+        sink.setFormatter(logging.Formatter("%(message)s"))
+
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=max(1, config.LOG_QUEUE_SIZE)))
+    _handler.setFormatter(JsonFormatter())
+    root.addHandler(_handler)
+    _listener = logging.handlers.QueueListener(_handler.queue, *sinks, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    # The parent's writer thread is gone in the child and its queue may be mid-use; start over
+    global _listener, _handler
+    if _handler is None:
+        return
+    logging.getLogger(ROOT).removeHandler(_handler)
+    _listener = _handler = None
+    setup()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def get_logger(name):
+    setup()
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def begin_request(request_id=None):
+    """Start a request context: assign an id and decide whether its payloads are logged."""
+    request_id = request_id or uuid.uuid4().hex[:12]
+    _request.set((request_id, random.random() < config.LOG_PAYLOAD_SAMPLE_RATE))
+    return request_id
+
+
+def request_id():
+    return _request.get()[0]
+
+
+def _plain(obj):
+    # Model objects (see models) log as their wire form, anything else as str()
+    return obj.to_dict() if hasattr(obj, "to_dict") else str(obj)
+
+
+def payload(value, max_chars=None):
+    """value (as text, truncated) if this request is sampled for payload logging, else None."""
+    if not _request.get()[1]:
+        return None
+    max_chars = max_chars or config.LOG_PAYLOAD_MAX_CHARS
+    text = value if isinstance(value, str) else json.dumps(value, default=_plain)
+    if len(text) > max_chars:
+        return f"{text[:max_chars]}...(+{len(text) - max_chars} chars)"
+    return text
+
+
+def event(logger, name, level=logging.INFO, /, exc_info=None, **fields):
+    """Log a structured event; fields with None values are left out."""
+    if logger.isEnabledFor(level):
+        logger.log(level, name, exc_info=exc_info, extra={"fields": fields, "request_id": request_id()})
+
+
+def ms_since(t0):
+    return round((time.perf_counter() - t0) * 1000, 1)
+
+
+def stats():
+    return {
+        "level": logging.getLevelName(logging.getLogger(ROOT).level),
+        "queued": _handler.queue.qsize() if _handler is not None else 0,
+        "dropped": _handler.dropped if _handler is not None else 0,
+        "payloadSampleRate": config.LOG_PAYLOAD_SAMPLE_RATE,
+    }
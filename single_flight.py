@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical in-flight upstream calls.
+
+Concurrent callers that ask for the same key while a call for it is running
+wait for that call and share its outcome instead of issuing their own. It works
+across threads and event loops (the Flask mode runs one event loop per request
+thread), because the shared outcome lives in a concurrent.futures.Future.
+
+- The first caller (the leader) runs the call; its exception is raised in every
+  waiter too.
+- A waiter that is cancelled just stops waiting; the call keeps going for the others.
+- If the leader is cancelled, or fails with one of the `abandon` exception types
+  (errors that are about the leader rather than the call, like its own deadline
+  running out), the call is abandoned and the remaining waiters retry, so one of
+  them becomes the new leader.
+
+Nothing is remembered once the call completes - this is not a cache.
+"""
+import asyncio
+import copy
+import threading
+from concurrent.futures import Future
+
+
+class _LeaderCancelled(Exception):
+    """Set on a call's future when its leader was cancelled or abandoned the call."""
+
+
+def _consume(waiter):
+    # Nobody awaits a cancelled caller's waiter any more; retrieve its outcome so
+    # asyncio does not report an unretrieved exception
+    if not waiter.cancelled():
+        waiter.exception()
+
+
+class SingleFlight:
+    def __init__(self, abandon=()):
+        self.abandon = tuple(abandon)
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, fetch, share=copy.deepcopy):
+        """
+        Return await fetch() for key, or the outcome of an identical call already in flight.
+        Waiters get share(result) (a deep copy by default) so callers can't mutate each
+        other's results.
+        """
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+                    self.leaders += 1
+                else:
+                    self.shared += 1
+            if leader:
+                return await self._lead(key, future, fetch)
+            waiter = asyncio.wrap_future(future)
+            try:
+                # shield: a cancelled waiter must not cancel the shared future
+                result = await asyncio.shield(waiter)
+            except _LeaderCancelled:
+                continue
+            except asyncio.CancelledError:
+                waiter.add_done_callback(_consume)
+                raise
+            return share(result) if share else result
+
+    async def _lead(self, key, future, fetch):
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            self._finish(key, future, exception=_LeaderCancelled())
+            raise
+        except self.abandon:
+            self._finish(key, future, exception=_LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def _finish(self, key, future, result=None, exception=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"calls": self.leaders, "coalesced": self.shared, "inFlight": in_flight}
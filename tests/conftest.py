@@ -0,0 +1,13 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# No cache files, log files or log output from the service modules under test
+os.environ.setdefault("GEOCODE_CACHE_PATH", "")
+os.environ.setdefault("LLM_CACHE_BACKEND", "off")
+os.environ.setdefault("PLAN_CACHE_BACKEND", "off")
+os.environ.setdefault("JOB_STORE", "memory")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "memory")
+os.environ.setdefault("LOG_FILE", "")
+os.environ.setdefault("LOG_STDERR", "false")
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import route_pipeline
+from models import Task
+from route_pipeline import parse_batched_addresses, stream_addresses_batched
+
+START = {"name": "Home", "address": "San Ramon, CA", "latitude": 37.78, "longitude": -121.98}
+
+
+@pytest.mark.parametrize("content, expected", [
+    ('{"0": ["a"], "1": ["b"], "2": ["c"]}', {0: ["a"], 1: ["b"], 2: ["c"]}),
+    # Zero-based, task 0 or the last task missing
+    ('{"0": ["a"], "1": ["b"]}', {0: ["a"], 1: ["b"]}),
+    ('{"0": ["a"], "2": ["c"]}', {0: ["a"], 2: ["c"]}),
+    ('```json\n{"task 0": ["a"], "task 1": ["b"],}\n```', {0: ["a"], 1: ["b"]}),
+    ('{"tasks": {"0": ["a"], "1": {"addresses": ["b"]}}}', {0: ["a"], 1: ["b"]}),
+    ('[["a"], ["b"], ["c"]]', {0: ["a"], 1: ["b"], 2: ["c"]}),
+    ('[{"task": 1, "addresses": ["b"]}, {"task": 0, "addresses": ["a"]}]', {0: ["a"], 1: ["b"]}),
+    ('Here: "0": ["a"], "1": ["b"] and "2": [oops', {0: ["a"], 1: ["b"]}),
+    ('{"0": "not a list", "1": ["b"], "7": ["x"]}', {1: ["b"]}),
+])
+def test_parse_zero_based(content, expected):
+    assert parse_batched_addresses(content, 3) == expected
+
+
+@pytest.mark.parametrize("content, expected", [
+    ('{"1": ["a"], "2": ["b"], "3": ["c"]}', {0: ["a"], 1: ["b"], 2: ["c"]}),
+    # One-based with the first task missing: key 3 still gives it away
+    ('{"2": ["b"], "3": ["c"]}', {1: ["b"], 2: ["c"]}),
+])
+def test_parse_one_based(content, expected):
+    assert parse_batched_addresses(content, 3) == expected
+
+
+def test_parse_rejects_ambiguous_numbering():
+    # One-based without the last task, or zero-based without the first: the same keys
+    assert parse_batched_addresses('{"1": ["a"], "2": ["b"]}', 3) == {}
+
+
+class StreamingUpstream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def sudo_chat_stream(self, messages):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def stream(content, n=3):
+    tasks = [Task(t) for t in ("grocery", "gym", "pharmacy")[:n]]
+    got = []
+    chunks = [content[i:i + 7] for i in range(0, len(content), 7)]
+    found, shift = asyncio.run(stream_addresses_batched(
+        tasks, START, StreamingUpstream(chunks), lambda i, addr: got.append((i, addr))))
+    return [f[0] if f else None for f in found], shift, got
+
+
+@pytest.fixture(autouse=True)
+def candidates_per_task(monkeypatch):
+    monkeypatch.setattr(route_pipeline.config, "CANDIDATES_PER_TASK", 5)
+
+
+def test_stream_zero_based():
+    found, shift, got = stream('{"0": ["a1", "a2"], "1": ["b"]}')
+    assert found == [["a1", "a2"], ["b"], None]
+    assert shift == 0
+    assert got == [(0, "a1"), (0, "a2"), (1, "b")]
+
+
+def test_stream_one_based():
+    found, shift, got = stream('{"1": ["a"], "2": ["b"], "3": ["c"]}')
+    assert found == [["a"], ["b"], ["c"]]
+    assert shift == 1
+    assert [(i - shift, addr) for i, addr in got] == [(0, "a"), (1, "b"), (2, "c")]
+
+
+def test_stream_rejects_ambiguous_numbering():
+    found, shift, got = stream('{"1": ["a"], "2": ["b"]}')
+    assert found == [None, None, None]
+    assert shift is None
+
+
+def test_stream_list_of_arrays_goes_through_the_parser():
+    found, shift, got = stream('[["a"], ["b"], ["c"]]')
+    assert found == [["a"], ["b"], ["c"]]
+    assert shift == 0
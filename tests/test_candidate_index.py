@@ -0,0 +1,69 @@
+import random
+
+import numpy as np
+import pytest
+
+from candidate_index import KDTree, project, prune_candidates
+
+START = {"latitude": 37.78, "longitude": -121.98}
+
+
+def random_candidates(seed, spread=0.4):
+    rng = random.Random(seed)
+    return [
+        [{"latitude": 37.78 + rng.uniform(-spread, spread), "longitude": -121.98 + rng.uniform(-spread, spread),
+          "name": f"task {t} place {i}"} for i in range(rng.randint(0, 25))]
+        for t in range(rng.randint(1, 4))
+    ]
+
+
+def brute_force_prune(start, candidates_per_task, keep, radius_meters):
+    projected = [project([c["latitude"] for c in locs], [c["longitude"] for c in locs],
+                         start["latitude"], start["longitude"]) for locs in candidates_per_task]
+    out = []
+    for t, locs in enumerate(candidates_per_task):
+        scored = []
+        for i, p in enumerate(projected[t]):
+            detour = float(np.hypot(*p))
+            for u, other in enumerate(projected):
+                if u != t and len(other):
+                    detour += min(float(np.hypot(*(p - q))) for q in other)
+            scored.append((detour, i))
+        inside = [(d, i) for d, i in scored if not radius_meters or np.hypot(*projected[t][i]) <= radius_meters]
+        if not inside and scored:
+            inside = [min(scored, key=lambda x: np.hypot(*projected[t][x[1]]))]
+        out.append([locs[i] for _, i in sorted(inside)[:keep]])
+    return out
+
+
+@pytest.mark.parametrize("seed", range(30))
+@pytest.mark.parametrize("radius", [None, 5000, 25000])
+def test_prune_matches_brute_force(seed, radius):
+    candidates = random_candidates(seed)
+    pruned, report = prune_candidates(START, candidates, keep=3, radius_meters=radius)
+    assert pruned == brute_force_prune(START, candidates, 3, radius)
+    for locs, kept, entry in zip(candidates, pruned, report):
+        assert entry["found"] == len(locs)
+        assert entry["kept"] == len(kept)
+
+
+def test_task_outside_the_radius_keeps_its_nearest_candidate():
+    far = [{"latitude": 38.5, "longitude": -121.98}, {"latitude": 38.4, "longitude": -121.98}]
+    pruned, report = prune_candidates(START, [far], keep=3, radius_meters=1000)
+    assert pruned == [[far[1]]]
+    assert report[0]["inRadius"] == 1
+
+
+def test_kdtree_queries_match_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-5000, 5000, size=(500, 2))
+    tree = KDTree(points)
+    for q in rng.uniform(-6000, 6000, size=(50, 2)):
+        d = np.hypot(*(points - q).T)
+        dist, idx = tree.nearest(q)
+        assert dist == pytest.approx(d.min())
+        assert d[idx] == pytest.approx(d.min())
+        assert sorted(tree.within(q, 1500)) == sorted(np.flatnonzero(d <= 1500).tolist())
+    empty = KDTree(np.empty((0, 2)))
+    assert empty.nearest((0, 0)) == (np.inf, -1)
+    assert empty.within((0, 0), 100) == []
@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+import pytest
+
+import deadline
+import route_pipeline
+from geo_kernels import haversine
+from models import Task
+
+
+def test_no_budget_means_no_limits():
+    async def main():
+        deadline.begin(None)
+        assert deadline.remaining() is None
+        assert deadline.timeout(20) == 20
+        with deadline.limit(5):
+            assert deadline.remaining() is None
+        assert await deadline.bounded(asyncio.sleep(0.01, "done")) == "done"
+        return deadline.missed()
+
+    assert asyncio.run(main()) == []
+
+
+def test_timeout_and_limit():
+    async def main():
+        deadline.begin(10)
+        assert deadline.timeout(20) == pytest.approx(10, abs=0.1)
+        assert deadline.timeout(3) == 3
+        with deadline.limit(4):
+            assert deadline.remaining() == pytest.approx(6, abs=0.1)
+            deadline.note("tasks")
+            with deadline.limit(10):
+                # More reserve than is left: nothing remains for this stage
+                assert deadline.expired()
+                with pytest.raises(deadline.DeadlineExceeded):
+                    deadline.timeout(20)
+        # Back to the request's deadline; stages noted inside limits are kept
+        assert deadline.remaining() == pytest.approx(10, abs=0.1)
+        assert not deadline.expired()
+        return deadline.missed()
+
+    assert asyncio.run(main()) == ["tasks"]
+
+
+def test_deadline_is_per_task():
+    async def request(budget):
+        deadline.begin(budget)
+        await asyncio.sleep(0.01)
+        return deadline.remaining()
+
+    async def main():
+        return await asyncio.gather(request(None), request(5))
+
+    unbounded, bounded = asyncio.run(main())
+    assert unbounded is None
+    assert bounded == pytest.approx(5, abs=0.1)
+
+
+def test_bounded_gives_up_at_the_deadline():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        deadline.begin(0.05)
+        t0 = time.monotonic()
+        with pytest.raises(deadline.DeadlineExceeded):
+            await deadline.bounded(slow())
+        return time.monotonic() - t0
+
+    assert asyncio.run(main()) < 0.5
+    assert cancelled == [True]
+
+
+def test_gather_partial():
+    async def value(v, seconds=0.0):
+        await asyncio.sleep(seconds)
+        return v
+
+    async def out_of_time():
+        raise deadline.DeadlineExceeded()
+
+    async def main():
+        deadline.begin(0.1)
+        t0 = time.monotonic()
+        results = await deadline.gather_partial([value(1), value(2, 1.0), out_of_time(), value(4)], "geocode")
+        return results, time.monotonic() - t0, deadline.missed()
+
+    results, elapsed, missed = asyncio.run(main())
+    assert results == [1, None, None, 4]
+    assert elapsed < 0.5
+    assert missed == ["geocode"]
+
+
+def test_gather_partial_raises_other_errors():
+    async def fail():
+        raise ValueError("bad")
+
+    async def main():
+        deadline.begin(1)
+        assert await deadline.gather_partial([], "geocode") == []
+        with pytest.raises(ValueError):
+            await deadline.gather_partial([fail(), asyncio.sleep(0, 1)], "geocode")
+        return deadline.missed()
+
+    assert asyncio.run(main()) == []
+
+
+START = {"name": "Home", "address": "San Ramon, CA", "latitude": 37.78, "longitude": -121.98}
+CANDIDATES = [
+    [{"name": "Walmart", "address": "2551 San Ramon Valley Blvd", "latitude": 37.7796, "longitude": -121.9385},
+     {"name": "Safeway", "address": "2505 San Ramon Valley Blvd", "latitude": 37.7771, "longitude": -121.9780}],
+    [{"name": "24 Hour Fitness", "address": "2600 Camino Ramon", "latitude": 37.7726, "longitude": -121.9500}],
+]
+
+
+class SlowDirections:
+    """Matrix at once; the directions call for the best route is quick, every other one slow."""
+
+    def __init__(self):
+        self.directions = 0
+
+    async def travel_matrix(self, coords):
+        seconds = [[haversine(a[1], a[0], b[1], b[0]) / 10 for b in coords] for a in coords]
+        return {"durations": seconds, "distances": [[s * 10 for s in row] for row in seconds]}
+
+    async def directions_waypoints(self, coords, steps=False):
+        self.directions += 1
+        if self.directions > 1:
+            await asyncio.sleep(1)
+        legs = [{"distance": 1000.0, "duration": 100.0, "steps": []} for _ in coords[1:]]
+        return {"routes": [{"distance": 1000.0 * len(legs), "duration": 100.0 * len(legs), "legs": legs,
+                            "geometry": {"type": "LineString", "coordinates": [list(c) for c in coords]}}]}
+
+
+def test_slow_directions_are_missed_and_their_routes_estimated():
+    options = [{"task": Task("groceries"), "locations": CANDIDATES[0]}, {"task": Task("gym"), "locations": CANDIDATES[1]}]
+    up = SlowDirections()
+
+    async def main():
+        deadline.begin(0.2)
+        t0 = time.monotonic()
+        routes = await route_pipeline.evaluate_routes_matrix(START, CANDIDATES, options, up)
+        return routes, time.monotonic() - t0, deadline.missed()
+
+    routes, elapsed, missed = asyncio.run(main())
+    assert elapsed < 0.8
+    assert missed == ["routes"]
+    # One route per combination: the best from its directions call, the other estimated from the matrix
+    assert len(routes) == up.directions == 2
+    assert [r.estimated for r in routes] == [False, True]
+    assert routes[0].legs
+    for route in routes[1:]:
+        assert route.total_duration is not None and route.total_distance is not None
+        assert route.geometry[0] == route.geometry[-1] == [START["longitude"], START["latitude"]]
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+
+import pytest
+
+import geo_cache
+from geo_cache import GeoCache, canonical_query
+from llm_cache import MemoryBackend
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("San Ramon, CA", "san ramon california"),
+    ("San Ramon, CA 94583", "san ramon california"),
+    ("san ramon california 94583", "san ramon california"),
+    ("Sears, Chicago, IL, U.S.", "sears chicago illinois"),
+    ("Walmart Supercenter, 9100 Alcosta Blvd, San Ramon, CA 94583, USA",
+     "walmart supercenter 9100 alcosta blvd san ramon california"),
+])
+def test_canonical_query_normalizes_addresses(query, expected):
+    assert canonical_query(query) == expected
+
+
+@pytest.mark.parametrize("query, expected", [
+    # A trailing "us" / state code inside a business name is part of the name
+    ("Toys R Us", "toys r us"),
+    ("Toys R Us, San Ramon, CA, USA", "toys r us san ramon california"),
+    ("Shop In", "shop in"),
+    ("Pizza Hut OR", "pizza hut or"),
+    # Only the last part is a state: "Co" here is part of the name
+    ("Acme, Co, Denver", "acme co denver"),
+])
+def test_canonical_query_keeps_business_names(query, expected):
+    assert canonical_query(query) == expected
+
+
+def test_business_names_do_not_share_keys():
+    assert GeoCache.make_key("poi", "Toys R Us") != GeoCache.make_key("poi", "Toys R")
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("San Ramon, CA, 94583, USA", "san ramon california"),
+    ("San Ramon, CA 94583-1234", "san ramon california"),
+    ("94583", "94583"),
+    # A 5-digit house number is not a ZIP
+    ("Safeway, 11050 Bollinger Canyon Rd, San Ramon, CA 94583",
+     "safeway 11050 bollinger canyon rd san ramon california"),
+])
+def test_canonical_query_strips_only_a_trailing_zip(query, expected):
+    assert canonical_query(query) == expected
+
+
+def test_house_numbers_do_not_share_keys():
+    assert (GeoCache.make_key("geocode", "Safeway, 11050 Bollinger Canyon Rd, San Ramon, CA")
+            != GeoCache.make_key("geocode", "Safeway, 18000 Bollinger Canyon Rd, San Ramon, CA"))
+
+
+def test_get_set_and_expiry(tmp_path):
+    cache = GeoCache(str(tmp_path / "c.sqlite3"), ttl_seconds=60)
+    cache.set("a", {"lat": 1})
+    cache.set("b", [1, 2], ttl_seconds=-1)
+    assert cache.get("a") == {"lat": 1}
+    assert cache.get("b") is None
+    assert cache.get("missing") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_reads_do_not_write_until_a_batch(tmp_path, monkeypatch):
+    cache = GeoCache(str(tmp_path / "c.sqlite3"), ttl_seconds=60)
+    cache.set("a", 1)
+    commits = []
+    conn = cache._conn
+
+    class Spy:
+        def __getattr__(self, name):
+            return getattr(conn, name)
+
+        def commit(self):
+            commits.append(1)
+            conn.commit()
+
+    cache._conn = Spy()
+    for _ in range(10):
+        assert cache.get("a") == 1
+    assert commits == []
+    monkeypatch.setattr("geo_cache.TOUCH_BATCH", 1)
+    cache.get("a")
+    assert commits == [1]
+
+
+def test_eviction_keeps_recently_read_rows(tmp_path):
+    cache = GeoCache(str(tmp_path / "c.sqlite3"), ttl_seconds=60, max_entries=10)
+    for i in range(10):
+        cache.set(f"k{i}", i)
+    cache.get("k0")  # the oldest write, but just read
+    for i in range(10, 15):
+        cache.set(f"k{i}", i)
+    assert cache.get("k0") == 0
+    assert [cache.get(f"k{i}") for i in range(1, 6)] == [None] * 5
+
+
+def test_io_runs_blocking_stores_off_the_loop(tmp_path):
+    cache = GeoCache(str(tmp_path / "c.sqlite3"), ttl_seconds=60)
+    memory = MemoryBackend(60)
+    threads = []
+
+    class Recorder:
+        def __init__(self, store):
+            self.store = store
+            self.blocking = store.blocking
+
+        def __getattr__(self, name):
+            def call(*args):
+                threads.append(threading.get_ident())
+                return getattr(self.store, name)(*args)
+            return call
+
+    async def main():
+        await geo_cache.io(Recorder(cache), "set", "a", [1])
+        await geo_cache.io(Recorder(cache), "set_many", [("b", 2), ("c", 3)])
+        found = await geo_cache.io(Recorder(cache), "get_many", ["a", "b", "missing"])
+        await geo_cache.io(Recorder(memory), "set", "a", 1)
+        return found, threading.get_ident()
+
+    found, loop_thread = asyncio.run(main())
+    assert found == {"a": [1], "b": 2}
+    assert loop_thread not in threads[:3]
+    assert threads[3] == loop_thread
@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import pytest
+
+import geo_kernels
+from geo_kernels import deduplicate_locations, distance_matrix, distances_from, haversine, sort_by_distance
+
+
+def random_locations(n, seed, spread=0.01, lat=37.78, lon=-121.98):
+    """Clustered candidates: many within tens of meters of each other."""
+    rng = random.Random(seed)
+    centers = [(lat + rng.uniform(-spread, spread), lon + rng.uniform(-spread, spread)) for _ in range(max(1, n // 4))]
+    out = []
+    for i in range(n):
+        c_lat, c_lon = rng.choice(centers)
+        out.append({"latitude": c_lat + rng.gauss(0, 0.0003), "longitude": c_lon + rng.gauss(0, 0.0003),
+                    "name": f"place {i}"})
+    return out
+
+
+def pairwise_dedup(locations, min_distance_meters):
+    """The original O(n^2) version."""
+    kept = []
+    for loc in locations:
+        if all(haversine(loc["latitude"], loc["longitude"], k["latitude"], k["longitude"]) >= min_distance_meters
+               for k in kept):
+            kept.append(loc)
+    return kept
+
+
+def test_haversine_known_distance():
+    # San Francisco to Los Angeles, about 559 km
+    assert haversine(37.7749, -122.4194, 34.0522, -118.2437) == pytest.approx(559_120, rel=1e-3)
+    assert haversine(10.0, 20.0, 10.0, 20.0) == 0
+
+
+def test_vectorized_distances_match_scalar():
+    rng = random.Random(0)
+    points = [(rng.uniform(-80, 80), rng.uniform(-180, 180)) for _ in range(200)]
+    lats, lons = np.array(points).T
+    expected = [[haversine(a[0], a[1], b[0], b[1]) for b in points] for a in points]
+    assert np.allclose(distance_matrix(lats, lons), expected, rtol=1e-9, atol=1e-6)
+    locations = [{"latitude": p[0], "longitude": p[1]} for p in points]
+    assert np.allclose(distances_from(1.5, 2.5, locations), [haversine(1.5, 2.5, *p) for p in points],
+                       rtol=1e-9, atol=1e-6)
+
+
+@pytest.mark.parametrize("n", [5, geo_kernels.SMALL_INPUT + 50])
+def test_sort_by_distance_matches_scalar(n):
+    locations = random_locations(n, seed=n)
+    locations.append(dict(locations[0], name="twin"))  # equal distances keep input order
+    expected = sorted(locations, key=lambda L: haversine(37.78, -121.98, L["latitude"], L["longitude"]))
+    assert sort_by_distance(37.78, -121.98, locations) == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("threshold", [10, 50, 200])
+def test_deduplicate_matches_pairwise(seed, threshold):
+    locations = random_locations(150, seed)
+    assert deduplicate_locations(locations, threshold) == pairwise_dedup(locations, threshold)
+
+
+def test_deduplicate_at_high_latitude_and_edge_cases():
+    locations = random_locations(100, seed=1, lat=69.5, lon=18.9)
+    assert deduplicate_locations(locations, 50) == pairwise_dedup(locations, 50)
+    assert deduplicate_locations([], 50) == []
+    assert deduplicate_locations(locations, 0) == locations
+    # Missing coordinates count as 0
+    assert deduplicate_locations([{"name": "a"}, {"name": "b"}], 50) == [{"name": "a"}]
@@ -0,0 +1,129 @@
+import asyncio
+import gc
+
+import pytest
+
+import deadline
+import http_clients
+from hedging import Hedger
+
+
+def make_hedger(**options):
+    options.setdefault("percentile", 95)
+    options.setdefault("initial_delay", 0.05)
+    options.setdefault("min_delay", 0.01)
+    return Hedger(**options)
+
+
+def scripted(*seconds, fail=()):
+    """fetch() whose n-th call takes seconds[n] and then returns n (or raises, for n in fail)."""
+    calls = []
+
+    async def fetch():
+        n = len(calls)
+        calls.append(n)
+        await asyncio.sleep(seconds[n])
+        if n in fail:
+            raise http_clients.UpstreamError(f"call {n} failed")
+        return n
+
+    return fetch, calls
+
+
+def test_fast_call_is_not_hedged():
+    hedger = make_hedger()
+    fetch, calls = scripted(0.0)
+    assert asyncio.run(hedger.do("geocode", fetch)) == 0
+    assert calls == [0]
+    assert hedger.stats()["geocode"] == {"calls": 1, "hedged": 0, "hedgeWins": 0, "delayMs": 50.0}
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    hedger = make_hedger()
+    fetch, calls = scripted(1.0, 0.0)
+
+    async def main():
+        result = await hedger.do("geocode", fetch)
+        await asyncio.sleep(0)
+        return result, len(asyncio.all_tasks())
+
+    result, running = asyncio.run(main())
+    assert result == 1
+    assert calls == [0, 1]
+    assert running == 1  # the slow call was cancelled
+    assert hedger.stats()["geocode"]["hedgeWins"] == 1
+
+
+def test_hedge_that_fails_leaves_the_primary():
+    hedger = make_hedger()
+    fetch, calls = scripted(0.1, 0.0, fail={1})
+    assert asyncio.run(hedger.do("geocode", fetch)) == 0
+    assert hedger.stats()["geocode"]["hedgeWins"] == 0
+    fetch, calls = scripted(0.1, 0.0, fail={0, 1})
+    with pytest.raises(http_clients.UpstreamError):
+        asyncio.run(hedger.do("geocode", fetch))
+
+
+def test_hedges_are_rationed():
+    hedger = make_hedger(max_ratio=0.5)
+    fetch, calls = scripted(0.1, 0.0, 0.1, 0.1, 0.1, 0.0)
+
+    async def main():
+        for _ in range(3):
+            await hedger.do("geocode", fetch)
+
+    asyncio.run(main())
+    # One token to start with, half a token per call: the second call finds 0.5 + 0.5 - 1 < 1
+    assert hedger.stats()["geocode"]["hedged"] == 2
+    assert len(calls) == 5
+
+
+def test_delay_follows_the_latency_percentile():
+    hedger = make_hedger(min_samples=10, min_delay=0.002)
+    assert hedger.delay("trips") == 0.05
+    for ms in range(1, 21):
+        hedger._record("trips", ms / 1000)
+    assert hedger.delay("trips") == pytest.approx(0.020)
+    hedger = make_hedger(min_samples=10, min_delay=0.5)
+    for ms in range(1, 21):
+        hedger._record("trips", ms / 1000)
+    assert hedger.delay("trips") == 0.5
+
+
+def test_no_hedge_once_the_deadline_has_passed():
+    hedger = make_hedger()
+    fetch, calls = scripted(0.1, 0.0)
+
+    async def main():
+        deadline.begin(0.01)
+        return await hedger.do("geocode", fetch)
+
+    assert asyncio.run(main()) == 0
+    assert calls == [0]
+
+
+def test_loser_errors_are_retrieved():
+    hedger = make_hedger()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            # A transport that reports its cancellation as a failure
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise http_clients.UpstreamError("timeout")
+        return len(calls)
+
+    async def main():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        result = await hedger.do("geocode", fetch)
+        await asyncio.sleep(0.01)
+        gc.collect()
+        return result, errors
+
+    result, errors = asyncio.run(main())
+    assert result == 2
+    assert errors == []
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+import requests
+
+import http_clients
+
+
+class Reply:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {"Retry-After": retry_after} if retry_after else {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Answers from a script of statuses (or exceptions), recording each attempt's timeout."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.timeouts = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        step = self.script.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(*script):
+        fake = FakeSession(script)
+        monkeypatch.setattr(http_clients, "session_for", lambda url: fake)
+        return fake
+    monkeypatch.setattr(http_clients.config, "HTTP_RETRIES", 2)
+    monkeypatch.setattr(http_clients.config, "HTTP_RETRY_BACKOFF", 0.01)
+    return install
+
+
+def test_idempotent_requests_are_retried(session):
+    fake = session(Reply(503), requests.ConnectionError("reset"), Reply(200))
+    assert http_clients.request("GET", "https://api.mapbox.com/x", timeout=5).status_code == 200
+    assert len(fake.timeouts) == 3
+    # Each attempt gets only what is left of the call's timeout
+    assert fake.timeouts[0] <= 5 and fake.timeouts[2] < fake.timeouts[0]
+
+
+def test_posts_are_not_retried(session):
+    fake = session(Reply(503), Reply(200))
+    assert http_clients.request("POST", "https://api.mapbox.com/x", timeout=5).status_code == 503
+    assert len(fake.timeouts) == 1
+    fake = session(requests.ConnectionError("reset"), Reply(200))
+    with pytest.raises(http_clients.UpstreamError):
+        http_clients.request("POST", "https://api.mapbox.com/x", timeout=5)
+    assert len(fake.timeouts) == 1
+
+
+def test_retries_stay_within_the_timeout(session):
+    # A Retry-After longer than the time left: the response is returned, not waited out
+    fake = session(Reply(503, retry_after="30"), Reply(200))
+    t0 = time.monotonic()
+    assert http_clients.request("GET", "https://api.mapbox.com/x", timeout=1).status_code == 503
+    assert time.monotonic() - t0 < 0.5
+    assert len(fake.timeouts) == 1
+    fake = session(requests.Timeout("read timed out"), Reply(200))
+    with pytest.raises(http_clients.UpstreamError):
+        http_clients.request("GET", "https://api.mapbox.com/x", timeout=0.005)
+    assert len(fake.timeouts) == 1
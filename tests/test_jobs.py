@@ -0,0 +1,165 @@
+import asyncio
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from jobs import JobQueue, QueueFull
+from llm_cache import DiskBackend, MemoryBackend
+
+
+def make_queue(**options):
+    options.setdefault("workers", 2)
+    options.setdefault("batch_workers", 1)
+    options.setdefault("max_queued", {"interactive": 2, "batch": 2})
+    return JobQueue(MemoryBackend(900), "memory", **options)
+
+
+def wait_until(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.005)
+
+
+class Gated:
+    """A job body that runs until release(); records the order jobs started in."""
+
+    def __init__(self, started=None):
+        self.gate = Future()
+        self.started = started if started is not None else []
+
+    def __call__(self, name):
+        async def run(job):
+            self.started.append(name)
+            await asyncio.wrap_future(self.gate)
+            return {"success": True, "name": name}, 200
+        return run
+
+    def release(self):
+        self.gate.set_result(None)
+
+
+def test_job_runs_and_its_record_is_published():
+    queue = make_queue()
+
+    async def run(job):
+        job.append(b'{"event": "progress"}\n')
+        return {"success": True}, 200
+
+    job = queue.submit("interactive", run)
+    wait_until(lambda: job.status == "succeeded")
+    lines, finished, _ = job.read(0)
+    assert (lines, finished) == ([b'{"event": "progress"}\n'], True)
+    record = queue.store.get(f"job|{job.id}")
+    assert record["status"] == "succeeded"
+    assert record["result"] == {"success": True}
+    assert record["resultStatus"] == 200
+
+
+def test_failing_job():
+    queue = make_queue()
+
+    async def run(job):
+        raise RuntimeError("boom")
+
+    job = queue.submit("batch", run)
+    wait_until(lambda: job.status == "failed")
+    assert job.result_status == 500
+    assert queue.stats()["finished"]["failed"] == 1
+
+
+def test_batch_jobs_leave_a_worker_for_interactive():
+    queue = make_queue(workers=2, batch_workers=5)
+    assert queue.batch_workers == 1
+    body = Gated()
+    batch = [queue.submit("batch", body(f"b{i}")) for i in range(2)]
+    wait_until(lambda: body.started == ["b0"])
+    interactive = queue.submit("interactive", body("i0"))
+    wait_until(lambda: body.started == ["b0", "i0"])
+    assert [j.status for j in batch] == ["running", "queued"]
+    assert interactive.status == "running"
+    body.release()
+    wait_until(lambda: all(j.status == "succeeded" for j in batch + [interactive]))
+
+
+def test_interactive_jobs_start_before_queued_batch_jobs():
+    queue = make_queue(workers=1, max_queued={"interactive": 5, "batch": 5})
+    body = Gated()
+    first = queue.submit("interactive", body("first"))
+    wait_until(lambda: body.started == ["first"])
+    queue.submit("batch", body("batch"))
+    queue.submit("interactive", body("interactive"))
+    assert queue.record(first.id)["status"] == "running"
+    body.release()
+    wait_until(lambda: len(body.started) == 3)
+    assert body.started == ["first", "interactive", "batch"]
+
+
+def test_full_queue_is_refused_with_retry_after():
+    queue = make_queue(workers=2, max_queued={"interactive": 2, "batch": 2}, initial_seconds=10.0)
+    body = Gated()
+    for i in range(2):
+        queue.submit("interactive", body(f"run{i}"))
+    wait_until(lambda: len(body.started) == 2)
+    waiting = [queue.submit("interactive", body(f"q{i}")) for i in range(2)]
+    assert [queue.position(j) for j in waiting] == [1, 2]
+    with pytest.raises(QueueFull) as refused:
+        queue.submit("interactive", body("refused"))
+    # Two queued jobs of about 10 s each, on 2 workers
+    assert refused.value.retry_after == 10
+    assert refused.value.queued == 2
+    # The other class has its own queue
+    queue.submit("batch", body("batch"))
+    assert queue.stats()["rejected"] == {"interactive": 1, "batch": 0}
+    body.release()
+
+
+def test_retry_after_follows_recent_durations():
+    queue = make_queue(workers=2, batch_workers=1, initial_seconds=10.0)
+    assert queue._retry_after("interactive", 3) == 15
+    assert queue._retry_after("batch", 3) == 30
+    queue.avg_seconds = 0.1
+    assert queue._retry_after("interactive", 3) == 1
+
+
+def test_cancel_queued_and_running_jobs():
+    queue = make_queue(workers=1)
+    body = Gated()
+    running = queue.submit("interactive", body("running"))
+    wait_until(lambda: running.status == "running")
+    queued = queue.submit("interactive", body("queued"))
+    assert queue.cancel(queued.id)
+    assert queued.status == "cancelled"
+    assert queue.store.get(f"job|{queued.id}")["status"] == "cancelled"
+    assert queue.cancel(running.id)
+    wait_until(lambda: running.status == "cancelled")
+    assert running.result_status == 409
+    assert not queue.cancel(running.id)
+    assert not queue.cancel("no-such-job")
+    assert body.started == ["running"]
+
+
+def test_record_of_a_job_from_another_worker():
+    store = MemoryBackend(900)
+    accepted = JobQueue(store, "memory")
+    job = accepted.submit("interactive", Gated()("x"))
+    # Another process's queue sharing the store has no Job, only its record
+    other = JobQueue(store, "memory")
+    assert other.get(job.id) is None
+    assert other.record(job.id)["jobId"] == job.id
+    assert other.record("unknown") is None
+
+
+def test_disk_store_is_written_and_read_off_the_loop(tmp_path):
+    store = DiskBackend(str(tmp_path / "jobs.sqlite3"), 900, table="jobs")
+    queue = JobQueue(store, "disk")
+    job = queue.submit("interactive", Gated()("x"))
+    other = JobQueue(DiskBackend(str(tmp_path / "jobs.sqlite3"), 900, table="jobs"), "disk")
+    # The writer thread publishes "queued" then "running", in order
+    wait_until(lambda: (other.record(job.id) or {}).get("status") == "running")
+    assert queue.cancel(job.id)
+    wait_until(lambda: job.status == "cancelled")
+    wait_until(lambda: other.record(job.id)["status"] == "cancelled")
+    assert asyncio.run(other.fetch(job.id))["status"] == "cancelled"
+    assert asyncio.run(other.fetch("unknown")) is None
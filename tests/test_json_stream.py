@@ -0,0 +1,53 @@
+import pytest
+
+from json_stream import JsonStreamScanner
+
+ANSWER = (
+    '```json\n{"0": ["Target, 1 Main St", "Say \\"hi\\" \\u00e9 [x] {y}"],\n'
+    ' "task 1": [{"name": "Gym", "address": "2 Oak Ave", "rating": 4.5}, 7, true, null],\n'
+    ' "tasks": {"2": ["3 Elm Rd"]}}\n```\nanything after ["ignored"]'
+)
+EXPECTED = [
+    (("0",), "Target, 1 Main St"),
+    (("0",), 'Say "hi" é [x] {y}'),
+    (("task 1",), "2 Oak Ave"),
+    (("tasks", "2"), "3 Elm Rd"),
+]
+
+
+def scan(chunks):
+    scanner = JsonStreamScanner()
+    out = []
+    for chunk in chunks:
+        out.extend(scanner.feed(chunk))
+    return out, scanner
+
+
+def test_whole_answer():
+    out, scanner = scan([ANSWER])
+    assert out == EXPECTED
+    assert scanner.done
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8, 13])
+def test_any_chunking_gives_the_same_values(size):
+    out, _ = scan([ANSWER[i:i + size] for i in range(0, len(ANSWER), size)])
+    assert out == EXPECTED
+
+
+def test_values_are_reported_when_their_quote_closes():
+    scanner = JsonStreamScanner()
+    assert scanner.feed('{"0": ["Target, 1 Main') == []
+    assert scanner.feed(' St", "Costco') == [(("0",), "Target, 1 Main St")]
+    assert scanner.feed('"') == [(("0",), "Costco")]
+    assert not scanner.done
+
+
+def test_escape_split_across_chunks():
+    out, _ = scan(['["a\\', '"b"]'])
+    assert out == [((), 'a"b')]
+
+
+def test_top_level_array_and_bad_escapes():
+    out, _ = scan(['["x", "bad \\q escape", "y"]'])
+    assert out == [((), "x"), ((), "y")]
@@ -0,0 +1,65 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from leg_cache import LegCache
+
+A = (-121.97891, 37.78012)
+B = (-121.95, 37.77)
+C = (-121.93, 37.76)
+# A Wednesday, 16:00 in the default PLAN_CACHE_TIMEZONE: the 15:00-19:00 window
+NOW = datetime(2026, 10, 14, 16, 0, tzinfo=ZoneInfo("America/Los_Angeles")).timestamp()
+
+
+def test_matrix_from_cached_legs():
+    cache = LegCache()
+    cache.put([(A, B, 100, 1000), (B, A, 110, 1100)], now=NOW)
+    assert cache.matrix([A, B], now=NOW) == {
+        "durations": [[0.0, 100], [110, 0.0]],
+        "distances": [[0.0, 1000], [1100, 0.0]],
+    }
+    # Rounded to 4 decimals: a point 1 m away shares the legs
+    assert cache.matrix([(A[0] + 0.00001, A[1]), B], now=NOW) is not None
+
+
+def test_missing_or_unroutable_leg_is_a_miss():
+    cache = LegCache()
+    cache.put([(A, B, 100, 1000), (B, A, None, None)], now=NOW)
+    assert cache.matrix([A, B], now=NOW) is None
+    assert cache.matrix([A, B, C], now=NOW) is None
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_legs_belong_to_their_profile_and_window():
+    cache = LegCache()
+    cache.put([(A, B, 100, 1000), (B, A, 110, 1100)], now=NOW)
+    assert cache.matrix([A, B], profile="walking", now=NOW) is None
+    # 19:00 starts the next window
+    assert cache.matrix([A, B], now=NOW + 3 * 3600) is None
+    # Same window id the next day: expired, not reused
+    assert cache.matrix([A, B], now=NOW + 24 * 3600) is None
+    assert cache.stats()["entries"] == 1
+
+
+def test_put_matrix_and_put_legs():
+    cache = LegCache()
+    cache.put_matrix([A, B], [[0, 100], [110, 0]], [[0, 1000], [1100, 0]])
+    assert cache.matrix([A, B])["durations"] == [[0.0, 100], [110, 0.0]]
+    cache.put_legs([A, B, C], [{"duration": 5, "distance": 50}, {"duration": 6, "distance": 60}])
+    cache.put_legs([C, B, A], [{"duration": 7, "distance": 70}, {"duration": 8, "distance": 80}])
+    cache.put_legs([C, A], [{"duration": 9, "distance": 90}])
+    cache.put_legs([A, C], [{"duration": 10, "distance": 100}])
+    assert cache.matrix([A, B, C])["durations"] == [[0.0, 5, 10], [8, 0.0, 6], [9, 7, 0.0]]
+
+
+def test_lru_bound():
+    cache = LegCache(max_entries=3)
+    cache.put([(A, B, 1, 1), (B, A, 2, 2), (A, C, 3, 3)], now=NOW)
+    # A read makes A<->B recent, so the next put evicts A->C
+    assert cache.matrix([A, B], now=NOW) is not None
+    cache.put([(C, A, 4, 4)], now=NOW)
+    assert cache.stats()["entries"] == 3
+    assert cache.matrix([A, B], now=NOW) is not None
+    # A->C was evicted; putting it back evicts C->A, the least recently used
+    cache.put([(A, C, 3, 3)], now=NOW)
+    assert cache.matrix([A, C], now=NOW) is None
+    assert cache.matrix([A, B], now=NOW) is not None
@@ -0,0 +1,62 @@
+import pytest
+
+from llm_cache import DiskBackend, LLMCache, MemoryBackend, cache_key
+
+MESSAGES = [
+    {"role": "system", "content": "You are a local business address finder."},
+    {"role": "user", "content": "Find 3 Walmart groceries near San Ramon"},
+]
+
+
+@pytest.mark.parametrize("messages", [
+    [{"role": " System ", "content": "You are a local business\n  address finder."},
+     {"role": "USER", "content": "  Find 3 Walmart groceries near San Ramon\n"}],
+    [dict(reversed(list(m.items()))) for m in MESSAGES],
+])
+def test_key_ignores_incidental_differences(messages):
+    assert cache_key("gemini", messages) == cache_key("gemini", MESSAGES)
+
+
+@pytest.mark.parametrize("model, messages", [
+    ("gpt", MESSAGES),
+    ("gemini", MESSAGES[:1]),
+    ("gemini", [MESSAGES[0], {"role": "user", "content": "Find 3 Target groceries near San Ramon"}]),
+    ("gemini", [MESSAGES[0], {"role": "user", "content": "find 3 walmart groceries near san ramon"}]),
+    ("gemini", [MESSAGES[0], {"role": "assistant", "content": MESSAGES[1]["content"]}]),
+    ("gemini", list(reversed(MESSAGES))),
+])
+def test_key_keeps_meaningful_differences(model, messages):
+    assert cache_key(model, messages) != cache_key("gemini", MESSAGES)
+
+
+@pytest.fixture(params=["memory", "disk"])
+def backend(request, tmp_path):
+    if request.param == "disk":
+        return DiskBackend(str(tmp_path / "llm_cache.sqlite3"), ttl_seconds=60)
+    return MemoryBackend(ttl_seconds=60)
+
+
+def test_cache_round_trip_and_errors_not_cached(backend):
+    cache = LLMCache(backend, "test")
+    assert cache.get("gemini", MESSAGES) is None
+    cache.set("gemini", MESSAGES, {"choices": [{"message": {"content": "[]"}}]})
+    cache.set("gemini", MESSAGES[:1], {"error": "quota"})
+    assert cache.get("gemini", MESSAGES) == {"choices": [{"message": {"content": "[]"}}]}
+    assert cache.get("gemini", MESSAGES[:1]) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_memory_backend_bounds():
+    backend = MemoryBackend(ttl_seconds=60, max_entries=2, max_bytes=40)
+    backend.set("a", "x" * 10)
+    backend.set("b", "y" * 10)
+    backend.get("a")
+    backend.set("c", "z" * 10)  # over max_entries: "b" is the least recently used
+    assert [backend.get(k) for k in "abc"] == ["x" * 10, None, "z" * 10]
+    backend.set("d", "w" * 30)  # over max_bytes: evicts until it fits
+    assert backend.get("d") == "w" * 30
+    assert backend.stats()["bytes"] <= 40
+    backend.set("huge", "v" * 100)  # larger than the whole cache: not stored
+    assert backend.get("huge") is None
+    backend.set("old", "u", ttl_seconds=-1)
+    assert backend.get("old") is None
@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+
+import models
+from models import Leg, Location, ModelError, Preference, Route, Step, Task
+
+STOPS = [
+    {"latitude": 37.7796, "longitude": -121.9385, "name": "Walmart", "address": "2551 San Ramon Valley Blvd"},
+    {"latitude": 37.7726, "longitude": -121.9500, "name": "24 Hour Fitness", "address": "2600 Camino Ramon",
+     "type": "gym"},
+]
+MAPBOX_ROUTE = {
+    "distance": 5230.4,
+    "duration": 611.2,
+    "weight": 700,  # not part of the model
+    "geometry": {"type": "LineString", "coordinates": [[-121.98, 37.78], [-121.96, 37.775], [-121.95, 37.7726]]},
+    "legs": [{
+        "distance": 5230.4,
+        "duration": 611.2,
+        "summary": "Bollinger Canyon Rd",
+        "steps": [{
+            "distance": 120.0,
+            "duration": 15.5,
+            "name": "Bollinger Canyon Rd",
+            "maneuver": {"instruction": "Head east", "type": "depart", "location": [-121.98, 37.78],
+                         "bearing_after": 90},
+            "geometry": {"type": "LineString", "coordinates": [[-121.98, 37.78], [-121.979, 37.78]]},
+            "intersections": [{"location": [-121.98, 37.78]}],
+        }],
+    }],
+}
+
+
+def test_route_round_trip():
+    route = Route.from_mapbox(MAPBOX_ROUTE, STOPS, [1, 0], 70)
+    route.id = "route-1"
+    d = route.to_dict()
+    assert d["totalDuration"] == 611.2
+    assert d["geometry"] == MAPBOX_ROUTE["geometry"]
+    assert d["stops"][1]["type"] == "gym" and "type" not in d["stops"][0]
+    step = d["legs"][0]["steps"][0]
+    assert "intersections" not in step and "bearing_after" not in step["maneuver"]
+    again = Route.from_dict(json.loads(json.dumps(d)))
+    assert again.to_dict() == d
+
+
+def test_compact_levels():
+    route = Route.from_mapbox(MAPBOX_ROUTE, STOPS, [0, 1], 70)
+    high = route.to_dict("high")
+    assert isinstance(high["geometry"], str)
+    assert "geometry" not in high["legs"][0]["steps"][0]
+    assert "location" not in high["legs"][0]["steps"][0]["maneuver"]
+    assert route.to_dict("low")["legs"] == [{"distance": 5230.4, "duration": 611.2}]
+
+
+def test_task_round_trip():
+    body = {"type": "grocery", "description": "weekly shop", "id": 3, "isMandatory": True,
+            "preferences": [{"type": "chain", "value": "Walmart", "isMandatory": True}]}
+    task = Task.from_dict(body)
+    assert task.id == "3"
+    assert task.preferences[0].is_mandatory
+    assert Task.from_dict(task.to_dict()).to_dict() == task.to_dict()
+
+
+@pytest.mark.parametrize("build, message", [
+    (lambda: Task.list_from([{"type": "gym"}, {"type": "x", "preferences": [{"value": {}}]}]),
+     "tasks[1].preferences[0].value"),
+    (lambda: Location.from_dict({"latitude": "37", "longitude": 0}), "location.latitude"),
+    (lambda: Location.from_dict({"latitude": 137, "longitude": 0}), "out of range"),
+    (lambda: Route.from_mapbox({**MAPBOX_ROUTE, "geometry": {"coordinates": [1, 2]}}, STOPS, [0, 1], 0),
+     "route.geometry.coordinates"),
+    (lambda: Route.from_mapbox({**MAPBOX_ROUTE, "legs": [{"duration": True}]}, STOPS, [0, 1], 0),
+     "route.legs[0].duration"),
+])
+def test_invalid_input_names_the_field(build, message):
+    with pytest.raises(ModelError, match=message.replace("[", r"\[").replace("]", r"\]")):
+        build()
+
+
+@pytest.mark.parametrize("cls, args", [
+    (Preference, ("chain", "Walmart")),
+    (Task, ("gym",)),
+    (Location, (1.0, 2.0)),
+    (Step, (1.0, 2.0)),
+    (Leg, (1.0, 2.0)),
+    (Route, ([], 1.0, 2.0, [], [], 50, [])),
+])
+def test_models_use_slots(cls, args):
+    obj = cls(*args)
+    assert not hasattr(obj, "__dict__")
+    with pytest.raises(AttributeError):
+        obj.unknown = 1
+
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_dumps_encodes_models(encoder, monkeypatch):
+    if encoder == "json":
+        monkeypatch.setattr(models, "orjson", None)
+    elif models.orjson is None:
+        pytest.skip("orjson is not installed")
+    route = Route.from_mapbox(MAPBOX_ROUTE, STOPS, (1, 0), 70)
+    payload = {"success": True, "routes": [route], "order": (1, 2)}
+    out = models.dumps(payload)
+    assert isinstance(out, bytes)
+    assert json.loads(out) == {"success": True, "routes": [route.to_dict()], "order": [1, 2]}
+    if encoder == "orjson":
+        assert json.loads(models.dumps({"d": np.array([1.5, 2.0])})) == {"d": [1.5, 2.0]}
@@ -0,0 +1,77 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from llm_cache import MemoryBackend
+from models import Preference, Task
+from plan_cache import PlanCache, geo_bucket, traffic_window
+
+LA = ZoneInfo("America/Los_Angeles")
+WINDOWS = [0, 6, 10, 15, 19]
+
+
+def at(*args):
+    return datetime(*args, tzinfo=LA).timestamp()
+
+
+@pytest.mark.parametrize("lat, lon, cell", [
+    (37.7801, -121.9789, (3778, -12198)),
+    (37.7899, -121.9701, (3778, -12198)),
+    (0.0, 0.0, (0, 0)),
+    (-0.005, -0.005, (-1, -1)),
+])
+def test_geo_bucket(lat, lon, cell):
+    assert geo_bucket(lat, lon, 0.01) == cell
+
+
+@pytest.mark.parametrize("now, window, end", [
+    # 2026-10-14 is a Wednesday, 2026-10-17 a Saturday
+    (at(2026, 10, 14, 0, 0), "weekday-0", at(2026, 10, 14, 6)),
+    (at(2026, 10, 14, 9, 59), "weekday-6", at(2026, 10, 14, 10)),
+    (at(2026, 10, 14, 15, 0), "weekday-15", at(2026, 10, 14, 19)),
+    (at(2026, 10, 14, 23, 30), "weekday-19", at(2026, 10, 15, 0)),
+    (at(2026, 10, 17, 12, 0), "weekend-10", at(2026, 10, 17, 15)),
+    # Friday evening is a weekday window that ends at Saturday's midnight
+    (at(2026, 10, 16, 20, 0), "weekday-19", at(2026, 10, 17, 0)),
+])
+def test_traffic_window(now, window, end):
+    assert traffic_window(now, "America/Los_Angeles", WINDOWS) == (window, end)
+
+
+def test_traffic_window_across_daylight_saving_changes():
+    # 2026-03-08 (a Sunday) has 23 hours in Los Angeles: its last window is 4 hours long, not 5
+    window, end = traffic_window(at(2026, 3, 8, 20), "America/Los_Angeles", WINDOWS)
+    assert window == "weekend-19"
+    assert end - at(2026, 3, 8, 20) == 4 * 3600
+    # The first window that day spans the skipped hour
+    window, end = traffic_window(at(2026, 3, 8, 1), "America/Los_Angeles", WINDOWS)
+    assert window == "weekend-0"
+    assert end - at(2026, 3, 8, 1) == 4 * 3600
+
+
+def test_keys_share_grid_cell_and_window():
+    cache = PlanCache(MemoryBackend(3600), "memory", bucket_deg=0.01, max_ttl=3600)
+    tasks = [Task("grocery", preferences=[Preference("chain", "Walmart")])]
+    same_tasks = [Task("Grocery", description="weekly shop", preferences=[Preference("chain", "walmart")])]
+    start = {"latitude": 37.7801, "longitude": -121.9789}
+    nearby = {"latitude": 37.7899, "longitude": -121.9701}
+    now = at(2026, 10, 14, 16, 0)
+
+    key, window, expires = cache.key(tasks, start, "matrix", "time", now=now)
+    assert cache.key(same_tasks, nearby, "matrix", "time", now=now + 60)[0] == key
+    assert window == "weekday-15"
+    assert expires == at(2026, 10, 14, 17, 0)  # max_ttl comes before the window's end at 19:00
+    # Another cell, mode or window
+    assert cache.key(tasks, {"latitude": 37.80, "longitude": -121.9789}, "matrix", "time", now=now)[0] != key
+    assert cache.key(tasks, start, "trips", "time", now=now)[0] != key
+    assert cache.key(tasks, start, "matrix", "time", now=at(2026, 10, 14, 19, 0))[0] != key
+
+
+def test_entries_expire_with_their_window():
+    cache = PlanCache(MemoryBackend(3600), "memory")
+    cache.set("k", {"success": True}, expires_at=0)
+    assert cache.get("k") is None
+    cache.set("k", {"success": True}, expires_at=datetime.now().timestamp() + 60)
+    assert cache.get("k")["payload"] == {"success": True}
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import deadline
+import python_agent_service
+import upstream
+from hedging import Hedger
+from upstream import Upstream
+
+SLOW_SECONDS = 1.5
+
+
+class Reply:
+    status_code = 200
+    headers = {}
+
+
+class SlowFirstTransport:
+    """Blocking calls in worker threads, like RequestsTransport; the first takes SLOW_SECONDS, cancelled or not."""
+
+    def __init__(self):
+        self.calls = 0
+        self.finished = threading.Event()
+
+    async def request(self, method, url, **kwargs):
+        self.calls += 1
+        seconds = SLOW_SECONDS if self.calls == 1 else 0.0
+        return await asyncio.to_thread(self._send, seconds)
+
+    def _send(self, seconds):
+        time.sleep(seconds)
+        if seconds:
+            self.finished.set()
+        return Reply()
+
+    def stats(self):
+        return {}
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    transport = SlowFirstTransport()
+    monkeypatch.setattr(python_agent_service, "UPSTREAM", Upstream(transport))
+    monkeypatch.setattr(upstream, "HEDGER", Hedger(percentile=95, initial_delay=0.05, min_delay=0.01))
+    monkeypatch.setattr(upstream, "LIMITER", None)
+    monkeypatch.setattr(upstream, "FLIGHTS", None)
+    return transport
+
+
+def timed(handler):
+    t0 = time.monotonic()
+    response = python_agent_service.run(handler)
+    return json.loads(response.get_data()), time.monotonic() - t0
+
+
+def test_response_does_not_wait_for_the_hedge_loser(transport):
+    async def handler(up):
+        r = await up._request("GET", "https://api.mapbox.com/geocoding", timeout=5, hedge="geocode")
+        return {"status": r.status_code}, 200
+
+    body, elapsed = timed(handler)
+    assert body == {"status": 200}
+    assert transport.calls == 2
+    assert elapsed < SLOW_SECONDS / 2
+    assert not transport.finished.is_set()  # the loser's thread is still running
+
+
+def test_response_does_not_wait_for_a_call_cut_off_at_the_deadline(transport):
+    async def handler(up):
+        deadline.begin(0.1)
+        try:
+            await deadline.bounded(up._request("GET", "https://api.mapbox.com/geocoding", timeout=5))
+        except deadline.DeadlineExceeded:
+            return {"partial": True}, 200
+        return {"partial": False}, 200
+
+    body, elapsed = timed(handler)
+    assert body == {"partial": True}
+    assert elapsed < SLOW_SECONDS / 2
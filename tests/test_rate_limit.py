@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import deadline
+import http_clients
+import rate_limit
+from rate_limit import Endpoint, MemoryBuckets, Permit, RateLimiter, SharedBuckets
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "disk"])
+def buckets(request, tmp_path):
+    if request.param == "disk":
+        return SharedBuckets(str(tmp_path / "rate_limit.sqlite3"))
+    return MemoryBuckets()
+
+
+def answered(status, retry_after=None):
+    permit = Permit()
+    permit.status = status
+    permit.retry_after = retry_after
+    return permit
+
+
+def test_burst_and_refill(buckets, clock):
+    # 2 tokens a second, bursts of 4
+    assert [buckets.take("geocode", 1, 2.0, 4.0) for _ in range(4)] == [0, 0, 0, 0]
+    assert buckets.take("geocode", 1, 2.0, 4.0) == pytest.approx(0.5)
+    clock.now += 1
+    assert [buckets.take("geocode", 1, 2.0, 4.0) for _ in range(3)] == [0, 0, pytest.approx(0.5)]
+    # A long idle period refills up to the burst only
+    clock.now += 100
+    assert [buckets.take("geocode", 2, 2.0, 4.0) for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+    # Buckets are independent
+    assert buckets.take("trips", 4, 2.0, 4.0) == 0
+
+
+def test_refund(buckets, clock):
+    assert buckets.take("geocode", 4, 2.0, 4.0) == 0
+    buckets.refund("geocode", 1, 4.0)
+    assert buckets.take("geocode", 1, 2.0, 4.0) == 0
+    assert buckets.take("geocode", 1, 2.0, 4.0) > 0
+    # Never above the burst
+    buckets.refund("geocode", 10, 4.0)
+    assert buckets.take("geocode", 4, 2.0, 4.0) == 0
+    assert buckets.take("geocode", 1, 2.0, 4.0) > 0
+
+
+def test_pause_grants_nothing_then_refills_from_empty(buckets, clock):
+    buckets.pause("geocode", clock.now + 3, 4.0)
+    assert buckets.take("geocode", 1, 2.0, 4.0) == pytest.approx(3.0)
+    clock.now += 3
+    assert buckets.take("geocode", 1, 2.0, 4.0) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert buckets.take("geocode", 1, 2.0, 4.0) == 0
+
+
+def test_shared_buckets_share_tokens_between_instances(tmp_path, clock):
+    path = str(tmp_path / "rate_limit.sqlite3")
+    first, second = SharedBuckets(path), SharedBuckets(path)
+    assert first.take("geocode", 3, 2.0, 4.0) == 0
+    assert second.take("geocode", 1, 2.0, 4.0) == 0
+    assert first.take("geocode", 1, 2.0, 4.0) > 0
+
+
+def test_waiters_go_earliest_deadline_first():
+    endpoint = Endpoint("geocode", MemoryBuckets(), per_minute=60000, max_concurrency=1)
+    order = []
+
+    async def call(budget):
+        deadline.begin(budget)
+        await endpoint.acquire()
+        order.append(budget)
+        await asyncio.sleep(0.01)
+        await endpoint.release(answered(200))
+
+    async def main():
+        await endpoint.acquire()  # hold the only slot while the others line up
+        calls = [asyncio.ensure_future(call(budget)) for budget in (50, 10, 30, None, 20)]
+        await asyncio.sleep(0.05)
+        assert endpoint.stats()["queued"] == 5
+        await endpoint.release(answered(200))
+        await asyncio.gather(*calls)
+
+    asyncio.run(main())
+    assert order == [10, 20, 30, 50, None]
+
+
+def test_concurrency_halves_on_failure_once_per_cooldown():
+    endpoint = Endpoint("trips", MemoryBuckets(), per_minute=60000, max_concurrency=16, min_concurrency=2,
+                        pause_seconds=0)
+
+    def finish(permit, failed=False):
+        asyncio.run(endpoint.acquire())
+        asyncio.run(endpoint.release(permit, failed=failed))
+
+    finish(answered(503))
+    assert endpoint.limit == 8
+    # Within the cooldown: counted, not cut again
+    finish(answered(429))
+    finish(answered(None), failed=True)
+    assert endpoint.limit == 8
+    assert (endpoint.throttled, endpoint.failed) == (1, 2)
+    for _ in range(3):
+        endpoint._last_cut -= rate_limit.DECREASE_COOLDOWN
+        finish(answered(500))
+    assert endpoint.limit == 2  # not below min_concurrency
+    # Additive increase: about one more slot per round of successes
+    finish(answered(200))
+    assert endpoint.limit == pytest.approx(2.5)
+    for _ in range(200):
+        finish(answered(200))
+    assert endpoint.limit == 16
+    # Calls that say nothing about the endpoint do not change it
+    finish(answered(None))
+    assert endpoint.limit == 16
+
+
+def test_429_pauses_the_endpoint():
+    endpoint = Endpoint("geocode", MemoryBuckets(), per_minute=60000, pause_seconds=0.3)
+
+    async def main():
+        await endpoint.acquire()
+        await endpoint.release(answered(429))  # no Retry-After: pause_seconds
+        t0 = time.monotonic()
+        await endpoint.acquire()
+        waited = time.monotonic() - t0
+        await endpoint.release(answered(429, retry_after="30"))
+        deadline.begin(1)
+        with pytest.raises(deadline.DeadlineExceeded):
+            await endpoint.acquire()
+        return waited
+
+    assert 0.25 <= asyncio.run(main()) < 1
+    assert endpoint.stats()["throttled"] == 2
+    assert endpoint.stats()["deadlineExpired"] == 1
+    assert endpoint.stats()["queued"] == 0
+
+
+def test_waiter_gives_up_at_its_deadline():
+    endpoint = Endpoint("geocode", MemoryBuckets(), per_minute=60000, max_concurrency=1)
+
+    async def main():
+        await endpoint.acquire()
+        deadline.begin(0.1)
+        t0 = time.monotonic()
+        with pytest.raises(deadline.DeadlineExceeded):
+            await endpoint.acquire()
+        return time.monotonic() - t0
+
+    assert 0.05 < asyncio.run(main()) < 1
+    assert endpoint.stats()["queued"] == 0
+    assert endpoint.stats()["inFlight"] == 1
+
+
+class SlowBuckets(MemoryBuckets):
+    """Blocking buckets whose first update takes a while, recording where updates run."""
+
+    blocking = True
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+        self.refunds = 0
+
+    def take(self, name, cost, rate, burst):
+        self.threads.append(threading.get_ident())
+        if len(self.threads) == 1:
+            time.sleep(0.2)
+        return super().take(name, cost, rate, burst)
+
+    def refund(self, name, cost, burst):
+        self.refunds += 1
+        super().refund(name, cost, burst)
+
+
+def test_blocking_update_runs_off_the_loop_and_yields_to_an_earlier_deadline():
+    buckets = SlowBuckets()
+    endpoint = Endpoint("geocode", buckets, per_minute=60000, max_concurrency=1)
+    order = []
+
+    async def call(name, budget):
+        deadline.begin(budget)
+        await endpoint.acquire()
+        order.append(name)
+        await endpoint.release(answered(200))
+
+    async def main():
+        late = asyncio.ensure_future(call("late", 50))
+        await asyncio.sleep(0.05)  # its bucket update is under way, in another thread
+        early = asyncio.ensure_future(call("early", 10))
+        await asyncio.gather(late, early)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    # The late call's tokens went back, and the earlier deadline went first
+    assert order == ["early", "late"]
+    assert buckets.refunds == 1
+    assert loop_thread not in buckets.threads
+
+
+def test_limiter_call():
+    limiter = RateLimiter(MemoryBuckets(), "memory", {"geocode": 60000})
+
+    async def main():
+        async with limiter.call("geocode") as permit:
+            permit.status = 200
+        with pytest.raises(http_clients.UpstreamError):
+            async with limiter.call("geocode"):
+                raise http_clients.UpstreamError("down")
+        # Not limited: passes straight through
+        async with limiter.call("llm") as permit:
+            assert isinstance(permit, Permit)
+
+    asyncio.run(main())
+    stats = limiter.stats()
+    assert stats["geocode"]["calls"] == 2
+    assert stats["geocode"]["failed"] == 1
+    assert stats["geocode"]["inFlight"] == 0
+    assert "llm" not in stats
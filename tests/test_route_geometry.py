@@ -0,0 +1,94 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+import route_geometry
+from route_geometry import decode_polyline, encode_polyline, simplify
+
+
+def test_known_encoding():
+    # The example from Google's polyline algorithm documentation (precision 5)
+    coords = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+    assert encode_polyline(coords, precision=5) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@", precision=5) == coords
+
+
+@pytest.mark.parametrize("coords", [
+    [],
+    [[0.0, 0.0]],
+    [[-121.978912, 37.780123], [-121.978912, 37.780123], [-121.95, 37.77]],
+    # Extremes of the coordinate range take the most chunks
+    [[-179.999999, -89.999999], [179.999999, 89.999999], [0.000001, -0.000001]],
+])
+def test_polyline6_round_trip(coords):
+    assert np.allclose(decode_polyline(encode_polyline(coords)), coords, rtol=0, atol=1e-9)
+
+
+def test_polyline6_round_trip_random():
+    rng = random.Random(0)
+    coords = [[round(rng.uniform(-180, 180), 6), round(rng.uniform(-90, 90), 6)] for _ in range(500)]
+    assert np.allclose(decode_polyline(encode_polyline(coords)), coords, rtol=0, atol=1e-9)
+
+
+def to_meters(coords):
+    pts = np.asarray(coords, dtype=float)
+    k = math.cos(math.radians(pts[:, 1].mean()))
+    return np.column_stack([pts[:, 0] * route_geometry.METERS_PER_DEGREE * k,
+                            pts[:, 1] * route_geometry.METERS_PER_DEGREE])
+
+
+def segment_distance(p, a, b):
+    seg = b - a
+    t = 0.0 if not seg @ seg else min(1.0, max(0.0, (p - a) @ seg / (seg @ seg)))
+    return float(np.hypot(*(p - a - t * seg)))
+
+
+def wiggly_route(n, seed):
+    rng = random.Random(seed)
+    lon, lat = -121.98, 37.78
+    coords = []
+    for _ in range(n):
+        lon += rng.uniform(-1e-4, 3e-4)
+        lat += rng.uniform(-1e-4, 2e-4)
+        coords.append([lon, lat])
+    return coords
+
+
+@pytest.mark.parametrize("n", [10, 47, 300])
+@pytest.mark.parametrize("tolerance", [1.0, 5.0, 25.0])
+def test_simplify_stays_within_tolerance(n, tolerance):
+    coords = wiggly_route(n, seed=n)
+    out = simplify(coords, tolerance)
+    assert out[0] == coords[0] and out[-1] == coords[-1]
+    # Every dropped point is within tolerance of the kept segment that replaced it
+    kept = [coords.index(c) for c in out]
+    xy = to_meters(coords)
+    for first, last in zip(kept, kept[1:]):
+        for i in range(first + 1, last):
+            assert segment_distance(xy[i], xy[first], xy[last]) <= tolerance + 1e-6
+
+
+def test_simplify_straight_line_and_trivial_inputs():
+    line = [[-121.98 + i * 1e-4, 37.78 + i * 1e-4] for i in range(100)]
+    assert simplify(line, 1.0) == [line[0], line[-1]]
+    assert simplify(line[:2], 1.0) == line[:2]
+    assert simplify(line, 0) == line
+    assert len(simplify(wiggly_route(300, seed=0), 25.0)) < 100
+
+
+def test_simplify_keeps_a_loop_back_past_the_end():
+    # Out and back along the same street: the far point is on the line but off the segment
+    coords = [[-121.98, 37.78], [-121.97, 37.78], [-121.975, 37.78]]
+    assert simplify(coords, 5.0) == coords
+
+
+def test_numpy_and_python_scans_agree():
+    xy = to_meters(wiggly_route(200, seed=1))
+    xs, ys = xy[:, 0].tolist(), xy[:, 1].tolist()
+    for first, last in [(0, 199), (5, 60), (10, 12)]:
+        k_np, d_np = route_geometry._farthest_np(xy, first, last)
+        k_py, d_py = route_geometry._farthest_py(xs, ys, first, last)
+        assert k_np == k_py
+        assert d_np == pytest.approx(d_py)
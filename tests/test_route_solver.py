@@ -0,0 +1,61 @@
+import random
+from itertools import permutations, product
+
+import numpy as np
+import pytest
+
+import route_solver
+
+
+def random_instance(seed):
+    """Asymmetric travel costs between random points: node 0 is the start, then 2-5 groups of 1-3 nodes."""
+    rng = random.Random(seed)
+    groups, n = [], 1
+    for _ in range(rng.randint(2, 5)):
+        size = rng.randint(1, 3)
+        groups.append(list(range(n, n + size)))
+        n += size
+    pts = np.array([[rng.uniform(0, 10), rng.uniform(0, 10)] for _ in range(n)])
+    cost = np.linalg.norm(pts[:, None] - pts[None], axis=2)
+    cost *= np.array([[rng.uniform(1, 1.5) for _ in range(n)] for _ in range(n)])
+    return cost, groups
+
+
+def brute_force(cost, groups, start, end):
+    return min(
+        route_solver.path_cost(cost, start, order, end)
+        for combo in product(*groups)
+        for order in permutations(combo)
+    )
+
+
+@pytest.mark.parametrize("end", [None, 0])
+@pytest.mark.parametrize("seed", range(40))
+def test_held_karp_is_optimal(seed, end):
+    cost, groups = random_instance(seed)
+    sol = route_solver.solve(cost, groups, start=0, end=end)
+    assert sol.exact
+    assert sol.cost == pytest.approx(brute_force(cost, groups, 0, end))
+    assert sol.cost == pytest.approx(route_solver.path_cost(cost, 0, sol.order, end))
+
+
+@pytest.mark.parametrize("end", [None, 0])
+@pytest.mark.parametrize("seed", range(40))
+def test_heuristic_matches_brute_force_on_small_instances(seed, end):
+    cost, groups = random_instance(seed)
+    sol = route_solver.solve(cost, groups, start=0, end=end, exact_max_groups=0)
+    assert not sol.exact
+    assert sol.cost == pytest.approx(brute_force(cost, groups, 0, end))
+    assert sorted(sol.selection) == sorted(sol.order)
+    assert all(node in grp for node, grp in zip(sol.selection, groups))
+
+
+def test_held_karp_gives_up_at_the_time_limit():
+    rng = np.random.default_rng(0)
+    pts = rng.random((37, 2))
+    cost = np.linalg.norm(pts[:, None] - pts[None], axis=2)
+    groups = [list(range(1 + 3 * i, 4 + 3 * i)) for i in range(12)]
+    sol = route_solver.solve(cost, groups, start=0, end=None, time_limit=0.05, exact_max_groups=12)
+    assert not sol.exact
+    assert len(sol.order) == 12
+    assert route_solver.rank_selections(cost, groups, start=0, end=0, time_limit=0.05, exact_max_groups=12)
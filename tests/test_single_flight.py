@@ -0,0 +1,140 @@
+import asyncio
+import threading
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+class LeaderGaveUp(Exception):
+    pass
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"value": [1]}
+
+    async def main():
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert calls == 1
+    assert all(r == {"value": [1]} for r in results)
+    # Each waiter gets its own copy
+    assert len({id(r) for r in results}) == 5
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "inFlight": 0}
+
+
+def test_different_keys_and_later_calls_are_not_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key
+
+    async def main():
+        await asyncio.gather(flight.do("a", lambda: fetch("a")), flight.do("b", lambda: fetch("b")))
+        await flight.do("a", lambda: fetch("a"))
+
+    asyncio.run(main())
+    assert sorted(calls) == ["a", "a", "b"]
+
+
+def test_leader_exception_reaches_waiters():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        raise ValueError("upstream down")
+
+    async def main():
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flight.stats()["calls"] == 1
+
+
+def test_cancelled_waiter_leaves_the_call_running():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return 7
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+
+    assert asyncio.run(main()) == 7
+
+
+@pytest.mark.parametrize("leader_fails", ["cancelled", "abandoned"])
+def test_waiters_retry_when_the_leader_gives_up(leader_fails):
+    flight = SingleFlight(abandon=(LeaderGaveUp,))
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        if calls == 1 and leader_fails == "abandoned":
+            raise LeaderGaveUp()
+        return calls
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.do("k", fetch)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        if leader_fails == "cancelled":
+            leader.cancel()
+        with pytest.raises((asyncio.CancelledError, LeaderGaveUp)):
+            await leader
+        return await asyncio.gather(*waiters)
+
+    # One waiter took over as the new leader, the other shared its call
+    assert asyncio.run(main()) == [2, 2]
+    assert calls == 2
+
+
+def test_callers_on_different_threads_share_one_call():
+    flight = SingleFlight()
+    calls = 0
+    started = threading.Event()
+    results = []
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        started.set()
+        await asyncio.sleep(0.1)
+        return "shared"
+
+    def caller():
+        results.append(asyncio.run(flight.do("k", fetch)))
+
+    first = threading.Thread(target=caller)
+    first.start()
+    started.wait(1)
+    others = [threading.Thread(target=caller) for _ in range(3)]
+    for t in others:
+        t.start()
+    for t in [first] + others:
+        t.join()
+    assert calls == 1
+    assert results == ["shared"] * 4
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import time
+from urllib.parse import unquote
+
+import pytest
+
+import deadline
+import http_clients
+import upstream
+from geo_cache import GeoCache
+from single_flight import SingleFlight
+from upstream import Upstream
+
+MESSAGES = [{"role": "user", "content": "Find 3 Walmart groceries near San Ramon"}]
+
+
+class Response:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data
+        self.text = json.dumps(data)
+        self.headers = {}
+
+    def json(self):
+        return self._data
+
+
+class FakeTransport:
+    """Upstream transport answering from scripted handlers, recording every call."""
+
+    def __init__(self, request=None, pieces=(), delay=0.0):
+        self.handler = request
+        self.pieces = pieces
+        self.delay = delay
+        self.calls = []
+
+    async def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        return await self.handler(method, url, **kwargs)
+
+    async def stream_lines(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        for piece in self.pieces:
+            await asyncio.sleep(self.delay)
+            yield "data: " + json.dumps({"choices": [{"delta": {"content": piece}}]})
+        yield "data: [DONE]"
+
+    def stats(self):
+        return {}
+
+
+@pytest.fixture(autouse=True)
+def configured(monkeypatch):
+    monkeypatch.setattr(upstream.config, "SUDO_API_KEY", "key")
+    monkeypatch.setattr(upstream.config, "MAPBOX_TOKEN", "token")
+    monkeypatch.setattr(upstream, "FLIGHTS", SingleFlight(abandon=(deadline.DeadlineExceeded,)))
+    monkeypatch.setattr(upstream, "LIMITER", None)
+    monkeypatch.setattr(upstream, "HEDGER", None)
+
+
+async def collect(stream):
+    return [piece async for piece in stream]
+
+
+def test_identical_streams_share_one_call():
+    transport = FakeTransport(pieces=["Walmart, ", "2551 San Ramon Valley Blvd"], delay=0.02)
+    up = Upstream(transport)
+
+    async def main():
+        streams = asyncio.gather(collect(up.sudo_chat_stream(MESSAGES)), collect(up.sudo_chat_stream(MESSAGES)))
+        await asyncio.sleep(0.01)
+        chat = await up.sudo_chat(MESSAGES)  # while the streams are still running
+        return (*await streams, chat)
+
+    leader, follower, chat = asyncio.run(main())
+    assert len(transport.calls) == 1
+    # The leader streams; the others get the finished text whole
+    assert leader == ["Walmart, ", "2551 San Ramon Valley Blvd"]
+    assert follower == ["Walmart, 2551 San Ramon Valley Blvd"]
+    assert chat["choices"][0]["message"]["content"] == "Walmart, 2551 San Ramon Valley Blvd"
+    assert upstream.FLIGHTS.stats() == {"calls": 1, "coalesced": 2, "inFlight": 0}
+
+
+def test_stream_joins_a_chat_in_flight():
+    async def chat(method, url, **kwargs):
+        await asyncio.sleep(0.05)
+        return Response(200, {"choices": [{"message": {"role": "assistant", "content": "Walmart"}}]})
+
+    transport = FakeTransport(chat)
+    up = Upstream(transport)
+
+    async def main():
+        first = asyncio.ensure_future(up.sudo_chat(MESSAGES))
+        await asyncio.sleep(0.01)
+        return await collect(up.sudo_chat_stream(MESSAGES)), await first
+
+    pieces, _ = asyncio.run(main())
+    assert pieces == ["Walmart"]
+    assert len(transport.calls) == 1
+
+
+def test_stream_joining_a_failed_chat_raises():
+    async def chat(method, url, **kwargs):
+        await asyncio.sleep(0.05)
+        return Response(500, {"message": "down"})
+
+    up = Upstream(FakeTransport(chat))
+
+    async def main():
+        first = asyncio.ensure_future(up.sudo_chat(MESSAGES))
+        await asyncio.sleep(0.01)
+        with pytest.raises(http_clients.UpstreamError):
+            await collect(up.sudo_chat_stream(MESSAGES))
+        assert "error" in await first
+
+    asyncio.run(main())
+
+
+def test_closing_the_leading_stream_hands_the_call_over():
+    transport = FakeTransport(pieces=["a", "b", "c"], delay=0.02)
+    up = Upstream(transport)
+
+    async def main():
+        leader = up.sudo_chat_stream(MESSAGES)
+        assert await leader.__anext__() == "a"
+        follower = asyncio.ensure_future(collect(up.sudo_chat_stream(MESSAGES)))
+        await asyncio.sleep(0.01)
+        await leader.aclose()
+        return await follower
+
+    # The waiting stream retries as the new leader
+    assert asyncio.run(main()) == ["a", "b", "c"]
+    assert len(transport.calls) == 2
+    assert upstream.FLIGHTS.stats()["inFlight"] == 0
+
+
+def geocoder(answers, cancelled=None):
+    """Geocoding handler: answers[variant] is (seconds, found or an exception to raise)."""
+    async def request(method, url, **kwargs):
+        variant = unquote(url.rsplit("/", 1)[1][:-len(".json")])
+        seconds, outcome = answers[variant]
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            if cancelled is not None:
+                cancelled.append(variant)
+            raise
+        if isinstance(outcome, Exception):
+            raise outcome
+        features = [{"center": [-121.98, 37.78], "place_name": f"{variant} (mapbox)", "text": variant}] if outcome else []
+        return Response(200, {"features": features})
+    return request
+
+
+VARIANTS = ["San Ramon", "San Ramon, USA", "San Ramon, California"]
+
+
+@pytest.fixture
+def caches(monkeypatch, tmp_path):
+    monkeypatch.setattr(upstream, "GEOCODE_CACHE", None)
+    monkeypatch.setattr(upstream, "START_ALIASES", GeoCache(str(tmp_path / "aliases.sqlite3"), table="start_aliases"))
+
+
+def test_first_variant_to_geocode_wins(caches):
+    cancelled = []
+    transport = FakeTransport(geocoder({
+        "San Ramon": (0.01, False),
+        "San Ramon, USA": (0.03, True),
+        "San Ramon, California": (1.0, True),
+    }, cancelled))
+    up = Upstream(transport)
+
+    async def main():
+        t0 = time.monotonic()
+        found, variant = await up.resolve_start("San Ramon", VARIANTS)
+        await asyncio.sleep(0.01)
+        return found, variant, time.monotonic() - t0
+
+    found, variant, elapsed = asyncio.run(main())
+    assert variant == "San Ramon, USA"
+    assert found[0]["address"] == "San Ramon, USA (mapbox)"
+    assert elapsed < 0.5
+    assert cancelled == ["San Ramon, California"]
+    assert len(transport.calls) == 3
+
+
+def test_all_variants_fail(caches):
+    up = Upstream(FakeTransport(geocoder({v: (0.01, False) for v in VARIANTS})))
+    assert asyncio.run(up.resolve_start("San Ramon", VARIANTS)) == ([], None)
+    # A transport failure is raised when no variant geocoded
+    up = Upstream(FakeTransport(geocoder({**{v: (0.01, False) for v in VARIANTS},
+                                          "San Ramon, USA": (0.0, http_clients.UpstreamError("down"))})))
+    with pytest.raises(http_clients.UpstreamError):
+        asyncio.run(up.resolve_start("San Ramon", VARIANTS))
+    assert upstream.START_ALIASES.stats()["entries"] == 0
+
+
+def test_remembered_variant_is_tried_first(caches):
+    answers = {"San Ramon": (0.0, False), "San Ramon, USA": (0.0, False), "San Ramon, California": (0.0, True)}
+    transport = FakeTransport(geocoder(answers))
+    up = Upstream(transport)
+    assert asyncio.run(up.resolve_start("San Ramon", VARIANTS))[1] == "San Ramon, California"
+    assert len(transport.calls) == 3
+    # The same input again: only the variant that worked is looked up
+    transport.calls.clear()
+    assert asyncio.run(up.resolve_start("  san ramon ", VARIANTS))[1] == "San Ramon, California"
+    assert [unquote(url.rsplit("/", 1)[1]) for _, url, _ in transport.calls] == ["San Ramon, California.json"]
+    # A remembered variant that stops geocoding falls back to the race
+    answers["San Ramon, California"] = (0.0, False)
+    answers["San Ramon"] = (0.0, True)
+    transport.calls.clear()
+    assert asyncio.run(up.resolve_start("San Ramon", VARIANTS))[1] == "San Ramon"
+    assert len(transport.calls) == 1 + len(VARIANTS)
@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+"""
+Upstream helpers (Sudo LLM endpoint and Mapbox) shared by both service modes.
+
+Every helper is a coroutine on Upstream, which sends its HTTP requests through a
+transport: RequestsTransport runs the pooled requests sessions from http_clients
+in worker threads (sync Flask app), AsyncHTTPClient talks aiohttp directly
+(async service). Caching, batching and response parsing live here once.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+import service_config as config
+import deadline
+import geo_cache
+import hedging
+import http_clients
+import leg_cache
+import llm_cache
+import rate_limit
+import service_logging
+from single_flight import SingleFlight
+
+# Persistent geocoding cache (GEOCODE_CACHE_PATH / _TTL / _MAX_ENTRIES); None when disabled
+GEOCODE_CACHE = geo_cache.from_env()
+# Which spelling variant of a start input geocoded (see Upstream.resolve_start); None when disabled
+START_ALIASES = geo_cache.aliases_from_env()
+# sudo_chat response cache (LLM_CACHE_BACKEND=memory|disk|off, LLM_CACHE_TTL, LLM_CACHE_MAX_*)
+LLM_CACHE = llm_cache.from_env()
+
+# Identical in-flight calls (same canonical key) are made once and shared; None when disabled.
+# A leader whose own request ran out of time hands the call over instead of failing the others.
+FLIGHTS = SingleFlight(abandon=(deadline.DeadlineExceeded,)) if config.UPSTREAM_SINGLE_FLIGHT else None
+# Travel legs seen in routing responses, for costing combinations without API calls; None when disabled
+LEGS = leg_cache.from_env()
+# Duplicate requests for slow geocoding / optimized-trips calls (UPSTREAM_HEDGING); None when disabled
+HEDGER = hedging.from_env()
+# Shared token buckets and adaptive concurrency per upstream endpoint (RATE_LIMIT_*); None when disabled
+LIMITER = rate_limit.from_env()
+
+log = service_logging.get_logger("upstream")
+
+
+class RequestsTransport:
+    """Blocking pooled sessions from http_clients, run off the event loop in threads."""
+
+    async def request(self, method, url, **kwargs):
+        return await asyncio.to_thread(http_clients.request, method, url, **kwargs)
+
+    async def stream_lines(self, method, url, **kwargs):
+        """Lines of http_clients.iter_lines, read in a worker thread and handed over as they arrive."""
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(lines.put_nowait, item)
+            except RuntimeError:
+                stop.set()  # event loop already closed
+
+        def pump():
+            try:
+                for line in http_clients.iter_lines(method, url, **kwargs):
+                    if stop.is_set():
+                        break
+                    put(("line", line))
+            except Exception as e:
+                put(("error", e))
+            finally:
+                put(("end", None))
+
+        loop.run_in_executor(None, pump)
+        try:
+            while True:
+                kind, item = await lines.get()
+                if kind == "end":
+                    break
+                if kind == "error":
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def stats(self):
+        return http_clients.stats()
+
+
+def location_from_feature(feature, address):
+    """
+    Build a location dict from a Mapbox feature (v5 places or v6 batch format).
+    The address format from Gemini is: "Business Name, Street Address, City, State ZIP"
+    We want to preserve the business name, not use Mapbox's text field.
+    """
+    props = feature.get("properties") or {}
+    if "center" in feature:
+        lon, lat = feature["center"]
+    else:
+        lon, lat = feature["geometry"]["coordinates"][:2]
+    place_name = feature.get("place_name") or props.get("full_address") or address
+    text = feature.get("text") or props.get("name") or address
+
+    # Extract business name from the original address (before the first comma)
+    # Format: "Business Name, Street Address, City, State ZIP"
+    business_name = address.split(",")[0].strip() if "," in address else text
+
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "address": place_name,
+        "name": business_name  # Use the business name from Gemini instead of Mapbox's street name
+    }
+
+
+def _places_url(query):
+    return f"https://api.mapbox.com/geocoding/v5/mapbox.places/{quote(query, safe='')}.json"
+
+
+def _locations(features, query):
+    return [{
+        "latitude": f["center"][1],
+        "longitude": f["center"][0],
+        "address": f.get("place_name", query),
+        "name": f.get("text", query)
+    } for f in features]
+
+
+class Upstream:
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def _once(self, key, fetch):
+        """await fetch(), sharing the call with any identical one already in flight (see single_flight)."""
+        if FLIGHTS is None:
+            return await fetch()
+        return await FLIGHTS.do(key, fetch)
+
+    async def _cached_geocode(self, namespace, query, fetch, **params):
+        """
+        Look up a geocoding result in GEOCODE_CACHE, awaiting fetch() and storing non-empty
+        results on a miss. Concurrent misses for the same key share one fetch.
+        """
+        key = geo_cache.GeoCache.make_key(namespace, query, **params)
+        if GEOCODE_CACHE is not None:
+            hit = await geo_cache.io(GEOCODE_CACHE, "get", key)
+            if hit is not None:
+                return hit
+
+        async def fetch_and_store():
+            value = await fetch()
+            if value and GEOCODE_CACHE is not None:
+                await geo_cache.io(GEOCODE_CACHE, "set", key, value)
+            return value
+
+        return await self._once(key, fetch_and_store)
+
+    def _admit(self, endpoint, cost=1):
+        """LIMITER.call(endpoint, cost); a no-op without a limiter."""
+        if LIMITER is None:
+            return contextlib.nullcontext(rate_limit.Permit())
+        return LIMITER.call(endpoint, cost)
+
+    async def _request(self, method, url, timeout, hedge=None, endpoint=None, cost=1, **kwargs):
+        """
+        transport.request with the timeout capped at the request's remaining budget, admitted
+        by LIMITER as a call to `endpoint` costing `cost` tokens, and hedged (see hedging)
+        when a hedge kind is given. A 429 on a GET is retried (HTTP_RETRIES times) through
+        the limiter, which holds it until the endpoint's Retry-After. Raises
+        deadline.DeadlineExceeded rather than UpstreamError when the call failed because the
+        budget ran out.
+        """
+        async def send():
+            async with self._admit(endpoint, cost) as permit:
+                # The timeout is taken after any wait for the limiter
+                r = await self.transport.request(method, url, timeout=deadline.timeout(timeout), **kwargs)
+                permit.record(r)
+                return r
+
+        retries = config.HTTP_RETRIES if LIMITER is not None and method in http_clients.IDEMPOTENT_METHODS else 0
+        try:
+            for _ in range(retries + 1):
+                if hedge and HEDGER is not None:
+                    r = await HEDGER.do(hedge, send)
+                else:
+                    r = await send()
+                if r.status_code != 429:
+                    break
+            return r
+        except http_clients.UpstreamError:
+            if deadline.expired():
+                raise deadline.DeadlineExceeded() from None
+            raise
+
+    async def _get_json(self, url, params, timeout=30, hedge=None, endpoint=None):
+        """GET a Mapbox JSON endpoint (coalesced on URL and parameters); None unless HTTP 200."""
+        key = "get|" + url + "|" + "&".join(f"{k}={params[k]}" for k in sorted(params) if k != "access_token")
+
+        async def fetch():
+            r = await self._request("GET", url, params=params, timeout=timeout, hedge=hedge, endpoint=endpoint)
+            if r.status_code != 200:
+                return None
+            return r.json()
+
+        return await self._once(key, fetch)
+
+    async def sudo_chat(self, messages, model="gemini-2.0-flash"):
+        if not config.SUDO_API_KEY:
+            return {"error": "SUDO_API_KEY not configured"}
+        if LLM_CACHE is not None:
+            cached = await geo_cache.io(LLM_CACHE, "get", model, messages)
+            if cached is not None:
+                return cached
+        return await self._once(llm_cache.cache_key(model, messages), lambda: self._chat(messages, model))
+
+    async def _chat(self, messages, model):
+        headers = {
+            "Authorization": f"Bearer {config.SUDO_API_KEY}",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "model": model,
+            "messages": messages,
+        }
+
+        service_logging.event(log, "llm.request", logging.DEBUG, url=config.SUDO_URL, model=model, messages=len(messages))
+        t0 = time.perf_counter()
+        r = await self._request("POST", config.SUDO_URL, headers=headers, json=payload, timeout=30, endpoint="llm")
+
+        if r.status_code != 200:
+            service_logging.event(log, "llm.error", logging.WARNING, model=model, status=r.status_code,
+                                  ms=service_logging.ms_since(t0), body=r.text[:200])
+            return {"error": f"HTTP {r.status_code}", "body": r.text}
+        service_logging.event(log, "llm.response", model=model, status=r.status_code, ms=service_logging.ms_since(t0))
+        data = r.json()
+        if LLM_CACHE is not None:
+            await geo_cache.io(LLM_CACHE, "set", model, messages, data)
+        return data
+
+    async def sudo_chat_stream(self, messages, model="gemini-2.0-flash"):
+        """
+        Yield the completion text in pieces as the model generates it (OpenAI-style SSE
+        with "stream": true). A cached answer is yielded as one piece, and the finished
+        text is cached like sudo_chat's. If the endpoint ignores "stream" and returns a
+        plain completion, its content is yielded whole. The call is coalesced with
+        identical sudo_chat / sudo_chat_stream calls: one already in flight is waited
+        for and its text yielded as one piece. Raises UpstreamError on failure.
+        """
+        if not config.SUDO_API_KEY:
+            raise http_clients.UpstreamError("SUDO_API_KEY not configured")
+        if LLM_CACHE is not None:
+            cached = await geo_cache.io(LLM_CACHE, "get", model, messages)
+            if cached is not None:
+                yield cached.get("choices", [{}])[0].get("message", {}).get("content", "")
+                return
+        # Pieces arrive here only when this call leads; None once the call is over
+        pieces = asyncio.Queue()
+
+        def finished(task):
+            if not task.cancelled():
+                task.exception()  # retrieved here too, in case the consumer has gone
+            pieces.put_nowait(None)
+
+        call = asyncio.ensure_future(self._once(llm_cache.cache_key(model, messages),
+                                                lambda: self._chat_stream(messages, model, pieces.put_nowait)))
+        call.add_done_callback(finished)
+        streamed = False
+        try:
+            while True:
+                piece = await pieces.get()
+                if piece is None:
+                    break
+                streamed = True
+                yield piece
+            data = call.result()
+        finally:
+            # The consumer stopped early: give up the call (waiters on it take over)
+            call.cancel()
+        if "error" in data:
+            # Shared from a sudo_chat that failed
+            raise http_clients.UpstreamError(data["error"])
+        text = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        if not streamed and text:
+            yield text
+
+    async def _chat_stream(self, messages, model, emit):
+        # emit(piece) for each piece of text as it arrives; returns the completion as sudo_chat would
+        headers = {
+            "Authorization": f"Bearer {config.SUDO_API_KEY}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+        }
+
+        service_logging.event(log, "llm.stream_request", logging.DEBUG, url=config.SUDO_URL, model=model, messages=len(messages))
+        t0 = time.perf_counter()
+        first_ms = None
+        parts = []
+        plain = []
+        async with self._admit("llm") as permit:
+            async for line in self.transport.stream_lines("POST", config.SUDO_URL, headers=headers, json=payload,
+                                                              timeout=deadline.timeout(60)):
+                if not line.startswith("data:"):
+                    if line and not line.startswith(":"):
+                        plain.append(line)
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data).get("choices", [{}])[0].get("delta", {}).get("content") or ""
+                except (ValueError, AttributeError, IndexError):
+                    continue
+                if delta:
+                    if first_ms is None:
+                        first_ms = service_logging.ms_since(t0)
+                    parts.append(delta)
+                    emit(delta)
+            # stream_lines raises on anything but a 200
+            permit.status = 200
+        if not parts and plain:
+            try:
+                data = json.loads("\n".join(plain))
+            except ValueError:
+                raise http_clients.UpstreamError("unrecognized streaming response")
+            text = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+            parts.append(text)
+            emit(text)
+        service_logging.event(log, "llm.stream_response", model=model, firstTokenMs=first_ms, ms=service_logging.ms_since(t0))
+        data = {"choices": [{"message": {"role": "assistant", "content": "".join(parts)}}]}
+        if LLM_CACHE is not None and parts:
+            await geo_cache.io(LLM_CACHE, "set", model, messages, data)
+        return data
+
+    async def geocode(self, query, proximity=None, limit=5):
+        if not config.MAPBOX_TOKEN:
+            return []
+        # Round the proximity bias (~1km) so nearby callers share cache entries
+        bias = f"{round(proximity[0], 2)},{round(proximity[1], 2)}" if proximity and len(proximity) == 2 else None
+
+        async def fetch():
+            params = {
+                "access_token": config.MAPBOX_TOKEN,
+                "limit": limit,
+                "types": "poi",
+                "autocomplete": "true",
+            }
+            if proximity and len(proximity) == 2:
+                params["proximity"] = f"{proximity[0]},{proximity[1]}"
+            r = await self._request("GET", _places_url(query), params=params, timeout=20, hedge="geocode", endpoint="geocode")
+            if r.status_code != 200:
+                return []
+            return _locations(r.json().get("features", [])[:limit], query)
+
+        return await self._cached_geocode("poi", query, fetch, proximity=bias, limit=limit)
+
+    async def geocode_start(self, query):
+        if not config.MAPBOX_TOKEN:
+            return []
+        return await self._cached_geocode("start", query, lambda: self.fetch_start(query))
+
+    async def fetch_start(self, query):
+        params = {
+            "access_token": config.MAPBOX_TOKEN,
+            "limit": 1,
+            "types": "place,locality,region,district,address",
+            "country": "us",
+        }
+        r = await self._request("GET", _places_url(query), params=params, timeout=20, hedge="geocode", endpoint="geocode")
+        if r.status_code != 200:
+            return []
+        return _locations(r.json().get("features", [])[:1], query)
+
+    async def resolve_start(self, query, variants):
+        """
+        Resolve a starting location from spelling variants of query (query itself first).
+        A variant remembered in START_ALIASES for this input is tried alone; otherwise the
+        geocode cache is checked and then every variant is looked up concurrently and the
+        first to geocode wins (the others are cancelled). The winner is remembered in
+        START_ALIASES, so a repeat of the input costs one lookup, or none when cached.
+        Returns (locations, variant) or ([], None).
+        """
+        if not config.MAPBOX_TOKEN:
+            return [], None
+        alias_key = geo_cache.GeoCache.make_key("start-alias", query)
+        alias = await geo_cache.io(START_ALIASES, "get", alias_key) if START_ALIASES is not None else None
+        if alias:
+            found = await self.geocode_start(alias)
+            if found:
+                service_logging.event(log, "start.variant", logging.DEBUG, source="alias", variant=alias)
+                return found, alias
+
+        variants = list(dict.fromkeys(v for v in variants if v))
+        if GEOCODE_CACHE is not None:
+            keys = {v: geo_cache.GeoCache.make_key("start", v) for v in variants}
+            hits = await geo_cache.io(GEOCODE_CACHE, "get_many", list(keys.values()))
+            for v in variants:
+                if hits.get(keys[v]):
+                    return hits[keys[v]], v
+
+        # Variants usually share a geocode cache key, so each race entry is coalesced on its exact text
+        jobs = {asyncio.ensure_future(self._once(f"start-variant|{v}", lambda v=v: self.fetch_start(v))): v for v in variants}
+        pending = set(jobs)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                hits = []
+                for job in done:
+                    if job.exception() is not None:
+                        error = error or job.exception()
+                    elif job.result():
+                        hits.append(job)
+                if hits:
+                    # Several finished together: prefer the earlier variant
+                    job = min(hits, key=lambda j: variants.index(jobs[j]))
+                    winner, found = jobs[job], job.result()
+                    if GEOCODE_CACHE is not None:
+                        await geo_cache.io(GEOCODE_CACHE, "set", geo_cache.GeoCache.make_key("start", winner), found)
+                    if START_ALIASES is not None:
+                        await geo_cache.io(START_ALIASES, "set", alias_key, winner)
+                    service_logging.event(log, "start.variant", logging.DEBUG, source="race", variant=winner,
+                                          raced=len(variants))
+                    return found, winner
+        finally:
+            for job in pending:
+                job.cancel()
+                # Not awaited any more: retrieve how it ended, so a failure is not logged as never retrieved
+                job.add_done_callback(lambda j: j.cancelled() or j.exception())
+        if error is not None:
+            raise error
+        return [], None
+
+    async def geocode_address(self, address):
+        """
+        Geocode an address and extract the business name from it.
+        """
+        if not config.MAPBOX_TOKEN:
+            return None
+        # The cache holds the raw Mapbox feature; the business name is re-derived from
+        # this caller's spelling of the address.
+        feature = await self._cached_geocode("address", address, lambda: self.fetch_address_feature(address))
+        return location_from_feature(feature, address) if feature else None
+
+    async def fetch_address_feature(self, address):
+        params = {
+            "access_token": config.MAPBOX_TOKEN,
+            "limit": 1,
+        }
+        r = await self._request("GET", _places_url(address), params=params, timeout=20, hedge="geocode", endpoint="geocode")
+        if r.status_code != 200:
+            return None
+        features = r.json().get("features", [])
+        if not features:
+            return None
+        return features[0]
+
+    async def geocode_batch(self, addresses):
+        """
+        Geocode many addresses with one call to the batch endpoint in MAPBOX_BATCH_GEOCODE_URL
+        (Mapbox v6 /search/geocode/v6/batch). Returns a list of features aligned with addresses,
+        or None if the batch call itself failed so the caller can fall back.
+        """
+        results = []
+        for i in range(0, len(addresses), config.GEOCODE_BATCH_SIZE):
+            chunk = addresses[i:i + config.GEOCODE_BATCH_SIZE]
+            r = await self._request(
+                "POST",
+                config.MAPBOX_BATCH_GEOCODE_URL,
+                params={"access_token": config.MAPBOX_TOKEN},
+                json=[{"q": a, "limit": 1} for a in chunk],
+                timeout=20,
+                # Mapbox counts every query of a batch against the geocoding limit
+                endpoint="geocode",
+                cost=len(chunk),
+            )
+            if r.status_code != 200:
+                return None
+            batch = r.json().get("batch", [])
+            for j in range(len(chunk)):
+                features = batch[j].get("features", []) if j < len(batch) else []
+                results.append(features[0] if features else None)
+        return results
+
+    async def geocode_addresses(self, addresses):
+        """
+        Bulk geocoding layer for LLM-supplied addresses. Identical strings are geocoded once
+        and cached features are reused; the remaining misses go to the batch endpoint when
+        MAPBOX_BATCH_GEOCODE_URL is set, otherwise they are fetched concurrently
+        (at most GEOCODE_CONCURRENCY at a time). Returns a list aligned with addresses
+        (None where geocoding failed); each entry is a fresh dict.
+        """
+        if not config.MAPBOX_TOKEN or not addresses:
+            return [None] * len(addresses)
+        unique = list(dict.fromkeys(addresses))
+        features = {}
+        misses = []
+        keys = {a: geo_cache.GeoCache.make_key("address", a) for a in unique}
+        hits = await geo_cache.io(GEOCODE_CACHE, "get_many", list(keys.values())) if GEOCODE_CACHE is not None else {}
+        for a in unique:
+            if keys[a] in hits:
+                features[a] = hits[keys[a]]
+            else:
+                misses.append(a)
+
+        found = None
+        if misses and config.MAPBOX_BATCH_GEOCODE_URL:
+            try:
+                found = await self.geocode_batch(misses)
+            except (http_clients.UpstreamError, deadline.DeadlineExceeded):
+                found = None
+        if misses and found is None:
+            limit = asyncio.Semaphore(max(1, config.GEOCODE_CONCURRENCY))
+
+            async def fetch(a):
+                async with limit:
+                    return await self._once(geo_cache.GeoCache.make_key("address", a), lambda: self.fetch_address_feature(a))
+
+            # Lookups still running when the budget runs out count as failed
+            found = await deadline.gather_partial([fetch(a) for a in misses], "geocode")
+        for a, f in zip(misses, found or []):
+            features[a] = f
+        if GEOCODE_CACHE is not None:
+            await geo_cache.io(GEOCODE_CACHE, "set_many", [(keys[a], features[a]) for a in misses if features.get(a)])
+
+        return [location_from_feature(features[a], a) if features.get(a) else None for a in addresses]
+
+    async def optimized_trip(self, coords, source_first=True, destination_last=False):
+        if not config.MAPBOX_TOKEN or len(coords) < 2:
+            return None
+        coords_str = ";".join([f"{lon},{lat}" for lon, lat in coords])
+        url = f"https://api.mapbox.com/optimized-trips/v1/mapbox/driving-traffic/{coords_str}"
+        params = {
+            "access_token": config.MAPBOX_TOKEN,
+            "steps": "true",
+            "geometries": "geojson",
+            "overview": "full",
+        }
+        if source_first:
+            params["source"] = "first"
+        if destination_last:
+            params["destination"] = "last"
+        data = await self._get_json(url, params, hedge="trips", endpoint="trips")
+        if LEGS is not None and data and data.get("trips") and data.get("waypoints"):
+            # waypoint_index is each input's position in the trip; the trip is a round trip
+            ordered = [None] * len(coords)
+            for c, w in zip(coords, data["waypoints"]):
+                ordered[w.get("waypoint_index", 0)] = c
+            if None not in ordered:
+                LEGS.put_legs(ordered + ordered[:1], data["trips"][0].get("legs") or [])
+        return data
+
+    async def directions_waypoints(self, coords, steps=False):
+        if not config.MAPBOX_TOKEN or len(coords) < 2:
+            return None
+        coords_str = ";".join([f"{lon},{lat}" for lon, lat in coords])
+        url = f"https://api.mapbox.com/directions/v5/mapbox/driving-traffic/{coords_str}"
+        params = {
+            "access_token": config.MAPBOX_TOKEN,
+            "geometries": "geojson",
+            "overview": "full",
+            "annotations": "duration,distance"
+        }
+        if steps:
+            params["steps"] = "true"
+        data = await self._get_json(url, params, endpoint="directions")
+        if LEGS is not None and data and data.get("routes"):
+            LEGS.put_legs(coords, data["routes"][0].get("legs") or [])
+        return data
+
+    async def travel_matrix(self, coords):
+        """
+        Fetch an NxN travel matrix for coords [(lon, lat), ...] from the Mapbox Matrix API.
+        Inputs larger than MATRIX_MAX_COORDS are split into blocks of half that size and
+        fetched one pair of blocks per call (calls run concurrently). No call is made when
+        the leg cache knows every pair.
+        Returns {"durations": [[...]], "distances": [[...]]} (None entries are unroutable)
+        or None if any call failed.
+        """
+        n = len(coords)
+        if not config.MAPBOX_TOKEN or n < 2:
+            return None
+        if LEGS is not None:
+            known = LEGS.matrix(coords)
+            if known is not None:
+                return known
+        block = n if n <= config.MATRIX_MAX_COORDS else max(1, config.MATRIX_MAX_COORDS // 2)
+        blocks = [list(range(i, min(i + block, n))) for i in range(0, n, block)]
+        # Each call covers two blocks and returns their full sub-matrix, so every
+        # pair of blocks (and each block with itself) is fetched exactly once
+        pairs = [(a, b) for a in range(len(blocks)) for b in range(a + 1, len(blocks))] or [(0, 0)]
+
+        async def fetch(idx):
+            coords_str = ";".join(f"{coords[i][0]},{coords[i][1]}" for i in idx)
+            url = f"https://api.mapbox.com/directions-matrix/v1/mapbox/driving-traffic/{coords_str}"
+            params = {
+                "access_token": config.MAPBOX_TOKEN,
+                "annotations": "duration,distance",
+            }
+            data = await self._get_json(url, params, endpoint="matrix")
+            return data if data and "durations" in data else None
+
+        groups = [blocks[a] + (blocks[b] if b != a else []) for a, b in pairs]
+        results = await asyncio.gather(*(fetch(idx) for idx in groups))
+        if any(data is None for data in results):
+            return None
+        durations = [[None] * n for _ in range(n)]
+        distances = [[None] * n for _ in range(n)]
+        for idx, data in zip(groups, results):
+            for x, i in enumerate(idx):
+                for y, j in enumerate(idx):
+                    durations[i][j] = data["durations"][x][y]
+                    if data.get("distances"):
+                        distances[i][j] = data["distances"][x][y]
+        if LEGS is not None:
+            LEGS.put_matrix(coords, durations, distances)
+        return {"durations": durations, "distances": distances}
+
+    def known_legs(self, coords):
+        """Travel matrix for coords from the leg cache alone (no API call), or None if any leg is unknown."""
+        return LEGS.matrix(coords) if LEGS is not None else None
+
+    def cache_stats(self):
+        """Stats of the caches that may be SQLite files (blocking: call it off the event loop)."""
+        return {
+            "geocodeCache": GEOCODE_CACHE.stats() if GEOCODE_CACHE is not None else "disabled",
+            "startAliases": START_ALIASES.stats() if START_ALIASES is not None else "disabled",
+            "llmCache": LLM_CACHE.stats() if LLM_CACHE is not None else "disabled",
+        }
+
+    def stats(self):
+        return {
+            "httpPools": self.transport.stats(),
+            "singleFlight": FLIGHTS.stats() if FLIGHTS is not None else "disabled",
+            "hedging": HEDGER.stats() if HEDGER is not None else "disabled",
+            "legCache": LEGS.stats() if LEGS is not None else "disabled",
+            "rateLimit": LIMITER.stats() if LIMITER is not None else "disabled",
+        }